@@ -1,16 +1,30 @@
 # Application factory for the Firestore adapter service
-from flask import Flask, jsonify, send_from_directory, request, current_app
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, jsonify, send_from_directory, request, current_app, stream_with_context
 from config import Config, validate_config
-from google.cloud import firestore
-from google.api_core.exceptions import InvalidArgument, NotFound
+from werkzeug.test import EnvironBuilder
 
 # Import the consolidated core functionalities
 from core import (
     configure_logging,
     register_error_handlers,
+    register_instrumentation,
+    register_deadlines,
+    register_compression,
+    register_services,
+    metrics_exposition,
+    TimedJSONProvider,
     require_api_key,
+    PRE_AUTHENTICATED,
+    NDJSON_MIMETYPE,
+    SSE_MIMETYPE,
+    SSE_HEADERS,
     FirestoreClient,
     FilterBuilder,
+    RequestBody,
+    Endpoints,
+    DocumentVersion,
     AppError
 )
 
@@ -20,13 +34,26 @@ def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
     app.config["ALL_API_KEYS"] = Config.ALL_API_KEYS # Explicitly set for the app context
+    app.json = TimedJSONProvider(app, encoder=app.config["JSON_ENCODER"])
+
+    # Firestore client, optional document cache, admission limits and watch hub, stored on the app
+    firestore_client = register_services(app, FirestoreClient, lambda client: client.db)
+    if app.config["FIRESTORE_PREWARM"]:
+        firestore_client.warm_in_background(app.config["WARMUP_TIMEOUT"])
 
-    # Initialize Firestore client and store on the app
-    firestore_client = FirestoreClient(app.config["FIRESTORE_CREDENTIALS"])
-    app.extensions["firestore_client"] = firestore_client
+    # Sub-requests of POST /batch run on one bounded pool shared by all batch calls
+    app.extensions["multiplex_pool"] = ThreadPoolExecutor(
+        max_workers=app.config["MULTIPLEX_CONCURRENCY"], thread_name_prefix="multiplex"
+    )
 
     # Register custom error handlers
     register_error_handlers(app)
+    # Server-Timing header and Prometheus metrics for every request
+    register_instrumentation(app)
+    # Per-request Firestore deadline from X-Request-Deadline or RPC_DEADLINE
+    register_deadlines(app)
+    # gzip/br for large bodies; registered last so it runs before the timer is finished
+    register_compression(app)
     
     def get_client():
         """Helper to get the Firestore client from app context."""
@@ -36,15 +63,28 @@ def create_app():
 
     @app.route("/")
     def root():
-        return jsonify({
-            "status": "success",
-            "message": "Firestore Adapter service is running.",
-            "documentation": "/openapi.yaml"
-        })
+        return jsonify(Endpoints.ROOT)
 
     @app.route("/health")
     def health():
-        return jsonify({"status": "success", "message": "Service is healthy."})
+        return jsonify(Endpoints.HEALTHY)
+
+    @app.route("/warmup")
+    def warmup():
+        """Readiness check: creates the Firestore client and waits for its channel."""
+        with Endpoints.readiness():
+            get_client().warm(current_app.config["WARMUP_TIMEOUT"])
+        return jsonify(Endpoints.READY)
+
+    @app.route("/stats")
+    @require_api_key
+    def stats():
+        return jsonify(Endpoints.stats(current_app))
+
+    @app.route("/metrics")
+    def metrics():
+        body, content_type = metrics_exposition()
+        return Response(body, content_type=content_type)
 
     @app.route('/openapi.yaml')
     def openapi_spec():
@@ -55,44 +95,47 @@ def create_app():
     @require_api_key
     def query_documents(collection):
         client = get_client()
-        db = client.db
-        query = db.collection(collection)
-
-        try:
-            filters = FilterBuilder.build(request.args)
-            for f in filters:
-                query = query.where(*f)
-        except InvalidArgument as e:
-            raise AppError(f"Invalid filter: {e}", 400)
-
-        order_by = request.args.get("order_by")
-        if order_by:
-            for field in order_by.split(","):
-                direction = firestore.Query.DESCENDING if field.startswith("-") else firestore.Query.ASCENDING
-                field_name = field.lstrip("-")
-                query = query.order_by(field_name, direction=direction)
-
-        try:
-            limit = int(request.args.get("limit", 20))
-            if not (1 <= limit <= 1000):
-                raise AppError("Limit must be between 1 and 1000", 400)
-            offset = int(request.args.get("offset", 0))
-            if offset < 0:
-                raise AppError("Offset must be non-negative", 400)
-        except ValueError:
-            raise AppError("Limit and offset must be integers", 400)
-
-        query = query.limit(limit)
-        docs = list(query.stream())[offset:offset+limit]
-
-        fields = request.args.get("fields")
-        if fields:
-            field_list = [f.strip() for f in fields.split(",")]
-            data = [{k: v for k, v in doc.to_dict().items() if k in field_list} | {"id": doc.id} for doc in docs]
-        else:
-            data = [{**doc.to_dict(), "id": doc.id} for doc in docs]
+        stream, query, with_total = Endpoints.query(current_app, request)
+
+        if stream:
+            # Started here so invalid filters and page tokens are reported with an error status
+            docs = client.stream_documents(collection, **query)
+
+            def generate():
+                try:
+                    for doc in docs:
+                        yield Endpoints.ndjson(current_app, doc)
+                except AppError as e:
+                    yield Endpoints.stream_error(current_app, e)
+            return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+        result = client.query_documents(collection, **query, with_total=with_total)
+        return Endpoints.page(current_app, request, query, with_total, result)
+
+    @app.route("/documents/<collection>:watch", methods=["GET"])
+    @require_api_key
+    def watch_documents(collection):
+        subscription = Endpoints.subscribe(current_app, request, collection)
+        events = subscription.events(current_app.config["WATCH_HEARTBEAT_SECONDS"])
+        response = Response(events, mimetype=SSE_MIMETYPE, headers=SSE_HEADERS)
+        # Unsubscribe when the client disconnects, even before the first event was sent
+        response.call_on_close(subscription.close)
+        return response
+
+    @app.route("/documents/<collection>:aggregate", methods=["GET"])
+    @require_api_key
+    def aggregate_documents(collection):
+        data = get_client().aggregate(collection, **Endpoints.aggregations(current_app, request))
+        return jsonify(Endpoints.data(data))
 
-        return jsonify({"status": "success", "data": data, "limit": limit, "offset": offset, "count": len(data)})
+    @app.route("/collections/<collection>/subcollections/<subcollection>", methods=["GET"])
+    @require_api_key
+    def query_subcollections(collection, subcollection):
+        filters, limit, offset, include_parent = Endpoints.subcollection_query(current_app, request)
+        result = get_client().query_subcollection_group(
+            collection, subcollection, filters, limit, offset=offset, include_parent=include_parent
+        )
+        return jsonify(Endpoints.subcollections(collection, subcollection, limit, offset, result))
 
     @app.route("/documents/<collection>", methods=["POST"])
     @require_api_key
@@ -110,37 +153,99 @@ def create_app():
             # Let Firestore generate the ID
             result = client.create_document(collection, data)
             
-        return jsonify({"status": "success", "data": result}), 201
+        return Endpoints.created(result)
+
+    @app.route("/documents/<collection>:batch", methods=["POST"])
+    @require_api_key
+    def batch_write(collection):
+        operations, atomic = RequestBody.operations(
+            request.get_json(silent=True), current_app.config["BATCH_MAX_OPERATIONS"]
+        )
+        results = get_client().batch_write(collection, operations, atomic=atomic)
+        return jsonify(RequestBody.batch_write_response(results))
+
+    def dispatch_sub_request(method, path, body, headers):
+        """Run one POST /batch sub-request through the normal routing, hooks and error handlers."""
+        kwargs = {"json": body} if body is not None else {}
+        environ = EnvironBuilder(path=path, method=method, headers=headers, **kwargs).get_environ()
+        environ[PRE_AUTHENTICATED] = True
+        with app.request_context(environ):
+            try:
+                response = app.full_dispatch_request()
+            except Exception as e:
+                response = app.handle_exception(e)
+            if response.is_streamed:
+                response.close()
+                return RequestBody.streamed_sub_response()
+            body = response.get_json(silent=True) if response.is_json else response.get_data(as_text=True) or None
+            return RequestBody.sub_response(response.status_code, body, response.headers)
+
+    @app.route("/batch", methods=["POST"])
+    @require_api_key
+    def multiplex():
+        sub_requests = RequestBody.sub_requests(
+            request.get_json(silent=True), current_app.config["MULTIPLEX_MAX_REQUESTS"]
+        )
+        pool = current_app.extensions["multiplex_pool"]
+        results = list(pool.map(lambda sub: dispatch_sub_request(*sub), sub_requests))
+        return jsonify(RequestBody.multiplex_response(results))
+
+    def batch_get_response(paths, ids):
+        body = request.get_json(silent=True)
+        fields = RequestBody.batch_get(body, paths, current_app.config["BATCH_MAX_OPERATIONS"])
+        docs = get_client().read_documents(paths, fields=fields)
+        return jsonify(RequestBody.batch_get_response(ids, docs))
+
+    @app.route("/documents/<collection>:batchGet", methods=["POST"])
+    @require_api_key
+    def batch_get(collection):
+        ids = RequestBody.ids(request.get_json(silent=True))
+        return batch_get_response([f"{collection}/{doc_id}" for doc_id in ids], ids)
+
+    @app.route("/documents:batchGet", methods=["POST"])
+    @require_api_key
+    def batch_get_paths():
+        paths = RequestBody.paths(request.get_json(silent=True))
+        return batch_get_response(paths, paths)
 
     @app.route("/documents/<collection>/<doc_id>", methods=["GET"])
     @require_api_key
     def read_document(collection, doc_id):
-        client = get_client()
-        doc = client.read_document(collection, doc_id)
-        if doc:
-            return jsonify({"status": "success", "data": doc})
-        raise NotFound("Document not found")
+        result = get_client().read_document(collection, doc_id, fields=FilterBuilder.projection(request.args))
+        return Endpoints.document(current_app, request, result)
 
     @app.route("/documents/<collection>/<doc_id>", methods=["PUT"])
     @require_api_key
     def update_document(collection, doc_id):
         data = request.json
-        client = get_client()
-        try:
-            updated = client.update_document(collection, doc_id, data)
-            return jsonify({"status": "success", "data": updated})
-        except NotFound:
-            raise AppError("Document not found", 404)
+        with Endpoints.missing_document():
+            result = get_client().update_document(collection, doc_id, data, **Endpoints.update_options(request))
+        return Endpoints.updated(current_app, result)
+
+    @app.route("/documents/<collection>/<doc_id>/counters/<counter>", methods=["GET"])
+    @require_api_key
+    def read_counter(collection, doc_id, counter):
+        # Cache-Control: no-cache skips the short-lived total cache
+        data = get_client().read_counter(
+            collection, doc_id, counter, use_cache=not request.cache_control.no_cache
+        )
+        return jsonify(Endpoints.data(data))
+
+    @app.route("/documents/<collection>/<doc_id>/counters/<counter>:increment", methods=["POST"])
+    @require_api_key
+    def increment_counter(collection, doc_id, counter):
+        amount = RequestBody.increment(request.get_json(silent=True))
+        data = get_client().increment_counter(collection, doc_id, counter, amount)
+        return jsonify(Endpoints.data(data))
 
     @app.route("/documents/<collection>/<doc_id>", methods=["DELETE"])
     @require_api_key
     def delete_document(collection, doc_id):
-        client = get_client()
-        try:
-            result = client.delete_document(collection, doc_id)
-            return jsonify({"status": "success", "data": result})
-        except NotFound:
-            raise AppError("Document not found", 404)
+        with Endpoints.missing_document():
+            result = get_client().delete_document(
+                collection, doc_id, if_match=DocumentVersion.from_if_match(request.if_match)
+            )
+        return jsonify(Endpoints.data(result))
 
     return app
 
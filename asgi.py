@@ -0,0 +1,272 @@
+# ASGI application factory: the same API served by Quart on an asyncio Firestore client
+from functools import wraps
+import asyncio
+
+from quart import Quart, Response, jsonify, send_from_directory, request, current_app, stream_with_context
+from quart.wrappers.response import DataBody
+from config import Config, validate_config
+
+from core import (
+    configure_logging,
+    register_error_handlers,
+    register_services,
+    start_request_timer,
+    end_request_timer,
+    RequestDeadline,
+    metrics_exposition,
+    ResponseCompression,
+    TimedJSONProvider,
+    admit,
+    UNAUTHORIZED,
+    PRE_AUTHENTICATED,
+    NDJSON_MIMETYPE,
+    SSE_MIMETYPE,
+    SSE_HEADERS,
+    AsyncFirestoreClient,
+    FilterBuilder,
+    RequestBody,
+    Endpoints,
+    DocumentVersion,
+    AppError
+)
+
+
+def require_api_key(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        slot = admit(current_app, request.headers, request.scope.get(PRE_AUTHENTICATED), kwargs.get("collection"))
+        if slot is None:
+            return UNAUTHORIZED
+        with slot:
+            return await f(*args, **kwargs)
+    return decorated_function
+
+
+def create_asgi_app():
+    validate_config()
+    configure_logging()
+    app = Quart(__name__)
+    app.config.from_object(Config)
+    app.config["ALL_API_KEYS"] = Config.ALL_API_KEYS
+    app.json = TimedJSONProvider(app, encoder=app.config["JSON_ENCODER"])
+
+    # Snapshot listeners are only available on the synchronous client
+    firestore_client = register_services(app, AsyncFirestoreClient, lambda client: client.sync_db)
+    if app.config["FIRESTORE_PREWARM"]:
+        @app.before_serving
+        async def prewarm():
+            firestore_client.warm_in_background(app.config["WARMUP_TIMEOUT"])
+
+    register_error_handlers(app)
+
+    # Hooks are async so the request timer is set in the request's own context
+    @app.before_request
+    async def start_timer():
+        start_request_timer()
+        RequestDeadline.start(request.headers, current_app.config)
+
+    @app.after_request
+    async def finish_timer(response):
+        return end_request_timer(response, request)
+
+    if app.config["COMPRESSION_ENABLED"]:
+        @app.after_request
+        async def compress_response(response):
+            body = await response.get_data() if isinstance(response.response, DataBody) else None
+            return ResponseCompression.apply(
+                response, body, request.accept_encodings, app.config["COMPRESSION_MIN_SIZE"]
+            )
+
+    def get_client():
+        """Helper to get the Firestore client from app context."""
+        return current_app.extensions["firestore_client"]
+
+    @app.route("/")
+    async def root():
+        return jsonify(Endpoints.ROOT)
+
+    @app.route("/health")
+    async def health():
+        return jsonify(Endpoints.HEALTHY)
+
+    @app.route("/warmup")
+    async def warmup():
+        """Readiness check: creates the Firestore client and waits for its channel."""
+        with Endpoints.readiness():
+            await get_client().warm(current_app.config["WARMUP_TIMEOUT"])
+        return jsonify(Endpoints.READY)
+
+    @app.route("/stats")
+    @require_api_key
+    async def stats():
+        return jsonify(Endpoints.stats(current_app))
+
+    @app.route("/metrics")
+    async def metrics():
+        body, content_type = metrics_exposition()
+        return Response(body, content_type=content_type)
+
+    @app.route('/openapi.yaml')
+    async def openapi_spec():
+        """Serve the OpenAPI specification file."""
+        return await send_from_directory('.', 'openapi.yaml', mimetype='text/yaml')
+
+    @app.route("/documents/<collection>", methods=["GET"])
+    @require_api_key
+    async def query_documents(collection):
+        client = get_client()
+        stream, query, with_total = Endpoints.query(current_app, request)
+
+        if stream:
+            # Started here so invalid filters and page tokens are reported with an error status
+            docs = await client.stream_documents(collection, **query)
+
+            @stream_with_context
+            async def generate():
+                try:
+                    async for doc in docs:
+                        yield Endpoints.ndjson(current_app, doc)
+                except AppError as e:
+                    yield Endpoints.stream_error(current_app, e)
+            return Response(generate(), mimetype=NDJSON_MIMETYPE)
+
+        result = await client.query_documents(collection, **query, with_total=with_total)
+        return Endpoints.page(current_app, request, query, with_total, result)
+
+    @app.route("/documents/<collection>:watch", methods=["GET"])
+    @require_api_key
+    async def watch_documents(collection):
+        subscription = Endpoints.subscribe(current_app, request, collection, loop=asyncio.get_running_loop())
+        response = Response(
+            subscription.events(current_app.config["WATCH_HEARTBEAT_SECONDS"]),
+            mimetype=SSE_MIMETYPE, headers=SSE_HEADERS
+        )
+        response.timeout = None  # the stream is open-ended
+        return response
+
+    @app.route("/documents/<collection>:aggregate", methods=["GET"])
+    @require_api_key
+    async def aggregate_documents(collection):
+        data = await get_client().aggregate(collection, **Endpoints.aggregations(current_app, request))
+        return jsonify(Endpoints.data(data))
+
+    @app.route("/collections/<collection>/subcollections/<subcollection>", methods=["GET"])
+    @require_api_key
+    async def query_subcollections(collection, subcollection):
+        filters, limit, offset, include_parent = Endpoints.subcollection_query(current_app, request)
+        result = await get_client().query_subcollection_group(
+            collection, subcollection, filters, limit, offset=offset, include_parent=include_parent
+        )
+        return jsonify(Endpoints.subcollections(collection, subcollection, limit, offset, result))
+
+    @app.route("/documents/<collection>", methods=["POST"])
+    @require_api_key
+    async def create_document(collection):
+        data = await request.get_json()
+        client = get_client()
+        doc_id = request.args.get("doc_id")
+        if doc_id:
+            result = await client.create_document_with_id(collection, doc_id, data)
+        else:
+            result = await client.create_document(collection, data)
+        return Endpoints.created(result)
+
+    @app.route("/documents/<collection>:batch", methods=["POST"])
+    @require_api_key
+    async def batch_write(collection):
+        operations, atomic = RequestBody.operations(
+            await request.get_json(silent=True), current_app.config["BATCH_MAX_OPERATIONS"]
+        )
+        results = await get_client().batch_write(collection, operations, atomic=atomic)
+        return jsonify(RequestBody.batch_write_response(results))
+
+    async def dispatch_sub_request(method, path, body, headers):
+        """Run one POST /batch sub-request through the normal routing, hooks and error handlers."""
+        kwargs = {"json": body} if body is not None else {}
+        ctx = app.test_request_context(
+            path, method=method, headers=headers, scope_base={PRE_AUTHENTICATED: True}, **kwargs
+        )
+        response = await app.handle_request(ctx.request)
+        if not isinstance(response.response, DataBody):
+            return RequestBody.streamed_sub_response()
+        if response.is_json:
+            body = await response.get_json(silent=True)
+        else:
+            body = await response.get_data(as_text=True) or None
+        return RequestBody.sub_response(response.status_code, body, response.headers)
+
+    @app.route("/batch", methods=["POST"])
+    @require_api_key
+    async def multiplex():
+        sub_requests = RequestBody.sub_requests(
+            await request.get_json(silent=True), current_app.config["MULTIPLEX_MAX_REQUESTS"]
+        )
+        limit = asyncio.Semaphore(current_app.config["MULTIPLEX_CONCURRENCY"])
+
+        async def bounded(sub):
+            async with limit:
+                return await dispatch_sub_request(*sub)
+        results = await asyncio.gather(*(bounded(sub) for sub in sub_requests))
+        return jsonify(RequestBody.multiplex_response(list(results)))
+
+    async def batch_get_response(body, paths, ids):
+        fields = RequestBody.batch_get(body, paths, current_app.config["BATCH_MAX_OPERATIONS"])
+        docs = await get_client().read_documents(paths, fields=fields)
+        return jsonify(RequestBody.batch_get_response(ids, docs))
+
+    @app.route("/documents/<collection>:batchGet", methods=["POST"])
+    @require_api_key
+    async def batch_get(collection):
+        body = await request.get_json(silent=True)
+        ids = RequestBody.ids(body)
+        return await batch_get_response(body, [f"{collection}/{doc_id}" for doc_id in ids], ids)
+
+    @app.route("/documents:batchGet", methods=["POST"])
+    @require_api_key
+    async def batch_get_paths():
+        body = await request.get_json(silent=True)
+        paths = RequestBody.paths(body)
+        return await batch_get_response(body, paths, paths)
+
+    @app.route("/documents/<collection>/<doc_id>", methods=["GET"])
+    @require_api_key
+    async def read_document(collection, doc_id):
+        result = await get_client().read_document(collection, doc_id, fields=FilterBuilder.projection(request.args))
+        return Endpoints.document(current_app, request, result)
+
+    @app.route("/documents/<collection>/<doc_id>", methods=["PUT"])
+    @require_api_key
+    async def update_document(collection, doc_id):
+        data = await request.get_json()
+        with Endpoints.missing_document():
+            result = await get_client().update_document(
+                collection, doc_id, data, **Endpoints.update_options(request)
+            )
+        return Endpoints.updated(current_app, result)
+
+    @app.route("/documents/<collection>/<doc_id>/counters/<counter>", methods=["GET"])
+    @require_api_key
+    async def read_counter(collection, doc_id, counter):
+        # Cache-Control: no-cache skips the short-lived total cache
+        data = await get_client().read_counter(
+            collection, doc_id, counter, use_cache=not request.cache_control.no_cache
+        )
+        return jsonify(Endpoints.data(data))
+
+    @app.route("/documents/<collection>/<doc_id>/counters/<counter>:increment", methods=["POST"])
+    @require_api_key
+    async def increment_counter(collection, doc_id, counter):
+        amount = RequestBody.increment(await request.get_json(silent=True))
+        data = await get_client().increment_counter(collection, doc_id, counter, amount)
+        return jsonify(Endpoints.data(data))
+
+    @app.route("/documents/<collection>/<doc_id>", methods=["DELETE"])
+    @require_api_key
+    async def delete_document(collection, doc_id):
+        with Endpoints.missing_document():
+            result = await get_client().delete_document(
+                collection, doc_id, if_match=DocumentVersion.from_if_match(request.if_match)
+            )
+        return jsonify(Endpoints.data(result))
+
+    return app
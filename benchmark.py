@@ -0,0 +1,531 @@
+# Offline benchmark harness for the Firestore adapter
+"""Drive every API route at a configurable concurrency and report the adapter's own overhead.
+
+Requests go through the framework test client, so no network is involved.
+By default Firestore is the in-memory backend from ``fake_firestore`` with a
+simulated RPC latency. With ``--backend emulator`` the local Firestore
+emulator is used instead (``FIRESTORE_EMULATOR_HOST`` must be set).
+
+For each scenario the report shows throughput, p50/p95/p99 latency and the
+peak memory allocated per request, measured with tracemalloc in a separate
+sequential pass. Save a run with ``--output`` and compare a later run against
+it with ``--compare``.
+
+    python benchmark.py --latency-ms 2 --concurrency 16 --requests 500 --output before.json
+    python benchmark.py --latency-ms 2 --concurrency 16 --requests 500 --compare before.json
+
+``--startup N`` measures cold starts instead: N fresh interpreters each import
+the app, build it and serve one query, reporting the time spent in each step.
+
+    python benchmark.py --startup 10 --output startup.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Scenarios ---
+
+SEED_USERS = 1000
+SEED_FILES_PER_USER = 2
+BATCH_SIZE = 50
+HOT_COUNTER = "/documents/pages/home/counters/views"
+# Sub-requests per POST /batch call
+MULTIPLEX_SIZE = 10
+
+# ``build(i, state)`` returns ``(method, path, json_body)`` for the i-th request of a scenario. Streamed
+# responses add a fourth item: the text after which the client stops reading and disconnects. A list of
+# requests is sent one after another and measured as one.
+Scenario = namedtuple("Scenario", ["name", "build"])
+
+
+def _get(path):
+    return lambda i, state: ("GET", path, None)
+
+
+def _user(i):
+    return f"u{i % SEED_USERS}"
+
+
+SCENARIOS = [
+    Scenario("root", _get("/")),
+    Scenario("health", _get("/health")),
+    Scenario("openapi", _get("/openapi.yaml")),
+    Scenario("stats", _get("/stats")),
+    Scenario("metrics", _get("/metrics")),
+    Scenario("warmup", _get("/warmup")),
+    Scenario("query", _get("/documents/users?team=a&order_by=-age&limit=50")),
+    Scenario("query_page_token", lambda i, state: (
+        "GET", f"/documents/users?order_by=age&limit=50&page_token={state['page_token']}", None
+    )),
+    Scenario("query_with_total", _get("/documents/users?team=b&limit=50&with_total=true")),
+    Scenario("query_fields", _get("/documents/users?order_by=age&limit=50&fields=name,age")),
+    Scenario("query_stream", _get("/documents/users?stream=true&limit=1000")),
+    Scenario("aggregate", _get("/documents/users:aggregate?count=true&sum=score&avg=age&team=a")),
+    Scenario("subcollections", _get("/collections/users/subcollections/files?limit=20&include_parent=true")),
+    # Subscribe and read until the initial state is complete; all streams share one listener
+    Scenario("watch", lambda i, state: ("GET", "/documents/users:watch?team=a", None, "event: sync")),
+    Scenario("create", lambda i, state: ("POST", "/documents/bench_created", {"name": f"n{i}", "n": i})),
+    Scenario("create_with_id", lambda i, state: (
+        "POST", f"/documents/bench_created?doc_id=c{i}", {"name": f"n{i}", "n": i}
+    )),
+    Scenario("batch_write", lambda i, state: ("POST", "/documents/bench_batch:batch", {"operations": [
+        {"op": "set", "id": f"b{i}-{j}", "data": {"n": j}} for j in range(BATCH_SIZE)
+    ]})),
+    Scenario("batch_get", lambda i, state: ("POST", "/documents/users:batchGet", {
+        "ids": [_user(i + j) for j in range(BATCH_SIZE)]
+    })),
+    Scenario("batch_get_paths", lambda i, state: ("POST", "/documents:batchGet", {
+        "paths": [f"users/{_user(i + j)}" for j in range(BATCH_SIZE)]
+    })),
+    Scenario("multiplex", lambda i, state: ("POST", "/batch", {"requests": [
+        {"method": "GET", "path": f"/documents/users/{_user(i * MULTIPLEX_SIZE + j)}"} for j in range(MULTIPLEX_SIZE)
+    ]})),
+    # The same reads as ``multiplex``, as separate requests sent one after another
+    Scenario("multiplex_sequential", lambda i, state: [
+        ("GET", f"/documents/users/{_user(i * MULTIPLEX_SIZE + j)}", None) for j in range(MULTIPLEX_SIZE)
+    ]),
+    Scenario("read", lambda i, state: ("GET", f"/documents/users/{_user(i)}", None)),
+    Scenario("read_fields", lambda i, state: ("GET", f"/documents/users/{_user(i)}?fields=name,age", None)),
+    Scenario("update", lambda i, state: ("PUT", f"/documents/users/{_user(i)}", {"score": i})),
+    Scenario("update_representation", lambda i, state: (
+        "PUT", f"/documents/users/{_user(i)}?return=representation", {"score": i}
+    )),
+    Scenario("delete", lambda i, state: ("DELETE", f"/documents/deletable/d{i}", None)),
+    Scenario("counter_increment", lambda i, state: (
+        "POST", f"/documents/users/{_user(i)}/counters/visits:increment", {"by": 1}
+    )),
+    Scenario("counter_read", lambda i, state: ("GET", f"/documents/users/{_user(i)}/counters/visits", None)),
+    # Every request hits one counter, alternating increments and reads of its total
+    Scenario("counter_hot", lambda i, state: (
+        ("POST", f"{HOT_COUNTER}:increment", {"by": 1}) if i % 2 else ("GET", HOT_COUNTER, None)
+    )),
+]
+
+
+def seed_documents(deletable):
+    """Yield ``(path, data)`` for the benchmark dataset."""
+    for n in range(SEED_USERS):
+        yield f"users/u{n}", {
+            "name": f"user {n}",
+            "age": n % 90,
+            "team": "a" if n % 2 else "b",
+            "score": n * 3,
+            "tags": ["x", "y"] if n % 3 else ["z"],
+            "profile": {"city": f"city {n % 20}", "active": n % 5 != 0},
+        }
+        for f in range(SEED_FILES_PER_USER):
+            yield f"users/u{n}/files/f{f}", {"size": n * 10 + f, "kind": "pdf" if f else "png"}
+    for n in range(deletable):
+        yield f"deletable/d{n}", {"n": n}
+
+
+# --- Backends ---
+
+def fake_backend(latency, asynchronous):
+    """Return ``(db, sync_db, backend)`` for the in-memory fake.
+
+    ``sync_db`` is the synchronous client the async app uses for non-atomic
+    batch writes; None for the Flask app.
+    """
+    from fake_firestore import FakeFirestoreBackend, fake_client
+    backend = FakeFirestoreBackend(latency=latency)
+    sync_db = fake_client(backend) if asynchronous else None
+    return fake_client(backend, asynchronous=asynchronous), sync_db, backend
+
+
+def seed(backend, db, deletable):
+    if backend is not None:
+        for path, data in seed_documents(deletable):
+            backend.seed(path, data)
+        return
+    # Emulator: seed with the synchronous client in atomic batches
+    from google.cloud import firestore
+    sync_db = firestore.Client()
+    batch, size = sync_db.batch(), 0
+    for path, data in seed_documents(deletable):
+        batch.set(sync_db.document(path), data)
+        size += 1
+        if size == 500:
+            batch.commit()
+            batch, size = sync_db.batch(), 0
+    if size:
+        batch.commit()
+
+
+# --- Harnesses ---
+
+class FlaskHarness:
+    """Issues requests against the Flask app from a pool of threads, one test client per thread."""
+
+    def __init__(self, db):
+        from app import create_app
+        self.app = create_app()
+        if db is not None:
+            self.app.extensions["firestore_client"].db = db
+        self.watch_hub = self.app.extensions["watch_hub"]
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+        return self._local.client
+
+    def call(self, method, path, body, until=None, headers=None):
+        response = self._client().open(path, method=method, json=body, headers=headers)
+        if until is None:
+            return response.status_code, response.get_data(as_text=True)
+        text = ""
+        for chunk in response.iter_encoded():
+            text += chunk.decode()
+            if until in text:
+                break
+        response.close()
+        return response.status_code, text
+
+    def send(self, request, headers):
+        """Send a request, or a list of requests one after another; returns the highest status."""
+        if isinstance(request, list):
+            return max(self.send(r, headers) for r in request)
+        return self.call(*request, headers=headers)[0]
+
+    def run(self, requests, concurrency, headers):
+        def timed(request):
+            start = time.perf_counter()
+            status = self.send(request, headers)
+            return time.perf_counter() - start, status
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(timed, requests))
+
+    def sequential(self, requests, headers, each):
+        for request in requests:
+            each(lambda: self.send(request, headers))
+
+
+class AsgiHarness:
+    """Issues requests against the Quart app from one event loop, at most ``concurrency`` at a time."""
+
+    def __init__(self, db, sync_db=None):
+        from asgi import create_asgi_app
+        self.app = create_asgi_app()
+        if db is not None:
+            self.app.extensions["firestore_client"].db = db
+        self.watch_hub = self.app.extensions["watch_hub"]
+        if sync_db is not None:
+            self.app.extensions["firestore_client"].sync_db = sync_db
+            self.watch_hub.db_factory = lambda: sync_db
+        self.loop = asyncio.new_event_loop()
+
+    async def _call(self, method, path, body, until=None, headers=None):
+        client = self.app.test_client()
+        if until is None:
+            response = await client.open(path, method=method, json=body, headers=headers)
+            return response.status_code, await response.get_data(as_text=True)
+        text = ""
+        async with client.request(path, method=method, headers=headers) as connection:
+            await connection.send_complete()
+            while until not in text:
+                text += (await connection.receive()).decode()
+                if connection.status_code >= 400:
+                    break
+            await connection.disconnect()
+        return connection.status_code, text
+
+    def call(self, method, path, body, until=None, headers=None):
+        return self.loop.run_until_complete(self._call(method, path, body, until, headers))
+
+    async def _send(self, request, headers):
+        if isinstance(request, list):
+            return max([await self._send(r, headers) for r in request])
+        return (await self._call(*request, headers=headers))[0]
+
+    def run(self, requests, concurrency, headers):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def timed(request):
+            async with semaphore:
+                start = time.perf_counter()
+                status = await self._send(request, headers)
+                return time.perf_counter() - start, status
+
+        async def run_all():
+            return await asyncio.gather(*(timed(request) for request in requests))
+
+        return self.loop.run_until_complete(run_all())
+
+    def sequential(self, requests, headers, each):
+        for request in requests:
+            each(lambda: self.loop.run_until_complete(self._send(request, headers)))
+
+
+# --- Measurement ---
+
+Result = namedtuple("Result", ["scenario", "requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms", "alloc_kib"])
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    return values[max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))]
+
+
+def measure_allocations(harness, requests, headers):
+    """Mean peak memory (KiB) allocated while serving each request."""
+    peaks = []
+
+    def each(send):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        send()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+
+    tracemalloc.start()
+    try:
+        harness.sequential(requests, headers, each)
+    finally:
+        tracemalloc.stop()
+    return sum(peaks) / len(peaks) / 1024 if peaks else 0.0
+
+
+def run_scenario(harness, scenario, state, args, headers, counter, backend):
+    def batch(count):
+        start = counter[scenario.name]
+        counter[scenario.name] += count
+        return [scenario.build(i, state) for i in range(start, start + count)]
+
+    harness.run(batch(args.warmup), args.concurrency, headers)
+
+    start = time.perf_counter()
+    timings = harness.run(batch(args.requests), args.concurrency, headers)
+    elapsed = time.perf_counter() - start
+
+    # Allocations are measured without simulated latency, which only adds idle time
+    alloc_kib = 0.0
+    if args.alloc_requests:
+        latency = backend.latency if backend is not None else 0
+        if backend is not None:
+            backend.latency = 0
+        try:
+            alloc_kib = measure_allocations(harness, batch(args.alloc_requests), headers)
+        finally:
+            if backend is not None:
+                backend.latency = latency
+
+    latencies = sorted(t for t, _ in timings)
+    return Result(
+        scenario=scenario.name,
+        requests=len(timings),
+        errors=sum(1 for _, status in timings if status >= 400),
+        rps=len(timings) / elapsed if elapsed else 0.0,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p95_ms=percentile(latencies, 95) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        alloc_kib=alloc_kib,
+    )
+
+
+def run(args):
+    """Run the selected scenarios; returns a list of Result."""
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+    unknown = set(args.scenario or ()) - {s.name for s in SCENARIOS}
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    asynchronous = args.app == "asgi"
+    if args.backend == "emulator":
+        if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+            raise SystemExit("--backend emulator requires FIRESTORE_EMULATOR_HOST")
+        db, sync_db, backend = None, None, None
+    else:
+        # The app's own client is replaced before any request, so it never connects anywhere
+        os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:0")
+        os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "bench")
+        db, sync_db, backend = fake_backend(args.latency_ms / 1000, asynchronous)
+
+    harness = AsgiHarness(db, sync_db) if asynchronous else FlaskHarness(db)
+    if harness.watch_hub.max_streams:
+        # Up to ``concurrency`` watch requests are open at once
+        harness.watch_hub.max_streams = max(harness.watch_hub.max_streams, args.concurrency)
+    seed(backend, db, args.warmup + args.requests + args.alloc_requests)
+
+    from config import Config
+    headers = {"X-API-KEY": Config.ALL_API_KEYS[0]}
+    state = {}
+    if any(s.name == "query_page_token" for s in scenarios):
+        _, body = harness.call("GET", "/documents/users?order_by=age&limit=50", None, headers=headers)
+        state["page_token"] = json.loads(body)["next_page_token"]
+
+    counter = {s.name: 0 for s in scenarios}
+    return [run_scenario(harness, s, state, args, headers, counter, backend) for s in scenarios]
+
+
+# --- Startup ---
+
+StartupResult = namedtuple("StartupResult", ["import_ms", "create_app_ms", "first_response_ms", "process_ms"])
+STARTUP_PATH = "/documents/users?limit=1"
+
+
+def startup_probe(args):
+    """Measure one cold start of this (fresh) process and print it as JSON.
+
+    With the fake backend the in-memory client is swapped in after the app is
+    built, so ``first_response_ms`` is the first request on a warm client; with
+    the emulator it includes creating the Firestore client and its channel.
+    """
+    if args.backend == "fake":
+        os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:0")
+        os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "bench")
+    start = time.perf_counter()
+    if args.app == "asgi":
+        from asgi import create_asgi_app as factory
+    else:
+        from app import create_app as factory
+    imported = time.perf_counter()
+    app = factory()
+    created = time.perf_counter()
+
+    if args.backend == "fake":
+        db, _, backend = fake_backend(args.latency_ms / 1000, args.app == "asgi")
+        backend.seed("users/u0", {"name": "user 0"})
+        app.extensions["firestore_client"].db = db
+    from config import Config
+    headers = {"X-API-KEY": Config.ALL_API_KEYS[0]}
+
+    ready = time.perf_counter()
+    if args.app == "asgi":
+        async def first():
+            return (await app.test_client().get(STARTUP_PATH, headers=headers)).status_code
+        status = asyncio.run(first())
+    else:
+        status = app.test_client().get(STARTUP_PATH, headers=headers).status_code
+    served = time.perf_counter()
+    if status != 200:
+        raise SystemExit(f"First request failed with status {status}")
+    print(json.dumps({
+        "import_ms": (imported - start) * 1000,
+        "create_app_ms": (created - imported) * 1000,
+        "first_response_ms": (served - ready) * 1000,
+    }))
+
+
+def run_startup(args):
+    """Run ``args.startup`` cold starts, each in a new interpreter; returns a list of StartupResult.
+
+    ``process_ms`` is the wall time of the whole process, interpreter start-up included.
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--startup-probe", "--app", args.app,
+               "--backend", args.backend, "--latency-ms", str(args.latency_ms)]
+    results = []
+    for _ in range(args.startup):
+        start = time.perf_counter()
+        probe = subprocess.run(command, capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        if probe.returncode:
+            raise SystemExit(f"Startup probe failed:\n{probe.stderr}")
+        results.append(StartupResult(**json.loads(probe.stdout.splitlines()[-1]), process_ms=elapsed * 1000))
+    return results
+
+
+# --- Reporting ---
+
+def report(results, baseline=None):
+    header = f"{'scenario':<24}{'reqs':>6}{'errs':>6}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'KiB/req':>9}"
+    if baseline:
+        header += f"{'Δ req/s':>10}{'Δ p99':>9}"
+    lines = [header, "-" * len(header)]
+    for r in results:
+        line = (f"{r.scenario:<24}{r.requests:>6}{r.errors:>6}{r.rps:>10.1f}"
+                f"{r.p50_ms:>9.2f}{r.p95_ms:>9.2f}{r.p99_ms:>9.2f}{r.alloc_kib:>9.1f}")
+        before = (baseline or {}).get(r.scenario)
+        if before:
+            line += f"{_change(before['rps'], r.rps):>10}{_change(before['p99_ms'], r.p99_ms):>9}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def report_startup(results, baseline=None):
+    header = f"{'startup':<24}{'runs':>6}{'mean ms':>10}{'p50 ms':>9}{'min ms':>9}{'max ms':>9}"
+    if baseline:
+        header += f"{'Δ mean':>9}"
+    lines = [header, "-" * len(header)]
+    for metric in StartupResult._fields:
+        values = sorted(getattr(r, metric) for r in results)
+        mean = sum(values) / len(values)
+        line = (f"{metric:<24}{len(values):>6}{mean:>10.1f}{percentile(values, 50):>9.1f}"
+                f"{values[0]:>9.1f}{values[-1]:>9.1f}")
+        if baseline:
+            before = [r[metric] for r in baseline]
+            line += f"{_change(sum(before) / len(before), mean):>9}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _change(before, after):
+    return f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", choices=("flask", "asgi"), default="flask")
+    parser.add_argument("--backend", choices=("fake", "emulator"), default="fake")
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="simulated latency per RPC (fake backend)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests per scenario")
+    parser.add_argument("--alloc-requests", type=int, default=20, help="sequential requests traced for allocations")
+    parser.add_argument("--scenario", action="append", help="run only this scenario (repeatable)")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare against results saved with --output")
+    parser.add_argument("--startup", type=int, metavar="N", help="measure N cold starts instead of the scenarios")
+    parser.add_argument("--startup-probe", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.disable(logging.INFO)
+    if args.startup_probe:
+        startup_probe(args)
+        return 0
+    if args.startup:
+        return main_startup(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+
+    results = run(args)
+    print(f"app={args.app} backend={args.backend} latency={args.latency_ms}ms concurrency={args.concurrency}")
+    print(report(results, baseline))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": [r._asdict() for r in results]}, f, indent=2)
+    return 1 if any(r.errors for r in results) else 0
+
+
+def main_startup(args):
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f).get("startup")
+
+    results = run_startup(args)
+    print(f"app={args.app} backend={args.backend} latency={args.latency_ms}ms runs={args.startup}")
+    print(report_startup(results, baseline))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "startup": [r._asdict() for r in results]}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -27,6 +27,88 @@ class Config:
     DEBUG = os.getenv("DEBUG", "False").lower() == "true"
     PORT = int(os.getenv("PORT", 8080))
 
+    # Upper bound for ?limit when a query is streamed as NDJSON
+    STREAM_MAX_LIMIT = int(os.getenv("STREAM_MAX_LIMIT", 50000))
+
+    # Upper bound for operations accepted by a single :batch request
+    BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", 10000))
+
+    # Response JSON encoder: "auto" (orjson when installed), "orjson" or "json"
+    JSON_ENCODER = os.getenv("JSON_ENCODER", "auto").lower()
+
+    # gzip/br compression for JSON responses of at least COMPRESSION_MIN_SIZE bytes
+    COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "True").lower() == "true"
+    COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+
+    # POST /batch: sub-requests per call, and how many run at once (threads shared by all calls
+    # in the Flask app; per call in async mode)
+    MULTIPLEX_MAX_REQUESTS = int(os.getenv("MULTIPLEX_MAX_REQUESTS", 50))
+    MULTIPLEX_CONCURRENCY = int(os.getenv("MULTIPLEX_CONCURRENCY", 16))
+
+    # --- Deadlines, retries and admission control ---
+    # Seconds a request may spend on Firestore when it sends no X-Request-Deadline, and the cap for that header
+    RPC_DEADLINE = float(os.getenv("RPC_DEADLINE", 10))
+    RPC_MAX_DEADLINE = float(os.getenv("RPC_MAX_DEADLINE", 60))
+    # Jittered exponential backoff between retries of reads and precondition-guarded writes
+    RPC_RETRY_INITIAL = float(os.getenv("RPC_RETRY_INITIAL", 0.1))
+    RPC_RETRY_MAXIMUM = float(os.getenv("RPC_RETRY_MAXIMUM", 2))
+    # Requests in flight per API key (over the limit: 429) and per collection (503) in each process; 0 disables
+    CONCURRENCY_PER_API_KEY = int(os.getenv("CONCURRENCY_PER_API_KEY", 64))
+    CONCURRENCY_PER_COLLECTION = int(os.getenv("CONCURRENCY_PER_COLLECTION", 128))
+    # Retry-After seconds sent with shed (429/503) responses
+    RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", 1))
+
+    # Share one Firestore call between concurrent identical document reads and queries
+    COALESCE_READS = os.getenv("COALESCE_READS", "False").lower() == "true"
+
+    # --- Sharded counters (/documents/<collection>/<doc_id>/counters/<counter>) ---
+    # Shards per counter; more shards sustain more increments per second
+    COUNTER_SHARDS = int(os.getenv("COUNTER_SHARDS", 10))
+    # Per-counter overrides keyed by collection and counter name, e.g. "mailboxes/unread=50,users/visits=20"
+    COUNTER_SHARD_COUNTS = {
+        name.strip(): int(shards)
+        for name, _, shards in (item.partition("=") for item in os.getenv("COUNTER_SHARD_COUNTS", "").split(","))
+        if name.strip() and shards.strip()
+    }
+    # Seconds a counter total is served from memory before the shards are summed again (0 disables)
+    COUNTER_CACHE_TTL = float(os.getenv("COUNTER_CACHE_TTL", 1.0))
+
+    # --- Startup ---
+    # Open the Firestore channel in the background as soon as the app (or worker) starts
+    FIRESTORE_PREWARM = os.getenv("FIRESTORE_PREWARM", "False").lower() == "true"
+    # Seconds GET /warmup waits for the Firestore channel to connect
+    WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", 10))
+    # gunicorn worker processes and threads per worker (see gunicorn.conf.py)
+    WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 2))
+    GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", 8))
+
+    # --- Change feeds (GET /documents/<collection>:watch) ---
+    # Seconds between SSE heartbeat comments on an idle stream
+    WATCH_HEARTBEAT_SECONDS = float(os.getenv("WATCH_HEARTBEAT_SECONDS", 15))
+    # Events kept per listener for resuming with Last-Event-ID
+    WATCH_REPLAY_SIZE = int(os.getenv("WATCH_REPLAY_SIZE", 1000))
+    # Events buffered per subscriber before it is resynchronized with a reset
+    WATCH_QUEUE_SIZE = int(os.getenv("WATCH_QUEUE_SIZE", 1000))
+    # Seconds a listener is kept after its last subscriber leaves
+    WATCH_LINGER_SECONDS = float(os.getenv("WATCH_LINGER_SECONDS", 60))
+    # Open streams per process before further watches get a 503 (0 for no limit); under
+    # Flask each stream holds a worker thread, so the default leaves half of them for requests
+    WATCH_MAX_STREAMS = int(os.getenv("WATCH_MAX_STREAMS", max(GUNICORN_THREADS // 2, 1)))
+
+    # --- Document cache ---
+    # In-process read-through cache for GET /documents/<collection>/<doc_id>.
+    CACHE_ENABLED = os.getenv("CACHE_ENABLED", "False").lower() == "true"
+    CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 10000))
+    CACHE_DEFAULT_TTL = float(os.getenv("CACHE_DEFAULT_TTL", 30))
+    # Per-collection TTLs in seconds, e.g. "config=300,lookups=60" (0 disables caching)
+    CACHE_COLLECTION_TTLS = {
+        name.strip(): float(ttl)
+        for name, _, ttl in (item.partition("=") for item in os.getenv("CACHE_COLLECTION_TTLS", "").split(","))
+        if name.strip() and ttl.strip()
+    }
+    # Collections kept coherent with snapshot listeners, e.g. "config,lookups"
+    CACHE_WATCH_COLLECTIONS = [c.strip() for c in os.getenv("CACHE_WATCH_COLLECTIONS", "").split(",") if c.strip()]
+
 def validate_config():
     """Basic validation to ensure at least one key is set."""
     if not Config.ALL_API_KEYS:
@@ -1,13 +1,49 @@
-from google.cloud import firestore, secretmanager
-from google.api_core.exceptions import InvalidArgument, NotFound as GoogleNotFound
-from flask import jsonify, current_app, request
-from functools import wraps
+from google.cloud import firestore
+from google.cloud.firestore_v1.bulk_batch import BulkWriteBatch
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+from google.cloud.firestore_v1.base_query import And, FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.cloud.firestore_v1.base_document import BaseDocumentReference
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.api_core.exceptions import (
+    Aborted, DeadlineExceeded, FailedPrecondition, GoogleAPICallError, InternalServerError, InvalidArgument,
+    NotFound as GoogleNotFound, ResourceExhausted, RetryError, ServiceUnavailable, from_grpc_status
+)
+from google.api_core.retry import AsyncRetry, Retry, if_exception_type
+import grpc
+from flask import current_app, request
+from flask.json.provider import DefaultJSONProvider
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from abc import ABC, abstractmethod
+from functools import lru_cache, wraps
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import asyncio
+import base64
+import gzip
+import hashlib
+import math
 import os
-import sys
+import queue
+import random
+import re
 import json
 import logging
+import threading
 import time
 
+try:
+    import orjson
+except ImportError:  # optional: responses fall back to the standard library encoder
+    orjson = None
+try:
+    import brotli
+except ImportError:  # optional: only gzip is offered
+    brotli = None
+
 # --- Logging Configuration (from utils/logging.py) ---
 
 def configure_logging():
@@ -17,30 +53,205 @@ def configure_logging():
         handlers=[logging.StreamHandler()],
     )
 
+# --- Request Timing and Metrics ---
+
+class RequestTimer:
+    """Accumulates the time spent in each phase of one request.
+
+    Phases are ``auth``, ``filter``, ``rpc`` (Firestore reads and writes),
+    ``count`` (count aggregations) and ``serialize``. ``adapter`` is the rest
+    of the request: total time minus Firestore time.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations = {}
+        # Set once the API key is checked; see ``authorize_request_metrics``
+        self.authorized = False
+
+    def add(self, phase, seconds):
+        self.durations[phase] = self.durations.get(phase, 0.0) + seconds
+
+    def phases(self):
+        """Return ``{phase: seconds}`` including ``adapter`` and ``total``."""
+        total = time.perf_counter() - self.start
+        phases = dict(self.durations)
+        firestore_time = phases.get("rpc", 0.0) + phases.get("count", 0.0)
+        phases["adapter"] = max(total - firestore_time, 0.0)
+        phases["total"] = total
+        return phases
+
+    @staticmethod
+    def server_timing(phases):
+        return ", ".join(f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in phases.items())
+
+
+_request_timer = ContextVar("request_timer", default=None)
+
+@contextmanager
+def timing(phase):
+    """Time a block as ``phase`` of the current request; a no-op outside a timed request."""
+    timer = _request_timer.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(phase, time.perf_counter() - start)
+
+def timed(phase):
+    """Decorator form of ``timing``."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with timing(phase):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+REQUEST_LABELS = ("route", "method", "collection")
+REQUEST_DURATION = Histogram(
+    "fs_adapter_request_duration_seconds", "Time to handle a request", REQUEST_LABELS
+)
+PHASE_DURATION = Histogram(
+    "fs_adapter_request_phase_duration_seconds", "Time spent in each phase of a request", REQUEST_LABELS + ("phase",)
+)
+REQUESTS = Counter("fs_adapter_requests_total", "Requests handled", REQUEST_LABELS + ("status",))
+
+def start_request_timer():
+    _request_timer.set(RequestTimer())
+
+def authorize_request_metrics():
+    """Label the current request's metrics with its collection.
+
+    Called once the API key is accepted; other requests are recorded under
+    ``collection="unknown"`` so unauthenticated clients cannot create new
+    metric series by requesting arbitrary collection names.
+    """
+    timer = _request_timer.get()
+    if timer is not None:
+        timer.authorized = True
+
+def finish_request_timer(response, rule, method, view_args):
+    """Add the Server-Timing header to ``response`` and record the request's metrics."""
+    timer = _request_timer.get()
+    if timer is None:
+        return response
+    _request_timer.set(None)
+    phases = timer.phases()
+    response.headers["Server-Timing"] = RequestTimer.server_timing(phases)
+    if rule is None:
+        return response
+    collection = (view_args or {}).get("collection", "")
+    labels = (rule.rule, method, collection if timer.authorized or not collection else "unknown")
+    REQUEST_DURATION.labels(*labels).observe(phases.pop("total"))
+    for phase, seconds in phases.items():
+        PHASE_DURATION.labels(*labels, phase).observe(seconds)
+    REQUESTS.labels(*labels, str(response.status_code)).inc()
+    return response
+
+def end_request_timer(response, req):
+    """``finish_request_timer`` for ``req``, the current request of either app."""
+    return finish_request_timer(response, req.url_rule, req.method, req.view_args)
+
+def register_instrumentation(app):
+    """Time every request of a Flask app; see ``RequestTimer``."""
+    app.before_request(start_request_timer)
+    app.after_request(lambda response: end_request_timer(response, request))
+
+def metrics_exposition():
+    """Return ``(body, content_type)`` for the Prometheus ``/metrics`` endpoint."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+def encode_firestore_value(obj):
+    """JSON ``default`` hook for Firestore value types.
+
+    Timestamps become RFC 3339 strings (keeping nanoseconds), geo points
+    ``{"latitude", "longitude"}``, references their document path and bytes
+    base64. Anything else falls back to Flask's encoder.
+    """
+    if isinstance(obj, DatetimeWithNanoseconds):
+        return obj.rfc3339()
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, firestore.GeoPoint):
+        return {"latitude": obj.latitude, "longitude": obj.longitude}
+    if isinstance(obj, BaseDocumentReference):
+        return obj.path
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode("ascii")
+    return DefaultJSONProvider.default(obj)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON provider for Firestore values that records serialization time (also used by the Quart app).
+
+    ``encoder`` is ``"orjson"`` or ``"json"`` (the standard library); ``"auto"``
+    picks orjson when it is installed. Indented output always uses the
+    standard library encoder.
+    """
+    ENCODERS = ("auto", "orjson", "json")
+
+    default = staticmethod(encode_firestore_value)
+
+    def __init__(self, app, encoder="auto"):
+        super().__init__(app)
+        if encoder not in self.ENCODERS:
+            raise ValueError(f"Unknown JSON encoder {encoder!r}, expected one of {', '.join(self.ENCODERS)}")
+        if encoder == "orjson" and orjson is None:
+            logging.warning("JSON_ENCODER=orjson but orjson is not installed; using the standard library encoder")
+        self.encoder = "orjson" if encoder != "json" and orjson is not None else "json"
+
+    def _orjson_dumps(self, obj):
+        options = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+        return orjson.dumps(obj, default=encode_firestore_value, option=options)
+
+    def dumps(self, obj, **kwargs):
+        with timing("serialize"):
+            if self.encoder == "orjson" and "indent" not in kwargs:
+                return self._orjson_dumps(obj).decode("utf-8")
+            return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        pretty = (self.compact is None and self._app.debug) or self.compact is False
+        if self.encoder != "orjson" or pretty:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        # Encode straight to bytes, skipping the str round trip of dumps()
+        with timing("serialize"):
+            body = self._orjson_dumps(obj) + b"\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 # --- Error Handling (from utils/errors.py) ---
 
 class AppError(Exception):
-    def __init__(self, message, status_code=500):
+    def __init__(self, message, status_code=500, headers=None):
         super().__init__(message)
         self.status_code = status_code
         self.message = message
+        self.headers = headers or {}
+
+# Handlers and the API key check return plain dicts so they work unchanged
+# under both the Flask app and the Quart (ASGI) app.
 
 def handle_app_error(error):
     response = {"status": "error", "message": error.message}
-    return jsonify(response), error.status_code
+    return response, error.status_code, error.headers
 
 def handle_generic_error(error):
     logging.exception("An unexpected error occurred")
     response = {"status": "error", "message": "Internal Server Error"}
-    return jsonify(response), 500
+    return response, 500
 
 def handle_not_found(error):
     response = {"status": "error", "message": "The requested URL was not found."}
-    return jsonify(response), 404
+    return response, 404
 
 def handle_google_not_found(error):
     """Handle Google's specific NotFound error."""
-    return jsonify({"status": "error", "message": str(error)}), 404
+    return {"status": "error", "message": str(error)}, 404
     
 def register_error_handlers(app):
     app.register_error_handler(AppError, handle_app_error)
@@ -50,120 +261,2897 @@ def register_error_handlers(app):
 
 # --- API Key Authentication (simplified) ---
 
+UNAUTHORIZED = ({"status": "error", "message": "Unauthorized"}, 401)
+# WSGI environ / ASGI scope key set on the sub-requests of an already authenticated POST /batch
+PRE_AUTHENTICATED = "fs_adapter.pre_authenticated"
+
+def api_key_valid(config, headers):
+    with timing("auth"):
+        # Keys are now loaded directly from the app's config
+        valid_keys = config.get("ALL_API_KEYS", [])
+        auth_header = headers.get("X-API-KEY")
+        return bool(auth_header) and auth_header in valid_keys
+
+def admit(app, headers, batched, collection):
+    """Check a request's API key and return its ``AdmissionControl`` slot, or None when the key is refused.
+
+    ``batched`` marks the sub-requests of an already authenticated POST
+    /batch, which skip the check and the per-key limit.
+    """
+    if not batched and not api_key_valid(app.config, headers):
+        return None
+    authorize_request_metrics()
+    return app.extensions["admission"].admit(None if batched else headers.get("X-API-KEY"), collection)
+
 def require_api_key(f):
+    """Check the API key, then admit the request under the app's ``AdmissionControl`` limits."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Keys are now loaded directly from the app's config
-        valid_keys = current_app.config.get("ALL_API_KEYS", [])
-        auth_header = request.headers.get("X-API-KEY")
-        
-        if not auth_header or auth_header not in valid_keys:
-            return jsonify({"status": "error", "message": "Unauthorized"}), 401
-        return f(*args, **kwargs)
+        slot = admit(current_app, request.headers, request.environ.get(PRE_AUTHENTICATED), kwargs.get("collection"))
+        if slot is None:
+            return UNAUTHORIZED
+        with slot:
+            return f(*args, **kwargs)
     return decorated_function
 
+# --- Deadlines, Retries and Admission Control ---
+
+_request_deadline = ContextVar("request_deadline", default=None)
+
+class RequestDeadline:
+    """The time budget of the current request.
+
+    ``X-Request-Deadline`` is the number of seconds the caller is willing to
+    wait; without it ``RPC_DEADLINE`` applies, and both are capped at
+    ``RPC_MAX_DEADLINE``. Every Firestore RPC of the request gets the time
+    that is left as its timeout.
+    """
+    HEADER = "X-Request-Deadline"
+
+    @classmethod
+    def start(cls, headers, config):
+        budget = config["RPC_DEADLINE"]
+        value = headers.get(cls.HEADER)
+        if value:
+            try:
+                budget = float(value)
+            except ValueError:
+                budget = 0.0
+            if not budget > 0:
+                raise AppError(f"{cls.HEADER} must be a positive number of seconds", 400)
+        _request_deadline.set(time.monotonic() + min(budget, config["RPC_MAX_DEADLINE"]))
+
+    @staticmethod
+    def clear(*_):
+        _request_deadline.set(None)
+
+    @staticmethod
+    def remaining():
+        """Seconds left for the current request, or None outside a request."""
+        deadline = _request_deadline.get()
+        return None if deadline is None else deadline - time.monotonic()
+
+    @classmethod
+    def propagate(cls, headers):
+        """Give ``headers`` (of a sub-request) the current request's remaining budget unless they set their own."""
+        remaining = cls.remaining()
+        if remaining is None or any(name.lower() == cls.HEADER.lower() for name in headers):
+            return headers
+        return {**headers, cls.HEADER: f"{max(remaining, 0.001):.3f}"}
+
+
+def register_deadlines(app):
+    """Start each request's deadline from its headers; see ``RequestDeadline``."""
+    app.before_request(lambda: RequestDeadline.start(request.headers, current_app.config))
+    app.teardown_request(RequestDeadline.clear)
+
+
+class RpcPolicy:
+    """``retry`` and ``timeout`` arguments for Firestore RPCs.
+
+    The timeout is the request's remaining deadline (``deadline`` seconds
+    outside a request). Reads are retried, and so are writes guarded by a
+    precondition, since a replay of those fails instead of applying twice.
+    Retries use truncated exponential backoff with full jitter and only
+    happen on the transient errors in ``RETRYABLE``. Other writes are sent
+    once: ``retry=None`` also turns off the client library's own retries.
+    """
+    RETRYABLE = (Aborted, InternalServerError, ResourceExhausted, ServiceUnavailable)
+
+    def __init__(self, deadline=10.0, initial_backoff=0.1, max_backoff=2.0, multiplier=2.0, retry_after=1):
+        self.deadline = deadline
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.retry_after = retry_after
+
+    def kwargs(self, retry_class, idempotent=True):
+        remaining = RequestDeadline.remaining()
+        timeout = self.deadline if remaining is None else remaining
+        if timeout <= 0:
+            raise AppError("Request deadline exceeded", 504)
+        retry = None
+        if idempotent:
+            retry = retry_class(
+                predicate=if_exception_type(*self.RETRYABLE), initial=self.initial_backoff,
+                maximum=self.max_backoff, multiplier=self.multiplier, timeout=timeout
+            )
+        return {"retry": retry, "timeout": timeout}
+
+    def error(self, error, message):
+        """The AppError for a failed RPC: 504 past the deadline, 503 while Firestore is overloaded."""
+        if isinstance(error, AppError):
+            return error
+        if isinstance(error, (DeadlineExceeded, RetryError)):
+            return AppError("Firestore did not respond within the request deadline", 504)
+        if isinstance(error, self.RETRYABLE):
+            return AppError("Firestore is temporarily unavailable", 503, {"Retry-After": str(self.retry_after)})
+        return AppError(message)
+
+
+SHED_REQUESTS = Counter("fs_adapter_shed_requests_total", "Requests rejected by admission control", ("limit",))
+
+class ConcurrencyLimiter:
+    """Caps the requests in flight per key (an API key or a collection).
+
+    A request over the limit is rejected at once, with a Retry-After header,
+    rather than queued: when Firestore slows down, excess load turns into
+    fast errors instead of a growing backlog of blocked threads or tasks.
+    A limit of 0 disables the check.
+    """
+
+    def __init__(self, name, limit, status_code, message, retry_after=1):
+        self.name = name
+        self.limit = limit
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+        self.shed = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        with self._lock:
+            in_flight = self._in_flight.get(key, 0)
+            if in_flight >= self.limit:
+                self.shed += 1
+                SHED_REQUESTS.labels(self.name).inc()
+                raise AppError(self.message, self.status_code, {"Retry-After": str(self.retry_after)})
+            self._in_flight[key] = in_flight + 1
+
+    def release(self, key):
+        with self._lock:
+            in_flight = self._in_flight.pop(key) - 1
+            if in_flight:
+                self._in_flight[key] = in_flight
+
+    @contextmanager
+    def slot(self, key):
+        if not self.limit or key is None:
+            yield
+            return
+        self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def stats(self):
+        with self._lock:
+            return {"limit": self.limit, "in_flight": sum(self._in_flight.values()), "shed": self.shed}
+
+
+class AdmissionControl:
+    """Concurrency limits per API key (429) and per collection (503) applied by ``require_api_key``.
+
+    Sub-requests of POST /batch only count against their collection; the
+    batch itself holds the API key's slot.
+    """
+
+    def __init__(self, per_api_key=0, per_collection=0, retry_after=1):
+        self.api_keys = ConcurrencyLimiter(
+            "api_key", per_api_key, 429, "Too many concurrent requests for this API key", retry_after
+        )
+        self.collections = ConcurrencyLimiter(
+            "collection", per_collection, 503, "Too many concurrent requests for this collection", retry_after
+        )
+
+    @contextmanager
+    def admit(self, api_key, collection):
+        with self.api_keys.slot(api_key), self.collections.slot(collection):
+            yield
+
+    def stats(self):
+        return {"api_keys": self.api_keys.stats(), "collections": self.collections.stats()}
+
+# --- Document Cache ---
+
+class DocumentCache:
+    """Bounded in-process read-through cache for single documents.
+
+    Entries are keyed by (collection, doc_id), expire after a per-collection
+    TTL and are evicted least-recently-used once ``max_entries`` is reached.
+    Missing documents are cached too, so repeated 404s are also served
+    locally. All methods are thread-safe.
+
+    A read takes a ``generation()`` before it starts and passes it to
+    ``put``; a document invalidated since then is not cached, so a read that
+    raced a write cannot store the value the write replaced.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, max_entries=1024, default_ttl=60.0, collection_ttls=None):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.collection_ttls = dict(collection_ttls or {})
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._watches = {}
+        # ``(db_factory, collections)`` to watch once the cache is first used
+        self._pending_watches = None
+        self._watch_lock = threading.Lock()
+        # Generation of the latest invalidation per key, bounded like the entries;
+        # ``_forgotten`` is the newest generation dropped from it
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        self._forgotten = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def ttl(self, collection):
+        return self.collection_ttls.get(collection, self.default_ttl)
+
+    def get(self, collection, doc_id):
+        """Return ``(hit, document)``; ``document`` is None for a cached miss."""
+        hit, document, _ = self.get_versioned(collection, doc_id)
+        return hit, document
+
+    def get_versioned(self, collection, doc_id):
+        """Return ``(hit, document, update_time)``."""
+        if self._pending_watches is not None:
+            self._start_pending_watches()
+        key = (collection, doc_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None, None
+            value, update_time, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return False, None, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return True, (None if value is self._MISSING else dict(value)), update_time
+
+    def generation(self):
+        """The token for a read that starts now; see ``put``."""
+        with self._lock:
+            return self._generation
+
+    def put(self, collection, doc_id, document, update_time=None, generation=None):
+        """Cache a document read; skipped if it was invalidated after ``generation`` was taken."""
+        ttl = self.ttl(collection)
+        if ttl <= 0:
+            return
+        key = (collection, doc_id)
+        value = self._MISSING if document is None else dict(document)
+        with self._lock:
+            if generation is not None and max(self._invalidated.get(key, 0), self._forgotten) > generation:
+                self.stale_puts += 1
+                return
+            self._entries[key] = (value, update_time, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, collection, doc_id):
+        key = (collection, doc_id)
+        with self._lock:
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.max_entries:
+                self._forgotten = self._invalidated.popitem(last=False)[1]
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def watch(self, db, collection):
+        """Keep ``collection`` coherent with an ``on_snapshot`` listener.
+
+        Every change reported by the listener invalidates the matching entry,
+        so updates made outside this instance are picked up within the
+        listener's latency rather than the TTL. Intended for small, allow-listed
+        collections, as the listener's initial snapshot reads the whole collection.
+        """
+        def on_snapshot(docs, changes, read_time):
+            for change in changes:
+                self.invalidate(collection, change.document.id)
+
+        if collection not in self._watches:
+            self._watches[collection] = db.collection(collection).on_snapshot(on_snapshot)
+            logging.info("Watching collection %s for cache invalidation", collection)
+
+    def watch_on_first_use(self, db_factory, collections):
+        """Watch ``collections`` from the first lookup on, using the client ``db_factory()`` returns.
+
+        Lets the app factory configure watches without creating the Firestore
+        client, which would otherwise happen in the master process of a
+        pre-fork server.
+        """
+        self._pending_watches = (db_factory, list(collections)) if collections else None
+
+    def _start_pending_watches(self):
+        with self._watch_lock:
+            if self._pending_watches is None:
+                return
+            db_factory, collections = self._pending_watches
+            try:
+                db = db_factory()
+                for collection in collections:
+                    self.watch(db, collection)
+            except Exception as e:
+                # Entries still expire by TTL; the next lookup tries again
+                logging.warning("Failed to start cache watches: %s", e)
+                return
+            self._pending_watches = None
+
+    def close(self):
+        self._pending_watches = None
+        for watch in self._watches.values():
+            watch.unsubscribe()
+        self._watches.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "stale_puts": self.stale_puts,
+                "watched_collections": sorted(self._watches),
+            }
+
+# --- Request Coalescing ---
+
+class SingleFlight:
+    """Coalesces concurrent identical calls into one (thread-safe).
+
+    While a call for ``key`` is running, identical calls wait for it and share
+    its result or exception instead of issuing their own RPC; a caller stops
+    waiting with a 504 once its own request deadline has passed. Nothing is kept
+    once the call returns, so unlike the document cache this never serves
+    stale data. Shared results must be treated as read-only.
+    """
+
+    class _Call:
+        __slots__ = ("done", "result", "error")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            # Waiting on another request's RPC still counts as RPC time
+            with timing("rpc"):
+                finished = call.done.wait(self._budget())
+            if not finished:
+                raise AppError("Request deadline exceeded", 504)
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    @staticmethod
+    def _budget():
+        """How long a follower may wait: the request's remaining time, or indefinitely outside a request."""
+        remaining = RequestDeadline.remaining()
+        return None if remaining is None else max(remaining, 0)
+
+    def forget(self, prefix):
+        """Make later calls whose key starts with ``prefix`` start a new flight.
+
+        Used after writes, so that a read issued after a write completed never
+        shares the result of a read that started before it.
+        """
+        with self._lock:
+            for key in [key for key in self._calls if key[:len(prefix)] == prefix]:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "executions": self.executions, "coalesced": self.coalesced}
+
+
+class AsyncSingleFlight(SingleFlight):
+    """asyncio counterpart of SingleFlight for one event loop.
+
+    The shared call runs as a task, so a caller that is cancelled does not
+    cancel the call for the others.
+    """
+
+    async def do(self, key, fn, *args):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda _: self._calls.get(key) is task and self._calls.pop(key))
+            self.executions += 1
+            return await asyncio.shield(task)
+        self.coalesced += 1
+        with timing("rpc"):
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), self._budget())
+            except asyncio.TimeoutError:
+                raise AppError("Request deadline exceeded", 504)
+
+
+def flight_key(*parts):
+    """Build a hashable single-flight key; lists (``in`` filters, projections) become tuples."""
+    return tuple(flight_key(*part) if isinstance(part, (list, tuple)) else part for part in parts)
+
+
+# --- Field Transforms ---
+
+class FieldTransforms:
+    """Server-side field transforms written inline in JSON write bodies.
+
+    A single-key object whose key is one of the transform names is replaced by
+    the matching Firestore sentinel, at any depth of nested maps:
+
+        {"views": {"$increment": 1}, "tags": {"$arrayUnion": ["a"]},
+         "seen_at": {"$serverTimestamp": true}, "draft": {"$delete": true}}
+
+    Any other object, including ones with other ``$`` keys, is a plain map.
+    Transforms are applied atomically by Firestore in the same write, so
+    counters and arrays need no read-modify-write round trip.
+    """
+
+    NUMERIC = {"$increment": firestore.Increment, "$maximum": firestore.Maximum, "$minimum": firestore.Minimum}
+    ARRAY = {"$arrayUnion": firestore.ArrayUnion, "$arrayRemove": firestore.ArrayRemove}
+    FLAGS = {"$serverTimestamp": firestore.SERVER_TIMESTAMP, "$delete": firestore.DELETE_FIELD}
+    NAMES = frozenset(NUMERIC) | frozenset(ARRAY) | frozenset(FLAGS)
+
+    @classmethod
+    def resolve(cls, data, delete=False):
+        """Return ``data`` with transform objects replaced by sentinels; ``data`` itself when there are none.
+
+        ``$delete`` is only valid where the write merges into an existing
+        document (update and ``set(merge=True)``), so it must be allowed with
+        ``delete``.
+        """
+        if not isinstance(data, dict):
+            raise AppError("Document data must be a JSON object", 400)
+        return cls._map(data, delete, ())
+
+    @classmethod
+    def echo(cls, data, resolved):
+        """``data`` for a write response: without the fields that hold transforms.
+
+        Only Firestore knows a transform's result, so echoing the request's
+        transform object would misreport the value. ``resolved`` is the
+        output of ``resolve``; when it is ``data`` there is nothing to strip.
+        """
+        return data if resolved is data else cls._strip(data)
+
+    @classmethod
+    def _strip(cls, data):
+        return {
+            key: cls._strip(value) if isinstance(value, dict) else value
+            for key, value in data.items() if cls._transform(value) is None
+        }
+
+    @classmethod
+    def _transform(cls, value):
+        """The ``(name, operand)`` of a transform object, or None."""
+        if isinstance(value, dict) and len(value) == 1:
+            (name, operand), = value.items()
+            if name in cls.NAMES:
+                return name, operand
+        return None
+
+    @classmethod
+    def _map(cls, data, delete, path):
+        resolved = data
+        for key, value in data.items():
+            new = cls._value(value, delete, path + (key,))
+            if new is not value:
+                if resolved is data:
+                    resolved = dict(data)
+                resolved[key] = new
+        return resolved
+
+    @classmethod
+    def _value(cls, value, delete, path):
+        if isinstance(value, dict):
+            transform = cls._transform(value)
+            if transform is not None:
+                return cls._sentinel(*transform, delete, ".".join(path))
+            return cls._map(value, delete, path)
+        if isinstance(value, list):
+            cls._check_array(value, ".".join(path))
+        return value
+
+    @classmethod
+    def _check_array(cls, values, field):
+        for value in values:
+            if cls._transform(value) is not None:
+                raise AppError(f"{field}: field transforms are not allowed inside arrays", 400)
+            if isinstance(value, list):
+                cls._check_array(value, field)
+            elif isinstance(value, dict):
+                cls._check_array(value.values(), field)
+
+    @classmethod
+    def _sentinel(cls, name, operand, delete, field):
+        if name in cls.NUMERIC:
+            if isinstance(operand, bool) or not isinstance(operand, (int, float)):
+                raise AppError(f"{field}: {name} takes a number", 400)
+            return cls.NUMERIC[name](operand)
+        if name in cls.ARRAY:
+            if not isinstance(operand, list):
+                raise AppError(f"{field}: {name} takes a list", 400)
+            cls._check_array(operand, field)
+            return cls.ARRAY[name](operand)
+        if operand is not True:
+            raise AppError(f"{field}: {name} takes true", 400)
+        if name == "$delete" and not delete:
+            raise AppError(f"{field}: $delete is only allowed in updates and merges", 400)
+        return cls.FLAGS[name]
+
+
+# --- Sharded Counters ---
+
+class ShardedCounters:
+    """Counters whose increments are spread over shard documents.
+
+    A counter ``<counter>`` on ``<collection>/<doc_id>`` lives in the
+    subcollection ``<collection>/<doc_id>/counters/<counter>/shards``. Each
+    increment is a blind ``Increment`` write to one randomly chosen shard, so a
+    counter sustains roughly ``shards`` times the per-document write rate.
+    Reads sum every shard with one sum aggregation; since they do not depend on
+    the shard count, it can be raised or lowered at any time.
+
+    Totals are cached for ``cache_ttl`` seconds, so hot counters are not
+    re-aggregated on every read.
+    """
+
+    FIELD = "count"
+    TOTAL = "total"
+
+    def __init__(self, default_shards=10, shard_counts=None, cache_ttl=1.0, max_entries=10000):
+        self.default_shards = default_shards
+        self.shard_counts = dict(shard_counts or {})
+        self.totals = DocumentCache(max_entries=max_entries, default_ttl=cache_ttl)
+
+    def shards(self, collection, counter):
+        """Shard count for ``counter`` on documents of ``collection``."""
+        return self.shard_counts.get(f"{collection}/{counter}", self.default_shards)
+
+    @staticmethod
+    def path(collection, doc_id, counter):
+        return f"{collection}/{doc_id}/counters/{counter}/shards"
+
+    def shard_id(self, collection, counter):
+        return str(random.randrange(self.shards(collection, counter)))
+
+    def cached_total(self, path):
+        """Return ``(hit, total)``."""
+        hit, entry = self.totals.get(path, self.TOTAL)
+        return hit, entry[self.TOTAL] if hit else None
+
+    def cache_total(self, path, total):
+        self.totals.put(path, self.TOTAL, {self.TOTAL: total})
+
+
 # --- Firestore Client (from firestore_client.py) ---
 
-class FirestoreClient:
-    def __init__(self, credentials_path=None):
+def driven(method):
+    """Mark a generator method of BaseFirestoreClient as the implementation of a client call.
+
+    The method yields each Firestore call it makes and is sent back the
+    call's result; see ``BaseFirestoreClient.__init_subclass__``.
+    """
+    method.driven = True
+    return method
+
+
+class BaseFirestoreClient:
+    """The Firestore calls of the sync and async clients, written once.
+
+    Every public call is a ``@driven`` generator that builds its requests
+    here and yields each RPC: the subclasses only decide how a yielded call
+    is run (see ``__init_subclass__``) and provide the few primitives whose
+    I/O differs, such as iterating a stream or running calls concurrently.
+    So both clients build exactly the same Firestore requests and shape their
+    results the same way.
+    """
+
+    GET_ALL_CHUNK = 100
+    # Firestore accepts at most five aggregations per request
+    MAX_AGGREGATIONS = 5
+    # Smallest possible document id, as used by the client library for path-scoped descendant queries
+    _MIN_DOCUMENT_ID = "__id-9223372036854775808__"
+    BATCH_LIMIT = 500
+    WRITE_OPS = ("create", "set", "update", "delete")
+
+    SINGLE_FLIGHT = SingleFlight
+
+    def __init__(self, credentials_path=None, cache=None, coalesce=False, counters=None, policy=None):
+        self._configure_credentials(credentials_path)
+        self.cache = cache
+        self.flights = self.SINGLE_FLIGHT() if coalesce else None
+        self.counters = counters or ShardedCounters()
+        self.policy = policy or RpcPolicy()
+
+    def __init_subclass__(cls, **kwargs):
+        """Give ``cls`` each ``@driven`` call as a method run by ``cls._driver``.
+
+        The sync client's calls return their results, so its driver sends each
+        yielded value straight back; the async client's calls return
+        awaitables, which its driver awaits, throwing a failure back in at the
+        ``yield`` so the generator's own error handling applies.
+        """
+        super().__init_subclass__(**kwargs)
+        for name, method in list(vars(BaseFirestoreClient).items()):
+            if getattr(method, "driven", False) and getattr(cls, name) is method:
+                setattr(cls, name, cls._driver(method))
+
+    @staticmethod
+    def _configure_credentials(credentials_path):
         if credentials_path and credentials_path.strip():
             os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
             logging.info("Using explicit credentials from: %s", credentials_path)
         else:
             logging.info("Using default authentication (service account or environment)")
-        self.db = firestore.Client()
 
-    def create_document(self, collection, data):
+    # Single-flight group for reads; None when coalescing is disabled
+    flights = None
+    # Deadline and retry settings for every RPC
+    policy = RpcPolicy()
+    RETRY = Retry
+
+    def _rpc(self, idempotent=True):
+        """``retry``/``timeout`` keyword arguments for one RPC; see RpcPolicy."""
+        return self.policy.kwargs(self.RETRY, idempotent)
+
+    @contextmanager
+    def _errors(self, message, subject, invalid=None, write=False):
+        """Turn an exception raised in the block into the AppError for it; unexpected ones are logged.
+
+        ``message`` is the generic error (see ``RpcPolicy.error``) and
+        ``subject`` completes it in the log. With ``invalid``, an
+        InvalidArgument is a 400 prefixed with it. For a ``write``, NotFound
+        passes through for the route to report, a failed version precondition
+        is a 412 and a ValueError, raised by the client library before any RPC
+        (e.g. for an empty update or a nested ``$delete``), is a 400.
+        """
+        try:
+            yield
+        except Exception as e:
+            if write and isinstance(e, GoogleNotFound):
+                raise
+            if write and isinstance(e, FailedPrecondition):
+                raise AppError("Document has been modified since the given version", 412)
+            if write and isinstance(e, ValueError):
+                raise AppError(str(e), 400)
+            if invalid and isinstance(e, InvalidArgument):
+                raise AppError(f"{invalid}: {e}", 400)
+            logging.exception("%s %s: %s", message, subject, e)
+            raise self.policy.error(e, message)
+
+    def _invalidate(self, collection, doc_id):
+        if self.cache is not None:
+            self.cache.invalidate(collection, doc_id)
+        if self.flights is not None:
+            self.flights.forget(("document", collection, doc_id))
+            self.flights.forget(("query", collection))
+
+    @contextmanager
+    def _invalidating(self, collection, doc_ids):
+        """Invalidate ``doc_ids`` once the enclosed write returns or fails.
+
+        A write that failed on our side, e.g. by timing out, may still have
+        been applied, so a copy cached before it can no longer be trusted.
+        """
         try:
+            yield
+        finally:
+            for doc_id in doc_ids:
+                self._invalidate(collection, doc_id)
+
+    def _coalesce(self, key, fn, *args):
+        """Call ``fn(*args)``, sharing an identical in-flight call when coalescing is enabled."""
+        if self.flights is None:
+            return fn(*args)
+        return self.flights.do(key, fn, *args)
+
+    # --- Lazy client ---
+
+    _db = None
+    _db_lock = threading.Lock()
+
+    @property
+    def db(self):
+        """The Firestore client, created on first use.
+
+        Construction resolves credentials and the project, so it is deferred
+        until a request (or ``warm``) needs it; under a pre-fork server that
+        happens in each worker rather than in the master process.
+        """
+        if self._db is None:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = self._create_db()
+        return self._db
+
+    @db.setter
+    def db(self, db):
+        self._db = db
+
+    def _channel(self):
+        """The client's gRPC channel, or None for clients without one (the in-memory fake)."""
+        api = getattr(self.db, "_firestore_api", None)
+        return getattr(getattr(api, "_transport", None), "grpc_channel", None)
+
+    # --- Documents ---
+
+    @driven
+    def create_document(self, collection, data):
+        fields = FieldTransforms.resolve(data)
+        with self._errors("Failed to create document", f"in {collection}"):
             doc_ref = self.db.collection(collection).document()
-            doc_ref.set(data)
+            with timing("rpc"):
+                yield doc_ref.set(fields, **self._rpc(idempotent=False))
             logging.info("Created document %s in %s", doc_ref.id, collection)
-            return {"id": doc_ref.id, **data}
-        except Exception as e:
-            logging.exception("Failed to create document in %s: %s", collection, e)
-            raise AppError("Failed to create document")
+            return {"id": doc_ref.id, **FieldTransforms.echo(data, fields)}
 
+    @driven
     def create_document_with_id(self, collection, doc_id, data):
-        try:
+        fields = FieldTransforms.resolve(data)
+        with self._errors("Failed to create document with ID", f"{collection}/{doc_id}"):
             doc_ref = self.db.collection(collection).document(doc_id)
-            doc_ref.set(data)
+            with self._invalidating(collection, [doc_id]), timing("rpc"):
+                yield doc_ref.set(fields, **self._rpc(idempotent=False))
             logging.info("Created document %s/%s", collection, doc_id)
-            return {"id": doc_id, **data}
-        except Exception as e:
-            logging.exception("Failed to create document %s/%s: %s", collection, doc_id, e)
-            raise AppError("Failed to create document with ID")
+            return {"id": doc_id, **FieldTransforms.echo(data, fields)}
 
-    def read_document(self, collection, doc_id):
-        try:
-            doc = self.db.collection(collection).document(doc_id).get()
+    @driven
+    def read_document(self, collection, doc_id, fields=None):
+        """Read a document, optionally projecting it server-side to ``fields``.
+
+        Whole-document reads are served from the cache when one is configured.
+        Returns a ``(document, update_time)`` tuple; both are None when the
+        document does not exist.
+        """
+        if self.cache is not None and not fields:
+            hit, cached, update_time = self.cache.get_versioned(collection, doc_id)
+            if hit:
+                return cached, update_time
+        return (yield self._coalesce(
+            flight_key("document", collection, doc_id, fields), self._read_document, collection, doc_id, fields
+        ))
+
+    @driven
+    def _read_document(self, collection, doc_id, fields):
+        caching = self.cache is not None and not fields
+        generation = self.cache.generation() if caching else None
+        with self._errors("Failed to read document", f"{collection}/{doc_id}"):
+            with timing("rpc"):
+                doc = yield self.db.collection(collection).document(doc_id).get(field_paths=fields, **self._rpc())
+            result, update_time = None, None
             if doc.exists:
                 logging.info("Read document %s/%s", collection, doc_id)
-                return {"id": doc.id, **doc.to_dict()}
-            return None
-        except Exception as e:
-            logging.exception("Failed to read document %s/%s: %s", collection, doc_id, e)
-            raise AppError("Failed to read document")
+                result, update_time = self._document_dict(doc), doc.update_time
+        if caching:
+            self.cache.put(collection, doc_id, result, update_time, generation=generation)
+        return result, update_time
 
-    def update_document(self, collection, doc_id, data):
+    @driven
+    def update_document(self, collection, doc_id, data, return_document=False, if_match=None, merge=False):
+        """Update a document in a single write.
+
+        ``update()`` already carries an ``exists`` precondition, so a missing
+        document surfaces as NotFound without a separate read. With ``merge``
+        the write is ``set(merge=True)`` instead: nested maps are merged key by
+        key and a missing document is created. ``if_match`` adds a
+        ``last_update_time`` precondition for optimistic concurrency. ``data``
+        may contain FieldTransforms. The merged document is only read back when
+        ``return_document`` is set, after the write so that it observes it.
+
+        Returns a ``(document, update_time)`` tuple.
+        """
         doc_ref = self.db.collection(collection).document(doc_id)
-        try:
-            doc_ref.update(data)
-            updated_doc = doc_ref.get()
+        fields = FieldTransforms.resolve(data, delete=True)
+        with self._errors("Failed to update document", f"{collection}/{doc_id}", write=True):
+            # Only a version precondition makes a replayed update fail instead of applying twice
+            rpc = self._rpc(idempotent=if_match is not None)
+            with self._invalidating(collection, [doc_id]), timing("rpc"):
+                if merge and not if_match:
+                    write_result = yield doc_ref.set(fields, merge=True, **rpc)
+                else:
+                    option = self.db.write_option(last_update_time=if_match) if if_match else None
+                    updates = self._merge_paths(fields) if merge else fields
+                    write_result = yield doc_ref.update(updates, option=option, **rpc)
             logging.info("Updated document %s/%s", collection, doc_id)
-            return {"id": doc_id, **updated_doc.to_dict()}
-        except NotFound:
-            raise
-        except Exception as e:
-            logging.exception("Failed to update document %s/%s: %s", collection, doc_id, e)
-            raise AppError("Failed to update document")
+            if return_document:
+                with timing("rpc"):
+                    updated_doc = yield doc_ref.get(**self._rpc())
+                return self._document_dict(updated_doc), updated_doc.update_time
+            return {"id": doc_id, **FieldTransforms.echo(data, fields)}, write_result.update_time
 
-    def delete_document(self, collection, doc_id):
-        try:
-            doc_ref = self.db.collection(collection).document(doc_id)
-            if not doc_ref.get().exists:
-                raise NotFound("Document not found")
-            doc_ref.delete()
+    @driven
+    def delete_document(self, collection, doc_id, if_match=None):
+        """Delete a document in a single write guarded by an existence or version precondition."""
+        doc_ref = self.db.collection(collection).document(doc_id)
+        if if_match:
+            option = self.db.write_option(last_update_time=if_match)
+        else:
+            option = self.db.write_option(exists=True)
+        with self._errors("Failed to delete document", f"{collection}/{doc_id}", write=True):
+            with self._invalidating(collection, [doc_id]), timing("rpc"):
+                yield doc_ref.delete(option=option, **self._rpc())
             logging.info("Deleted document %s/%s", collection, doc_id)
             return {"id": doc_id}
-        except NotFound:
-            raise
-        except Exception as e:
-            logging.exception("Failed to delete document %s/%s: %s", collection, doc_id, e)
-            raise AppError("Failed to delete document")
 
+    @staticmethod
+    def _merge_paths(data, prefix=()):
+        """Flatten nested maps to ``{field_path: value}``.
+
+        ``update()`` with these paths touches only the given leaves, as
+        ``set(merge=True)`` does, but unlike ``set()`` it takes a write option,
+        so a merge with If-Match is sent as such an update.
+        """
+        paths = {}
+        for key, value in data.items():
+            path = prefix + (key,)
+            if isinstance(value, dict) and value:
+                paths.update(BaseFirestoreClient._merge_paths(value, path))
+            else:
+                paths[FieldPath(*path).to_api_repr()] = value
+        return paths
 
-# --- Filter Builder (from services/filter_builder.py) ---
+    # --- Collection queries ---
 
-class FilterBuilder:
     @staticmethod
-    def _auto_type(val: str):
+    def _where(query, filters):
+        """Apply ``(field, op, value)`` filters as one composite filter."""
+        if not filters:
+            return query
+        clauses = [FieldFilter(*f) for f in filters]
+        return query.where(filter=clauses[0] if len(clauses) == 1 else And(clauses))
+
+    def _build_query(self, collection, filters, orders, limit, offset=0, page_token=None, fields=None):
+        """Build the page query for ``GET /documents/<collection>``.
+
+        Returns ``(filtered_query, query, hidden_fields)``: the filtered query
+        (for counts), the full ordered/paged/projected query, and the ordering
+        fields that were only selected to build cursors and must be stripped.
+        """
+        query = self._where(self.db.collection(collection), filters)
+        filtered_query = query
+
+        for field_name, direction in orders:
+            query = query.order_by(field_name, direction=direction)
+        if page_token:
+            query = query.start_after(PageCursor.decode(page_token, orders, self.db))
+        if offset:
+            query = query.offset(offset)
+        query = query.limit(limit)
+
+        # Project server-side; ordering fields are also selected so cursors can be built
+        hidden_fields = set()
+        if fields:
+            order_fields = [f for f, _ in orders if f != PageCursor.DOCUMENT_ID and f not in fields]
+            requested_roots = {f.split(".")[0] for f in fields}
+            hidden_fields = {f.split(".")[0] for f in order_fields} - requested_roots
+            query = query.select(list(fields) + order_fields)
+        return filtered_query, query, hidden_fields
+
+    @staticmethod
+    def _document_dict(doc, hidden_fields=()):
+        data = doc.to_dict()
+        for key in hidden_fields:
+            data.pop(key, None)
+        data["id"] = doc.id
+        return data
+
+    @staticmethod
+    def _next_page_token(orders, docs, limit):
+        return PageCursor.encode(orders, docs[-1]) if len(docs) == limit else None
+
+    @driven
+    def query_documents(self, collection, filters, orders, limit, offset=0, page_token=None, fields=None,
+                        with_total=False):
+        """Run one page of a collection query; the async client counts the total concurrently.
+
+        Returns ``(documents, next_page_token, total, version)``; ``total``
+        comes from a count aggregation and is None unless ``with_total`` is
+        set, and ``version`` identifies the page's content (see
+        ``DocumentVersion.page``). Identical concurrent queries are coalesced
+        when the client was created with ``coalesce=True``.
+        """
+        key = flight_key("query", collection, filters, orders, limit, offset, page_token, fields, with_total)
+        return (yield self._coalesce(
+            key, self._query_documents, collection, filters, orders, limit, offset, page_token, fields, with_total
+        ))
+
+    @driven
+    def _query_documents(self, collection, filters, orders, limit, offset, page_token, fields, with_total):
+        filtered_query, query, hidden_fields = self._build_query(
+            collection, filters, orders, limit, offset, page_token, fields
+        )
+        with self._errors("Failed to query documents", f"in {collection}", invalid="Invalid filter"):
+            if with_total:
+                docs, total = yield self._gather(self._get(query), self.count_query(filtered_query))
+            else:
+                docs, total = (yield self._get(query)), None
+        data = [self._document_dict(doc, hidden_fields) for doc in docs]
+        return data, self._next_page_token(orders, docs, limit), total, DocumentVersion.page(docs, total)
+
+    @driven
+    def stream_documents(self, collection, filters, orders, limit, offset=0, page_token=None, fields=None):
+        """Return an (async) iterator over the documents of a collection query, straight from the Firestore stream.
+
+        The query is built and its first document fetched before returning, so
+        an invalid filter or page token raises AppError while the response
+        status can still report it. A failure later in the stream ends the
+        iterator with AppError.
+        """
+        _, query, hidden_fields = self._build_query(collection, filters, orders, limit, offset, page_token, fields)
+        docs = query.stream(**self._rpc())
+        with self._errors("Failed to query documents", f"in {collection}", invalid="Invalid filter"):
+            first = yield self._first(docs)
+        return self._stream(collection, first, docs, hidden_fields)
+
+    # --- Batched reads ---
+
+    def _document_refs(self, paths):
+        """Map each distinct path to a DocumentReference, rejecting invalid paths with a 400."""
         try:
-            if '.' in val: return float(val)
-            else: return int(val)
-        except (ValueError, TypeError):
-            return val
+            return {path: self.db.document(path) for path in dict.fromkeys(paths)}
+        except ValueError as e:
+            raise AppError(f"Invalid document path: {e}", 400)
+
+    def _chunks(self, items, size):
+        return [items[start:start + size] for start in range(0, len(items), size)]
+
+    @driven
+    def read_documents(self, paths, fields=None):
+        """Read many documents by ``collection/doc_id`` path with batched get_all() calls.
+
+        The async client fetches the chunks concurrently. Returns one entry
+        per requested path, in request order: the document dict when it
+        exists, otherwise None.
+        """
+        refs = self._document_refs(paths)
+        unique_refs = list(refs.values())
+        with self._errors("Failed to read documents", f"({len(unique_refs)} paths)"):
+            chunks = yield self._gather(
+                *(self._get_all(chunk, fields) for chunk in self._chunks(unique_refs, self.GET_ALL_CHUNK))
+            )
+        found = {doc.reference.path: self._document_dict(doc) for chunk in chunks for doc in chunk}
+
+        logging.info("Read %d of %d documents", len(found), len(unique_refs))
+        return [found.get(refs[path].path) for path in paths]
+
+    # --- Aggregations ---
+
+    def _aggregation(self, collection, filters, count, sums, avgs):
+        """Build one aggregation query; returns ``(aggregation, aliases)``."""
+        aliases = ([("count", None)] if count else []) + [("sum", f) for f in sums] + [("avg", f) for f in avgs]
+        if not aliases:
+            raise AppError("Request at least one of count, sum or avg", 400)
+        if len(aliases) > self.MAX_AGGREGATIONS:
+            raise AppError(f"At most {self.MAX_AGGREGATIONS} aggregations are allowed per request", 400)
+
+        query = self._where(self.db.collection(collection), filters)
+
+        aggregation = None
+        for index, (kind, field) in enumerate(aliases):
+            alias = f"a{index}"
+            target = aggregation if aggregation is not None else query
+            if kind == "count":
+                aggregation = target.count(alias=alias)
+            else:
+                aggregation = getattr(target, kind)(field, alias=alias)
+        return aggregation, aliases
 
     @staticmethod
-    def build(args):
-        filters = []
-        for key, value in args.items():
-            if key in ["limit", "offset", "order_by", "fields", "include_parent"] or key.startswith("subcollection_"):
-                continue
+    def _aggregation_data(aliases, results):
+        values = {result.alias: result.value for result in results}
+        data = {}
+        for index, (kind, field) in enumerate(aliases):
+            value = values.get(f"a{index}")
+            if kind == "count":
+                data["count"] = value
+            else:
+                data.setdefault(kind, {})[field] = value
+        return data
 
-            op_map = {
-                "_gte": ">=", "_lte": "<=", "_gt": ">", "_lt": "<", "_in": "in"
-            }
-            
-            op = "=="
-            field = key
-            
-            for suffix, operator in op_map.items():
-                if key.endswith(suffix):
-                    field = key[:-len(suffix)]
-                    op = operator
-                    break
-            
-            processed_value = [FilterBuilder._auto_type(v) for v in value.split(',')] if op == "in" else FilterBuilder._auto_type(value)
-            filters.append((field, op, processed_value))
-            
-        return filters 
\ No newline at end of file
+    @driven
+    def count_query(self, query):
+        """Return the number of documents matching ``query`` via a count aggregation."""
+        with timing("count"):
+            results = yield query.count(alias="count").get(**self._rpc())
+        return results[0][0].value
+
+    @driven
+    def aggregate(self, collection, filters, count=False, sums=(), avgs=()):
+        """Run count/sum/avg aggregations server-side over the filtered collection.
+
+        Returns ``{"count": n, "sum": {field: total}, "avg": {field: mean}}`` with
+        only the requested keys present.
+        """
+        aggregation, aliases = self._aggregation(collection, filters, count, sums, avgs)
+        with self._errors("Failed to aggregate documents", f"in {collection}"), timing("rpc"):
+            results = (yield aggregation.get(**self._rpc()))[0]
+        data = self._aggregation_data(aliases, results)
+        logging.info("Aggregated %s: %s", collection, data)
+        return data
+
+    # --- Sharded counters ---
+
+    # ShardedCounters layout and total cache; set by the constructors
+    counters = None
+
+    @driven
+    def increment_counter(self, collection, doc_id, counter, amount=1):
+        """Add ``amount`` to one random shard of the counter; creates the shard on first use."""
+        shards = self.db.collection(ShardedCounters.path(collection, doc_id, counter))
+        shard_ref = shards.document(self.counters.shard_id(collection, counter))
+        data = {ShardedCounters.FIELD: firestore.Increment(amount)}
+        with self._errors("Failed to increment counter", f"{counter} on {collection}/{doc_id}"), timing("rpc"):
+            yield shard_ref.set(data, merge=True, **self._rpc(idempotent=False))
+        return {"id": doc_id, "counter": counter, "shard": shard_ref.id, "increment": amount}
+
+    @driven
+    def read_counter(self, collection, doc_id, counter, use_cache=True):
+        """Sum the counter's shards, from the short-lived total cache when allowed.
+
+        Concurrent reads of the same counter share one aggregation.
+        """
+        path = ShardedCounters.path(collection, doc_id, counter)
+        hit, total = self.counters.cached_total(path) if use_cache else (False, None)
+        if not hit:
+            total = yield self._coalesce(flight_key("counter", path), self._sum_counter, path)
+        return {"id": doc_id, "counter": counter, "value": total, "shards": self.counters.shards(collection, counter)}
+
+    @driven
+    def _sum_counter(self, path):
+        aggregation = self.db.collection(path).sum(ShardedCounters.FIELD, alias=ShardedCounters.TOTAL)
+        with self._errors("Failed to read counter", path), timing("count"):
+            results = (yield aggregation.get(**self._rpc()))[0]
+        total = results[0].value or 0
+        self.counters.cache_total(path, total)
+        return total
+
+    # --- Cross-parent subcollection queries ---
+
+    def _group_query(self, subcollection, collection, filters):
+        """Build the collection group query, scoped to the documents under ``collection``.
+
+        The scope is a document-id range on the ``collection`` prefix, applied
+        as filters so it also bounds the count aggregation. Results are
+        ordered by path first, so each parent's documents arrive together and
+        streaming can stop once a page of parents is complete.
+        """
+        doc_id = PageCursor.DOCUMENT_ID
+        scope = [
+            (doc_id, ">=", self.db.document(f"{collection}/{self._MIN_DOCUMENT_ID}")),
+            (doc_id, "<", self.db.document(f"{collection}\0/{self._MIN_DOCUMENT_ID}")),
+        ]
+        return self._where(self.db.collection_group(subcollection), list(filters) + scope).order_by(doc_id)
+
+    @staticmethod
+    def _group_parent(doc, collection):
+        """Path of the ``collection`` document ``doc`` belongs to, or None for a deeper or unrelated parent.
+
+        Compared through the parent document's path: the collection reference
+        above it has no ``path`` attribute.
+        """
+        parent = doc.reference.parent.parent
+        if parent is None or parent.path.rsplit("/", 1)[0] != collection:
+            return None
+        return parent.path
+
+    @staticmethod
+    def _add_to_group(groups, doc, collection, max_parents):
+        """Add ``doc`` to its parent's group; returns False once the page of parents is complete."""
+        path = BaseFirestoreClient._group_parent(doc, collection)
+        if path is None:
+            return True
+        if path not in groups:
+            if len(groups) == max_parents:
+                return False
+            groups[path] = []
+        groups[path].append(BaseFirestoreClient._document_dict(doc))
+        return True
+
+    @staticmethod
+    def _group_entries(page, parents):
+        data = []
+        for (path, files), parent in zip(page, parents):
+            entry = dict(parent) if parent else {"id": path.rsplit("/", 1)[-1]}
+            entry["files"] = files
+            data.append(entry)
+        return data
+
+    @driven
+    def query_subcollection_group(self, collection, subcollection, filters, limit, offset=0, include_parent=False):
+        """Query ``subcollection`` across every document of ``collection`` in one request.
+
+        Runs a single ``collection_group`` query scoped to ``collection`` (see
+        ``_group_query``) and groups the matching documents by parent as they
+        stream in, stopping as soon as the requested page of parents is complete.
+
+        Parents are fetched with batched ``get_all`` calls, and the total number
+        of matching subcollection documents comes from a count aggregation over
+        the same scoped query; the async client runs the stream and the count
+        concurrently.
+
+        Returns ``(groups, total_found)``.
+        """
+        query = self._group_query(subcollection, collection, filters)
+        with self._errors("Failed to query subcollections", f"{collection}/*/{subcollection}"):
+            groups, total_found = yield self._gather(
+                self._group(query, collection, offset + limit), self.count_query(query)
+            )
+
+        page = list(groups.items())[offset:offset + limit]
+        if include_parent and page:
+            parents = yield self.read_documents([path for path, _ in page])
+        else:
+            parents = [None] * len(page)
+        data = self._group_entries(page, parents)
+        logging.info("Queried %s/*/%s: %d parents, %d total matches", collection, subcollection, len(data), total_found)
+        return data, total_found
+
+    # --- Batch writes ---
+
+    def _plan_batch(self, collection, operations, atomic):
+        """Validate operations and split them into commits.
+
+        Returns ``(writes, chunks)``. Atomic batches form a single chunk.
+        Otherwise chunks hold up to 500 writes and are cut early when a
+        document repeats, since BatchWrite cannot write a document twice.
+        """
+        coll = self.db.collection(collection)
+        writes = [self._prepare_write(coll, index, operation) for index, operation in enumerate(operations)]
+        if atomic:
+            if len(writes) > self.BATCH_LIMIT:
+                raise AppError(f"Atomic batches are limited to {self.BATCH_LIMIT} operations", 400)
+            return writes, [writes]
+
+        chunks = []
+        chunk, paths = [], set()
+        for write in writes:
+            if len(chunk) == self.BATCH_LIMIT or write[1].path in paths:
+                chunks.append(chunk)
+                chunk, paths = [], set()
+            chunk.append(write)
+            paths.add(write[1].path)
+        if chunk:
+            chunks.append(chunk)
+        return writes, chunks
+
+    @staticmethod
+    def _distinct_paths(writes):
+        return len({write[1].path for write in writes}) == len(writes)
+
+    def _prepare_write(self, coll, index, operation):
+        if not isinstance(operation, dict):
+            raise AppError(f"Operation {index} must be an object", 400)
+        op = operation.get("op")
+        if op not in self.WRITE_OPS:
+            raise AppError(f"Operation {index}: op must be one of {', '.join(self.WRITE_OPS)}", 400)
+        doc_id = operation.get("id")
+        if doc_id is not None and not isinstance(doc_id, str):
+            raise AppError(f"Operation {index}: id must be a string", 400)
+        if not doc_id and op in ("update", "delete"):
+            raise AppError(f"Operation {index}: {op} requires an id", 400)
+        data = operation.get("data")
+        if op != "delete" and not isinstance(data, dict):
+            raise AppError(f"Operation {index}: {op} requires a data object", 400)
+        merge = bool(operation.get("merge", False))
+        if data is not None:
+            try:
+                data = FieldTransforms.resolve(data, delete=op == "update" or (op == "set" and merge))
+            except AppError as e:
+                raise AppError(f"Operation {index}: {e.message}", 400)
+        ref = coll.document(doc_id) if doc_id else coll.document()
+        return (op, ref, data, merge)
+
+    # Deletes of missing documents fail with NotFound, as DELETE /documents/<collection>/<id> does
+    _DELETE_OPTION = firestore.Client.write_option(exists=True)
+
+    @staticmethod
+    def _add_write(batch, op, ref, data, merge):
+        if op == "create":
+            batch.create(ref, data)
+        elif op == "set":
+            batch.set(ref, data, merge=merge)
+        elif op == "update":
+            batch.update(ref, data)
+        else:
+            batch.delete(ref, option=BaseFirestoreClient._DELETE_OPTION)
+
+    @staticmethod
+    def _write_result(write, update_time=None, error=None):
+        result = {"op": write[0], "id": write[1].id}
+        if error is not None:
+            result.update({"status": "error", "code": error.code, "message": error.message})
+        else:
+            result.update({"status": "success", "update_time": DocumentVersion.etag(update_time)})
+        return result
+
+    @driven
+    def batch_write(self, collection, operations, atomic=False):
+        """Apply a list of create/set/update/delete operations in batched commits.
+
+        Non-atomic batches are sent through the BatchWrite RPC in chunks of up
+        to 500 writes; each write is applied independently and reports its own
+        status. The async client commits the chunks concurrently unless a
+        document is written more than once, in which case they keep their
+        request order. Chunks left once the request deadline has passed are
+        not sent, and their writes are reported as errors with code 504.
+        Atomic batches are committed as a single WriteBatch and are therefore
+        limited to 500 operations.
+
+        Returns one result dict per operation, in request order.
+        """
+        writes, chunks = self._plan_batch(collection, operations, atomic)
+        with self._invalidating(collection, [write[1].id for write in writes]):
+            if atomic:
+                results = yield self._commit_atomic(writes)
+            elif self._distinct_paths(writes):
+                chunk_results = yield self._gather(*(self._commit_chunk(chunk) for chunk in chunks))
+                results = [result for chunk in chunk_results for result in chunk]
+            else:
+                results = []
+                for chunk in chunks:
+                    results += yield self._commit_chunk(chunk)
+        failed = sum(1 for r in results if r["status"] == "error")
+        logging.info("Batch wrote %d operations to %s (%d failed)", len(results), collection, failed)
+        return results
+
+    @driven
+    def _commit_chunk(self, chunk):
+        try:
+            rpc = self._rpc(idempotent=False)
+        except AppError as e:
+            return self._unsent_results(chunk, e)
+        return (yield self._send_bulk(chunk, rpc))
+
+    def _commit_bulk(self, db, chunk, rpc):
+        """Send ``chunk`` through the BatchWrite RPC of the synchronous client ``db``."""
+        batch = BulkWriteBatch(db)
+        for write in chunk:
+            self._add_write(batch, *write)
+        try:
+            with timing("rpc"):
+                response = batch.commit(**rpc)
+        except GoogleAPICallError as e:
+            logging.exception("Batch write of %d operations failed: %s", len(chunk), e)
+            return [self._write_result(write, error=e) for write in chunk]
+        return self._chunk_results(chunk, response)
+
+    def _unsent_results(self, chunk, error):
+        """Results for a chunk that was not sent because the request deadline had passed."""
+        logging.warning("Skipped batch write of %d operations: %s", len(chunk), error.message)
+        unsent = DeadlineExceeded(f"Not attempted: {error.message}")
+        return [self._write_result(write, error=unsent) for write in chunk]
+
+    def _chunk_results(self, chunk, response):
+        results = []
+        for write, status, write_result in zip(chunk, response.status, response.write_results):
+            if status.code:
+                results.append(self._write_result(write, error=from_grpc_status(status.code, status.message)))
+            else:
+                results.append(self._write_result(write, update_time=write_result.update_time))
+        return results
+
+    @driven
+    def _commit_atomic(self, writes):
+        batch = self.db.batch()
+        for write in writes:
+            self._add_write(batch, *write)
+        try:
+            with timing("rpc"):
+                write_results = yield batch.commit(**self._rpc(idempotent=False))
+        except GoogleAPICallError as e:
+            logging.exception("Atomic batch of %d operations failed: %s", len(writes), e)
+            return [self._write_result(write, error=e) for write in writes]
+        return [self._write_result(write, update_time=wr.update_time) for write, wr in zip(writes, write_results)]
+
+
+class FirestoreClient(BaseFirestoreClient):
+    """Firestore client for the WSGI app: every yielded call has already run and is its own result."""
+
+    @staticmethod
+    def _driver(steps):
+        @wraps(steps)
+        def call(self, *args, **kwargs):
+            calls = steps(self, *args, **kwargs)
+            result = None
+            try:
+                while True:
+                    result = calls.send(result)
+            except StopIteration as done:
+                return done.value
+        return call
+
+    def _create_db(self):
+        return firestore.Client()
+
+    def warm(self, timeout):
+        """Create the client and wait until its gRPC channel is connected."""
+        start = time.perf_counter()
+        channel = self._channel()
+        if channel is not None:
+            grpc.channel_ready_future(channel).result(timeout=timeout)
+        logging.info("Firestore client ready in %.1f ms", (time.perf_counter() - start) * 1000)
+
+    def warm_in_background(self, timeout):
+        """Run ``warm`` on a daemon thread so startup does not wait for the channel."""
+        def run():
+            try:
+                self.warm(timeout)
+            except Exception as e:
+                logging.warning("Firestore pre-warm failed: %s", e)
+
+        thread = threading.Thread(target=run, name="firestore-prewarm", daemon=True)
+        thread.start()
+        return thread
+
+    # --- I/O primitives ---
+
+    @staticmethod
+    def _gather(*results):
+        """The results of calls that the async client runs concurrently; here they ran one after another."""
+        return list(results)
+
+    def _get(self, query):
+        with timing("rpc"):
+            return list(query.stream(**self._rpc()))
+
+    def _get_all(self, refs, fields):
+        with timing("rpc"):
+            return [doc for doc in self.db.get_all(refs, field_paths=fields, **self._rpc()) if doc.exists]
+
+    @staticmethod
+    def _first(docs):
+        return next(docs, None)
+
+    def _stream(self, collection, first, docs, hidden_fields):
+        if first is None:
+            return
+        yield self._document_dict(first, hidden_fields)
+        with self._errors("Failed to stream documents", f"of {collection}"):
+            for doc in docs:
+                yield self._document_dict(doc, hidden_fields)
+
+    def _group(self, query, collection, max_parents):
+        groups = OrderedDict()
+        with timing("rpc"):
+            for doc in query.stream(**self._rpc()):
+                if not self._add_to_group(groups, doc, collection, max_parents):
+                    break
+        return groups
+
+    def _send_bulk(self, chunk, rpc):
+        return self._commit_bulk(self.db, chunk, rpc)
+
+
+class AsyncFirestoreClient(BaseFirestoreClient):
+    """asyncio counterpart of FirestoreClient built on ``firestore.AsyncClient``.
+
+    Every call is a coroutine with the same arguments and results as on
+    FirestoreClient. RPCs that do not depend on each other within one call
+    run concurrently: get_all chunks, a query page and its total count, the
+    subcollection stream and its count, and non-atomic batch commits.
+    """
+
+    RETRY = AsyncRetry
+    SINGLE_FLIGHT = AsyncSingleFlight
+
+    @staticmethod
+    def _driver(steps):
+        @wraps(steps)
+        async def call(self, *args, **kwargs):
+            calls = steps(self, *args, **kwargs)
+            send, value = calls.send, None
+            while True:
+                try:
+                    awaitable = send(value)
+                except StopIteration as done:
+                    return done.value
+                try:
+                    send, value = calls.send, await awaitable
+                except BaseException as e:
+                    send, value = calls.throw, e
+        return call
+
+    def _create_db(self):
+        return firestore.AsyncClient()
+
+    _sync_db = None
+
+    @property
+    def sync_db(self):
+        """A synchronous client for non-atomic batch writes, created on first use.
+
+        The BatchWrite RPC is only exposed through ``BulkWriteBatch``, which
+        needs a synchronous client, so those commits run on worker threads (as
+        ``AsyncClient.bulk_writer()`` does).
+        """
+        if self._sync_db is None:
+            with self._db_lock:
+                if self._sync_db is None:
+                    self._sync_db = firestore.Client()
+        return self._sync_db
+
+    @sync_db.setter
+    def sync_db(self, db):
+        self._sync_db = db
+
+    async def warm(self, timeout):
+        """Create the client and wait until its gRPC channel is connected."""
+        start = time.perf_counter()
+        channel = self._channel()
+        if channel is not None:
+            await asyncio.wait_for(channel.channel_ready(), timeout)
+        logging.info("Firestore client ready in %.1f ms", (time.perf_counter() - start) * 1000)
+
+    def warm_in_background(self, timeout):
+        """Schedule ``warm`` on the running event loop; failures are logged, not raised."""
+        def done(task):
+            if not task.cancelled() and task.exception() is not None:
+                logging.warning("Firestore pre-warm failed: %s", task.exception())
+
+        task = asyncio.ensure_future(self.warm(timeout))
+        task.add_done_callback(done)
+        return task
+
+    # --- I/O primitives ---
+
+    @staticmethod
+    def _gather(*calls):
+        return asyncio.gather(*calls)
+
+    async def _get(self, query):
+        with timing("rpc"):
+            return await query.get(**self._rpc())
+
+    async def _get_all(self, refs, fields):
+        with timing("rpc"):
+            return [doc async for doc in self.db.get_all(refs, field_paths=fields, **self._rpc()) if doc.exists]
+
+    @staticmethod
+    async def _first(docs):
+        try:
+            return await docs.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def _stream(self, collection, first, docs, hidden_fields):
+        if first is None:
+            return
+        yield self._document_dict(first, hidden_fields)
+        with self._errors("Failed to stream documents", f"of {collection}"):
+            async for doc in docs:
+                yield self._document_dict(doc, hidden_fields)
+
+    async def _group(self, query, collection, max_parents):
+        groups = OrderedDict()
+        with timing("rpc"):
+            async for doc in query.stream(**self._rpc()):
+                if not self._add_to_group(groups, doc, collection, max_parents):
+                    break
+        return groups
+
+    def _send_bulk(self, chunk, rpc):
+        return asyncio.to_thread(self._commit_bulk, self.sync_db, chunk, rpc)
+
+
+# --- Filter Builder (from services/filter_builder.py) ---
+
+class QueryPlan:
+    """A compiled query shape: filters with their operators, plus ordering and projection.
+
+    ``filters`` holds ``(param, field, op, is_list)`` tuples; ``bind`` reads the
+    values of one request from its query parameters.
+    """
+    __slots__ = ("filters", "orders", "fields")
+
+    # Firestore's limits on list operands
+    LIST_LIMITS = {"in": 30, "array_contains_any": 30, "not-in": 10}
+
+    def __init__(self, filters, orders=None, fields=None):
+        self.filters = filters
+        self.orders = orders
+        self.fields = fields
+
+    def bind(self, args):
+        """Return ``(field, op, value)`` filters with this request's values coerced."""
+        filters = []
+        for param, field, op, is_list in self.filters:
+            raw = args[param]
+            if is_list:
+                value = [FilterBuilder._auto_type(v) for v in raw.split(",")]
+                if len(value) > self.LIST_LIMITS[op]:
+                    raise AppError(f"'{param}' accepts at most {self.LIST_LIMITS[op]} values", 400)
+            else:
+                value = FilterBuilder._auto_type(raw)
+                if op != "==" and (value is None or value != value):
+                    raise AppError(f"'{param}': null and NaN can only be compared with equality", 400)
+            filters.append((field, op, value))
+        return filters
+
+
+class FilterBuilder:
+    """Parses query parameters into Firestore filters, caching compiled query plans per instance (one per app)."""
+
+    # Query parameters that control the request rather than filter documents
+    RESERVED_PARAMS = {
+        "limit", "offset", "order_by", "fields", "include_parent", "page_token", "stream", "with_total",
+        "resume_token"
+    }
+
+    # Parameter suffixes and their Firestore operators, longest first so that
+    # e.g. ``_not_in`` is not read as ``_in`` and ``_gte`` not as ``_gt``
+    OPERATOR_SUFFIXES = (
+        ("_array_contains_any", "array_contains_any"),
+        ("_array_contains", "array_contains"),
+        ("_not_in", "not-in"),
+        ("_gte", ">="),
+        ("_lte", "<="),
+        ("_gt", ">"),
+        ("_lt", "<"),
+        ("_ne", "!="),
+        ("!", "!="),
+        ("_in", "in"),
+    )
+    LIST_OPS = ("in", "not-in", "array_contains_any")
+    EQUALITY_OPS = ("==", "in")
+
+    _TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?(Z|[+-]\d{2}:\d{2})?")
+
+    PLAN_CACHE_SIZE = 512
+
+    def __init__(self, plan_cache_size=PLAN_CACHE_SIZE):
+        self.plan_cache_size = plan_cache_size
+        self._plans = OrderedDict()
+        self._plans_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _auto_type(val: str):
+        """Coerce a query parameter value: numbers, true/false, null and ISO 8601 timestamps.
+
+        A value in double quotes is always a string, e.g. ``"true"`` or ``"42"``.
+        """
+        if len(val) >= 2 and val[0] == val[-1] == '"':
+            return val[1:-1]
+        if val in ("true", "false"):
+            return val == "true"
+        if val == "null":
+            return None
+        if FilterBuilder._TIMESTAMP.fullmatch(val):
+            try:
+                parsed = datetime.fromisoformat(val)
+            except ValueError:
+                raise AppError(f"Invalid timestamp: '{val}'", 400)
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+        try:
+            if '.' in val: return float(val)
+            else: return int(val)
+        except (ValueError, TypeError):
+            return val
+
+    @staticmethod
+    def _field_path(path, param):
+        try:
+            FieldPath.from_string(path)
+        except ValueError:
+            raise AppError(f"Invalid field path in '{param}': {path!r}", 400)
+        return path
+
+    @staticmethod
+    def _compile(params, prefix, ordered, order_by, fields):
+        filters = []
+        for param in params:
+            key = param[len(prefix):] if prefix else param
+            field, op = key, "=="
+            for suffix, operator in FilterBuilder.OPERATOR_SUFFIXES:
+                if key.endswith(suffix):
+                    field, op = key[:-len(suffix)], operator
+                    break
+            if not field:
+                raise AppError(f"Invalid filter parameter '{param}'", 400)
+            FilterBuilder._field_path(field, param)
+            filters.append((param, field, op, op in FilterBuilder.LIST_OPS))
+
+        ops = [op for _, _, op, _ in filters]
+        if ops.count("array_contains") + ops.count("array_contains_any") > 1:
+            raise AppError("At most one array_contains or array_contains_any filter is allowed", 400)
+        if ops.count("not-in") + ops.count("!=") > 1:
+            raise AppError("At most one not_in or != filter is allowed", 400)
+        if "not-in" in ops and ("in" in ops or "array_contains_any" in ops):
+            raise AppError("not_in cannot be combined with in or array_contains_any", 400)
+        if not ordered:
+            return QueryPlan(tuple(filters))
+
+        shape = [(field, op, None) for _, field, op, _ in filters]
+        orders = PageCursor.orders(shape, order_by)
+        order_fields = [FilterBuilder._field_path(f, "order_by") for f, _ in orders if f != PageCursor.DOCUMENT_ID]
+        if len(set(order_fields)) != len(order_fields):
+            raise AppError("order_by lists a field more than once", 400)
+        equality_fields = {field for field, op, _ in shape if op in FilterBuilder.EQUALITY_OPS}
+        if equality_fields & set(order_fields):
+            raise AppError("Cannot order by a field that has an equality or in filter", 400)
+        inequality_fields = [field for field, op, _ in shape if op in PageCursor.INEQUALITY_OPS]
+        if inequality_fields and order_fields and order_fields[0] not in inequality_fields:
+            raise AppError(f"The first order_by field must be the inequality field '{inequality_fields[0]}'", 400)
+
+        projection = None
+        if fields:
+            projection = tuple(FilterBuilder._field_path(f.strip(), "fields") for f in fields.split(",") if f.strip())
+        return QueryPlan(tuple(filters), tuple(orders), projection or None)
+
+    def plan(self, args, prefix=None, exclude=(), ordered=False):
+        """Return the cached QueryPlan for the shape of ``args``.
+
+        The shape is the sorted filter parameter names, plus ``order_by`` and
+        ``fields`` when ``ordered``. Values and parameter order are not part of
+        it, so repeated queries only pay for ``QueryPlan.bind``. Invalid shapes
+        raise a 400 AppError before any RPC is made.
+        """
+        if prefix:
+            params = tuple(sorted(key for key in args if key.startswith(prefix) and key[len(prefix):]))
+        else:
+            params = tuple(sorted(
+                key for key in args
+                if key not in FilterBuilder.RESERVED_PARAMS and key not in exclude
+                and not key.startswith("subcollection_")
+            ))
+        order_by, fields = (args.get("order_by"), args.get("fields")) if ordered else (None, None)
+        signature = (prefix, ordered, params, order_by, fields)
+
+        with self._plans_lock:
+            plan = self._plans.get(signature)
+            if plan is not None:
+                self._plans.move_to_end(signature)
+                self.hits += 1
+                return plan
+            self.misses += 1
+
+        plan = FilterBuilder._compile(params, prefix, ordered, order_by, fields)
+        with self._plans_lock:
+            self._plans[signature] = plan
+            while len(self._plans) > self.plan_cache_size:
+                self._plans.popitem(last=False)
+        return plan
+
+    def plan_cache_stats(self):
+        with self._plans_lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._plans)}
+
+    @timed("filter")
+    def build(self, args, prefix=None):
+        """Build ``(field, op, value)`` filters from query parameters.
+
+        With ``prefix``, only parameters carrying that prefix are used, with
+        the prefix stripped (e.g. ``subcollection_status`` -> ``status``).
+        """
+        return self.plan(args, prefix=prefix).bind(args)
+
+    @staticmethod
+    def pagination(args, max_limit=1000):
+        """Parse and validate ``limit``/``offset``; returns ``(limit, offset)``."""
+        try:
+            limit = int(args.get("limit", 20))
+            offset = int(args.get("offset", 0))
+        except ValueError:
+            raise AppError("Limit and offset must be integers", 400)
+        if not (1 <= limit <= max_limit):
+            raise AppError(f"Limit must be between 1 and {max_limit}", 400)
+        if offset < 0:
+            raise AppError("Offset must be non-negative", 400)
+        return limit, offset
+
+    @timed("filter")
+    def query(self, args, max_limit=1000):
+        """Parse the parameters of ``GET /documents/<collection>`` into ``query_documents`` arguments."""
+        plan = self.plan(args, ordered=True)
+        filters = plan.bind(args)
+        limit, offset = FilterBuilder.pagination(args, max_limit)
+        return {
+            "filters": filters,
+            "orders": list(plan.orders),
+            "limit": limit,
+            "offset": offset,
+            "page_token": args.get("page_token") or None,
+            "fields": list(plan.fields) if plan.fields else None,
+        }
+
+    # Parameters of GET /documents/<collection>:aggregate that select aggregations
+    AGGREGATION_PARAMS = ("count", "sum", "avg")
+
+    @timed("filter")
+    def aggregations(self, args):
+        """Parse the parameters of ``GET /documents/<collection>:aggregate`` into ``aggregate`` arguments."""
+        def field_list(param):
+            return [f.strip() for value in args.getlist(param) for f in value.split(",") if f.strip()]
+
+        return {
+            "filters": self.plan(args, exclude=FilterBuilder.AGGREGATION_PARAMS).bind(args),
+            "count": "count" in args and args["count"].lower() not in ("false", "0"),
+            "sums": field_list("sum"),
+            "avgs": field_list("avg"),
+        }
+
+    @staticmethod
+    def projection(args):
+        """Return the field paths requested via ``fields``, or None for whole documents."""
+        fields = args.get("fields")
+        if not fields:
+            return None
+        return [f.strip() for f in fields.split(",") if f.strip()] or None
+
+
+# --- Request Bodies ---
+
+class RequestBody:
+    """Validation of the JSON bodies accepted by the batch endpoints.
+
+    Shared by the Flask and ASGI apps, which only differ in how the body is read.
+    """
+
+    @staticmethod
+    def operations(body, max_operations):
+        operations = body.get("operations") if isinstance(body, dict) else None
+        if not isinstance(operations, list) or not operations:
+            raise AppError("Request body must contain a non-empty 'operations' list", 400)
+        if len(operations) > max_operations:
+            raise AppError(f"A batch may contain at most {max_operations} operations", 400)
+        return operations, bool(body.get("atomic", False))
+
+    SUB_REQUEST_METHODS = ("GET", "POST", "PUT", "DELETE")
+    # Response headers passed through for each sub-request of POST /batch
+    SUB_RESPONSE_HEADERS = ("ETag", "Last-Modified", "Retry-After")
+
+    @classmethod
+    def sub_requests(cls, body, max_requests):
+        """Validate a ``POST /batch`` body; returns ``[(method, path, json_body, headers)]``.
+
+        Sub-requests use the existing routes. Streaming routes (``:watch``) and
+        nested batches are rejected, and ``Accept-Encoding`` is dropped so each
+        result can be embedded as JSON. Sub-requests without their own
+        ``X-Request-Deadline`` get the batch's remaining deadline.
+        """
+        requests = body.get("requests") if isinstance(body, dict) else None
+        if not isinstance(requests, list) or not requests:
+            raise AppError("Request body must contain a non-empty 'requests' list", 400)
+        if len(requests) > max_requests:
+            raise AppError(f"A batch may contain at most {max_requests} requests", 400)
+        parsed = []
+        for index, sub in enumerate(requests):
+            if not isinstance(sub, dict):
+                raise AppError(f"Request {index} must be an object", 400)
+            method = str(sub.get("method", "GET")).upper()
+            if method not in cls.SUB_REQUEST_METHODS:
+                raise AppError(f"Request {index}: method must be one of {', '.join(cls.SUB_REQUEST_METHODS)}", 400)
+            path = sub.get("path")
+            if not isinstance(path, str) or not path.startswith("/"):
+                raise AppError(f"Request {index}: path must be an absolute path such as /documents/users/u1", 400)
+            route = path.split("?", 1)[0]
+            if route.rstrip("/") == "/batch" or route.endswith(":watch"):
+                raise AppError(f"Request {index}: {route} cannot be used inside a batch", 400)
+            headers = sub.get("headers") or {}
+            if not isinstance(headers, dict) or not all(isinstance(v, str) for v in headers.values()):
+                raise AppError(f"Request {index}: headers must be an object of strings", 400)
+            headers = {k: v for k, v in headers.items() if k.lower() != "accept-encoding"}
+            parsed.append((method, path, sub.get("body"), RequestDeadline.propagate(headers)))
+        return parsed
+
+    @classmethod
+    def sub_response(cls, status, body, headers=None):
+        result = {"status": status, "body": body}
+        passed = {name: headers[name] for name in cls.SUB_RESPONSE_HEADERS if headers and name in headers}
+        if passed:
+            result["headers"] = passed
+        return result
+
+    @classmethod
+    def streamed_sub_response(cls):
+        message = "Streaming responses cannot be used inside a batch"
+        return cls.sub_response(400, {"status": "error", "message": message})
+
+    @staticmethod
+    def multiplex_response(results):
+        return {
+            "status": "success",
+            "data": results,
+            "count": len(results),
+            "failed": sum(1 for r in results if r["status"] >= 400)
+        }
+
+    @staticmethod
+    def increment(body):
+        """The ``by`` amount of a counter increment; 1 when there is no body."""
+        if body is None:
+            return 1
+        amount = body.get("by", 1) if isinstance(body, dict) else None
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+            raise AppError("'by' must be a number", 400)
+        return amount
+
+    @staticmethod
+    def ids(body):
+        ids = body.get("ids") if isinstance(body, dict) else None
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, str) and i and "/" not in i for i in ids):
+            raise AppError("Request body must contain a non-empty 'ids' list of document IDs", 400)
+        return ids
+
+    @staticmethod
+    def paths(body):
+        paths = body.get("paths") if isinstance(body, dict) else None
+        if not isinstance(paths, list) or not paths or not all(isinstance(p, str) and p for p in paths):
+            raise AppError("Request body must contain a non-empty 'paths' list of 'collection/doc_id' paths", 400)
+        return paths
+
+    @staticmethod
+    def batch_get(body, paths, max_documents):
+        """Validate a batchGet request; returns the optional ``fields`` projection."""
+        if len(paths) > max_documents:
+            raise AppError(f"A batch may contain at most {max_documents} documents", 400)
+        fields = body.get("fields") if isinstance(body, dict) else None
+        if fields is not None and (not isinstance(fields, list) or not all(isinstance(f, str) for f in fields)):
+            raise AppError("'fields' must be a list of field paths", 400)
+        return fields or None
+
+    @staticmethod
+    def batch_get_response(ids, docs):
+        return {
+            "status": "success",
+            "data": docs,
+            "count": sum(1 for doc in docs if doc is not None),
+            "missing": [doc_id for doc_id, doc in zip(ids, docs) if doc is None]
+        }
+
+    @staticmethod
+    def batch_write_response(results):
+        failed = sum(1 for r in results if r["status"] == "error")
+        return {
+            "status": "success",
+            "data": results,
+            "count": len(results),
+            "succeeded": len(results) - failed,
+            "failed": failed
+        }
+
+
+# --- Endpoints ---
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+SSE_MIMETYPE = "text/event-stream"
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+class Endpoints:
+    """Request parsing and response shaping of the API routes.
+
+    Shared by the Flask and ASGI apps, whose routes only call the Firestore
+    client, read request bodies and stream responses. ``app`` and ``req`` are
+    the current app and request of either framework.
+    """
+
+    ROOT = {"status": "success", "message": "Firestore Adapter service is running.", "documentation": "/openapi.yaml"}
+    HEALTHY = {"status": "success", "message": "Service is healthy."}
+    READY = {"status": "success", "message": "Service is ready."}
+
+    @staticmethod
+    def flag(args, name):
+        return args.get(name, "").lower() == "true"
+
+    @staticmethod
+    def data(data):
+        return {"status": "success", "data": data}
+
+    @staticmethod
+    def created(result):
+        return Endpoints.data(result), 201
+
+    @staticmethod
+    @contextmanager
+    def readiness():
+        """Report a failed warm-up of the Firestore client as 503."""
+        try:
+            yield
+        except Exception as e:
+            logging.warning("Warmup failed: %r", e)
+            raise AppError("Firestore is not ready", 503)
+
+    @staticmethod
+    @contextmanager
+    def missing_document():
+        """Report a write to a document that does not exist as 404."""
+        try:
+            yield
+        except GoogleNotFound:
+            raise AppError("Document not found", 404)
+
+    @staticmethod
+    def stats(app):
+        client = app.extensions["firestore_client"]
+        return Endpoints.data({
+            "cache": client.cache.stats() if client.cache is not None else None,
+            "coalescing": client.flights.stats() if client.flights is not None else None,
+            "query_plans": app.extensions["filter_builder"].plan_cache_stats(),
+            "watches": app.extensions["watch_hub"].stats(),
+            "admission": app.extensions["admission"].stats()
+        })
+
+    @staticmethod
+    def query(app, req):
+        """Parse ``GET /documents/<collection>``; returns ``(stream, query, with_total)``.
+
+        NDJSON streaming is negotiated via the Accept header or ``?stream=true``.
+        """
+        stream = Endpoints.flag(req.args, "stream") or req.accept_mimetypes.best == NDJSON_MIMETYPE
+        max_limit = app.config["STREAM_MAX_LIMIT"] if stream else 1000
+        query = app.extensions["filter_builder"].query(req.args, max_limit)
+        return stream, query, Endpoints.flag(req.args, "with_total")
+
+    @staticmethod
+    def ndjson(app, doc):
+        return app.json.dumps(doc) + "\n"
+
+    @staticmethod
+    def stream_error(app, error):
+        """The record that ends an NDJSON stream once its status line has been sent."""
+        return Endpoints.ndjson(app, {"status": "error", "message": error.message})
+
+    @staticmethod
+    def page(app, req, query, with_total, result):
+        """The response for a ``query_documents`` result; 304 when the client's copy is current."""
+        data, next_page_token, total, version = result
+        if DocumentVersion.not_modified(req, version):
+            return DocumentVersion.conditional(app.response_class(status=304), version)
+        response = {
+            "status": "success",
+            "data": data,
+            "limit": query["limit"],
+            "offset": query["offset"],
+            "count": len(data),
+            "next_page_token": next_page_token
+        }
+        if with_total:
+            response["total"] = total
+        return DocumentVersion.conditional(app.json.response(response), version)
+
+    @staticmethod
+    def subscribe(app, req, collection, **kwargs):
+        """Subscribe to the change feed of ``collection``, resuming from ``Last-Event-ID`` or ``?resume_token``."""
+        filters = app.extensions["filter_builder"].build(req.args)
+        resume_token = req.headers.get("Last-Event-ID") or req.args.get("resume_token")
+        return app.extensions["watch_hub"].subscribe(collection, filters, resume_token, **kwargs)
+
+    @staticmethod
+    def aggregations(app, req):
+        return app.extensions["filter_builder"].aggregations(req.args)
+
+    @staticmethod
+    def subcollection_query(app, req):
+        """Parse a subcollection group query; returns ``(filters, limit, offset, include_parent)``."""
+        filters = app.extensions["filter_builder"].build(req.args, prefix="subcollection_")
+        limit, offset = FilterBuilder.pagination(req.args)
+        return filters, limit, offset, Endpoints.flag(req.args, "include_parent")
+
+    @staticmethod
+    def subcollections(collection, subcollection, limit, offset, result):
+        data, total_found = result
+        return {
+            "status": "success",
+            "data": data,
+            "limit": limit,
+            "offset": offset,
+            "count": len(data),
+            "total_found": total_found,
+            "collection": collection,
+            "subcollection": subcollection
+        }
+
+    @staticmethod
+    def document(app, req, result):
+        """The response for a ``read_document`` result; 304 when the client's copy is current."""
+        doc, update_time = result
+        if not doc:
+            raise GoogleNotFound("Document not found")
+        etag = DocumentVersion.etag(update_time)
+        if DocumentVersion.not_modified(req, etag, update_time):
+            return DocumentVersion.conditional(app.response_class(status=304), etag, update_time)
+        return DocumentVersion.conditional(app.json.response(Endpoints.data(doc)), etag, update_time)
+
+    @staticmethod
+    def update_options(req):
+        """``update_document`` options from ``?return=representation``, ``If-Match`` and ``?merge``."""
+        return {
+            "return_document": req.args.get("return") == "representation",
+            "if_match": DocumentVersion.from_if_match(req.if_match),
+            "merge": Endpoints.flag(req.args, "merge")
+        }
+
+    @staticmethod
+    def updated(app, result):
+        updated, update_time = result
+        response = app.json.response(Endpoints.data(updated))
+        return DocumentVersion.conditional(response, DocumentVersion.etag(update_time))
+
+
+def register_services(app, client_class, listener_db):
+    """Create the Firestore client and the services shared by its requests from ``app.config``.
+
+    ``listener_db(client)`` returns the synchronous client that snapshot
+    listeners (cache watches and ``:watch`` change feeds) run on. The client
+    is stored as ``app.extensions["firestore_client"]`` and returned.
+    """
+    cache = None
+    if app.config["CACHE_ENABLED"]:
+        cache = DocumentCache(
+            max_entries=app.config["CACHE_MAX_ENTRIES"],
+            default_ttl=app.config["CACHE_DEFAULT_TTL"],
+            collection_ttls=app.config["CACHE_COLLECTION_TTLS"]
+        )
+    counters = ShardedCounters(
+        default_shards=app.config["COUNTER_SHARDS"],
+        shard_counts=app.config["COUNTER_SHARD_COUNTS"],
+        cache_ttl=app.config["COUNTER_CACHE_TTL"]
+    )
+    policy = RpcPolicy(
+        deadline=app.config["RPC_DEADLINE"],
+        initial_backoff=app.config["RPC_RETRY_INITIAL"],
+        max_backoff=app.config["RPC_RETRY_MAXIMUM"],
+        retry_after=app.config["RETRY_AFTER_SECONDS"]
+    )
+    firestore_client = client_class(
+        app.config["FIRESTORE_CREDENTIALS"], cache=cache, coalesce=app.config["COALESCE_READS"],
+        counters=counters, policy=policy
+    )
+    app.extensions["firestore_client"] = firestore_client
+    app.extensions["filter_builder"] = FilterBuilder()
+    app.extensions["admission"] = AdmissionControl(
+        per_api_key=app.config["CONCURRENCY_PER_API_KEY"],
+        per_collection=app.config["CONCURRENCY_PER_COLLECTION"],
+        retry_after=app.config["RETRY_AFTER_SECONDS"]
+    )
+    if cache is not None:
+        cache.watch_on_first_use(lambda: listener_db(firestore_client), app.config["CACHE_WATCH_COLLECTIONS"])
+
+    # Shared snapshot listeners for :watch change feeds, started on first use
+    app.extensions["watch_hub"] = WatchHub(
+        lambda: listener_db(app.extensions["firestore_client"]),
+        dumps=app.json.dumps,
+        replay_size=app.config["WATCH_REPLAY_SIZE"],
+        queue_size=app.config["WATCH_QUEUE_SIZE"],
+        linger=app.config["WATCH_LINGER_SECONDS"],
+        max_streams=app.config["WATCH_MAX_STREAMS"],
+        retry_after=app.config["RETRY_AFTER_SECONDS"]
+    )
+    return firestore_client
+
+
+# --- Page Cursors ---
+
+class PageCursor:
+    """Opaque page tokens built on Firestore ``start_after`` cursors.
+
+    A token records the values of the active ordering fields for the last
+    document of a page, ending with the document id, so the next page can be
+    resumed server-side instead of re-reading and skipping documents.
+    """
+
+    DOCUMENT_ID = "__name__"
+    INEQUALITY_OPS = (">", ">=", "<", "<=", "!=", "not-in")
+
+    @staticmethod
+    def orders(filters, order_by=None):
+        """Return the full (field, direction) ordering used for cursors.
+
+        Explicit ``order_by`` fields come first. Without them, Firestore
+        implicitly orders by the first inequality field, so that is made
+        explicit here. The document id is always appended as a tie-breaker in
+        the direction of the last ordering, matching Firestore's own implicit
+        ordering so no additional index is required.
+        """
+        orders = []
+        if order_by:
+            for field in order_by.split(","):
+                field = field.strip()
+                if not field:
+                    continue
+                direction = firestore.Query.DESCENDING if field.startswith("-") else firestore.Query.ASCENDING
+                orders.append((field.lstrip("-"), direction))
+        else:
+            for field, op, _ in filters:
+                if op in PageCursor.INEQUALITY_OPS:
+                    orders.append((field, firestore.Query.ASCENDING))
+                    break
+
+        if not orders or orders[-1][0] != PageCursor.DOCUMENT_ID:
+            direction = orders[-1][1] if orders else firestore.Query.ASCENDING
+            orders.append((PageCursor.DOCUMENT_ID, direction))
+        return orders
+
+    @staticmethod
+    def encode(orders, snapshot):
+        """Build the token that resumes after ``snapshot``.
+
+        Values keep their Firestore type (see ``TypedValue``), so pages can be
+        ordered by timestamps, references, geo points, bytes or maps.
+        """
+        fields = [field for field, _ in orders]
+        values = [snapshot.id if field == PageCursor.DOCUMENT_ID else snapshot.get(field) for field in fields]
+        payload = json.dumps({"o": fields, "v": [TypedValue.encode(value) for value in values]}, separators=(",", ":"))
+        return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode(token, orders, db):
+        """Return the ``start_after`` cursor dict for ``token``; references resolve in ``db``.
+
+        Raises ``AppError`` (400) if the token is malformed or was issued for a
+        different ordering.
+        """
+        try:
+            padded = token + "=" * (-len(token) % 4)
+            payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+            fields = payload["o"]
+            values = [TypedValue.decode(value, db) for value in payload["v"]]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise AppError("Invalid page_token", 400)
+
+        if fields != [field for field, _ in orders] or len(values) != len(fields):
+            raise AppError("page_token does not match the requested ordering", 400)
+        return dict(zip(fields, values))
+
+
+# --- Document Versions ---
+
+class DocumentVersion:
+    """Strong ETags derived from a document's Firestore ``update_time``."""
+
+    @staticmethod
+    def etag(update_time):
+        """Return the ETag value for ``update_time`` (None when unknown)."""
+        return update_time.rfc3339() if update_time is not None else None
+
+    @staticmethod
+    def parse(etag):
+        """Return the ``update_time`` encoded in ``etag``.
+
+        Raises ``AppError`` (400) if the value is not an ETag issued by this service.
+        """
+        try:
+            return DatetimeWithNanoseconds.from_rfc3339(etag)
+        except ValueError:
+            raise AppError("Invalid ETag", 400)
+
+    @staticmethod
+    def page(docs, total=None):
+        """Return a strong ETag value for a query page.
+
+        It is a digest of the ``(id, update_time)`` pairs of the page's
+        snapshots, in order, plus ``total`` when it was counted, so it changes
+        whenever a document on the page is written, added or removed.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for doc in docs:
+            digest.update(f"{doc.id}\0{DocumentVersion.etag(doc.update_time)}\n".encode("utf-8"))
+        if total is not None:
+            digest.update(f"total\0{total}".encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _representations(etag):
+        """The ETag and its compressed variants (see ``ResponseCompression``)."""
+        return [etag] + [f"{etag}-{encoding}" for encoding in ResponseCompression.ENCODINGS]
+
+    @staticmethod
+    def not_modified(req, etag, last_modified=None):
+        """Return True when a conditional GET can be answered with 304 Not Modified.
+
+        ``If-None-Match`` takes precedence over ``If-Modified-Since``, which is
+        compared at the one-second resolution of HTTP dates.
+        """
+        if req.if_none_match:
+            return etag is not None and any(
+                req.if_none_match.contains_weak(tag) for tag in DocumentVersion._representations(etag)
+            )
+        if req.if_modified_since and last_modified is not None:
+            return int(last_modified.timestamp()) <= req.if_modified_since.timestamp()
+        return False
+
+    @staticmethod
+    def conditional(response, etag, last_modified=None):
+        """Set the ``ETag`` and ``Last-Modified`` validators on ``response``."""
+        if etag:
+            response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        return response
+
+    @staticmethod
+    def from_if_match(etags):
+        """Return the ``update_time`` precondition for an ``If-Match`` header, or None.
+
+        ``*`` and an absent header add no version check, since updates and
+        deletes already require the document to exist.
+        """
+        if not etags or etags.star_tag:
+            return None
+        strong = etags.as_set()
+        if len(strong) != 1:
+            raise AppError("If-Match must contain exactly one strong ETag", 412)
+        etag = next(iter(strong))
+        for encoding in ResponseCompression.ENCODINGS:
+            etag = etag.removesuffix(f"-{encoding}")
+        return DocumentVersion.parse(etag)
+
+
+# --- Response Compression ---
+
+class ResponseCompression:
+    """gzip/br compression of large response bodies, negotiated through ``Accept-Encoding``.
+
+    br is only offered when the optional ``brotli`` package is installed.
+    Compressed responses get the ETag suffixed with the encoding, since a
+    strong ETag must differ between representations.
+    """
+
+    ENCODINGS = ("br", "gzip")
+    MIMETYPES = {"application/json"}
+    GZIP_LEVEL = 6
+    BROTLI_QUALITY = 5
+
+    @staticmethod
+    def encoding(accept_encodings):
+        """Return the client's preferred supported encoding, or None."""
+        offered = [e for e in ResponseCompression.ENCODINGS if e != "br" or brotli is not None]
+        return accept_encodings.best_match(offered)
+
+    @staticmethod
+    def compress(body, encoding):
+        if encoding == "br":
+            return brotli.compress(body, quality=ResponseCompression.BROTLI_QUALITY)
+        return gzip.compress(body, compresslevel=ResponseCompression.GZIP_LEVEL)
+
+    @staticmethod
+    def apply(response, body, accept_encodings, min_size):
+        """Compress ``response`` in place when it is eligible.
+
+        ``body`` is the response's data, or None for streamed responses,
+        which are never compressed.
+        """
+        if (body is None or response.status_code != 200 or "Content-Encoding" in response.headers
+                or response.mimetype not in ResponseCompression.MIMETYPES or len(body) < min_size):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = ResponseCompression.encoding(accept_encodings)
+        if encoding is None:
+            return response
+        with timing("compress"):
+            response.set_data(ResponseCompression.compress(body, encoding))
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+        return response
+
+
+def register_compression(app):
+    """Compress eligible responses of a Flask app (register after ``register_instrumentation``)."""
+    if not app.config["COMPRESSION_ENABLED"]:
+        return
+
+    @app.after_request
+    def compress_response(response):
+        body = None if response.is_streamed else response.get_data()
+        return ResponseCompression.apply(response, body, request.accept_encodings, app.config["COMPRESSION_MIN_SIZE"])
+
+
+# --- Change Feeds ---
+
+class WatchListener:
+    """One shared ``on_snapshot`` listener for a (collection, filters) query.
+
+    Every change becomes an SSE frame that is formatted once and fanned out
+    to all subscribers. Frames are numbered; the last ``replay_size`` are kept
+    so a reconnecting client can resume from the id of the last event it saw.
+    Ids are ``<epoch>.<seq>``, where the epoch is unique to this listener, so
+    ids from an earlier listener or another instance are never mistaken for
+    positions in this one.
+    """
+
+    def __init__(self, hub, key, query):
+        self.hub = hub
+        self.key = key
+        self.epoch = base64.urlsafe_b64encode(os.urandom(6)).decode("ascii")
+        self.seq = 0
+        self.ready = False
+        self.documents = {}
+        self.replay = deque(maxlen=hub.replay_size)
+        self.subscribers = set()
+        self.idle_timer = None
+        self.watch = query.on_snapshot(self._on_snapshot)
+
+    def token(self, seq=None):
+        return f"{self.epoch}.{self.seq if seq is None else seq}"
+
+    def _frame(self, event, data=None, seq=None):
+        lines = [f"id: {self.token(seq)}"] if seq is not None else []
+        lines.append(f"event: {event}")
+        lines.append(f"data: {self.hub.dumps(data if data is not None else {})}")
+        return "\n".join(lines) + "\n\n"
+
+    def _on_snapshot(self, docs, changes, read_time):
+        # Runs on the listener's background thread
+        with self.hub.lock:
+            frames = []
+            for change in changes:
+                doc = change.document
+                event = change.type.name.lower()
+                if event == "removed":
+                    self.documents.pop(doc.id, None)
+                    data = {"id": doc.id}
+                else:
+                    document = BaseFirestoreClient._document_dict(doc)
+                    self.documents[doc.id] = (document, doc.update_time)
+                    data = {"id": doc.id, "data": document, "update_time": DocumentVersion.etag(doc.update_time)}
+                self.seq += 1
+                frame = (self.seq, self._frame(event, data, self.seq))
+                self.replay.append(frame)
+                frames.append(frame)
+            self.ready = True
+            self.hub.events += len(frames)
+            for subscriber in list(self.subscribers):
+                for frame in frames:
+                    subscriber.offer(frame)
+                if not subscriber.synced:
+                    subscriber.offer((self.seq, self._frame("sync", {"token": self.token()}, self.seq)))
+                    subscriber.synced = True
+
+    def snapshot_frames(self, reset=False):
+        """Frames that bring a new or lagging subscriber to the current state (caller holds the hub lock)."""
+        frames = [self._frame("reset")] if reset else []
+        for doc_id, (document, update_time) in self.documents.items():
+            data = {"id": doc_id, "data": document, "update_time": DocumentVersion.etag(update_time)}
+            frames.append(self._frame("added", data))
+        if self.ready:
+            frames.append(self._frame("sync", {"token": self.token()}, self.seq))
+        return frames
+
+    def resume_frames(self, token):
+        """Frames after ``token``, or None if they are no longer retained (caller holds the hub lock)."""
+        epoch, _, seq = (token or "").partition(".")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self.seq:
+            return None
+        seq = int(seq)
+        oldest = self.replay[0][0] if self.replay else self.seq + 1
+        if seq + 1 < oldest:
+            return None
+        return [frame for frame_seq, frame in self.replay if frame_seq > seq]
+
+    def close(self):
+        self.watch.unsubscribe()
+
+
+class WatchSubscription(ABC):
+    """A subscriber's bounded queue of ``(seq, frame)`` items.
+
+    ``pending`` holds the frames that catch the client up (the current state
+    or the frames after its resume token); they are sent before anything
+    queued. If the client falls more than ``queue_size`` frames behind, its
+    backlog is replaced by a reset: a ``reset`` event and the current state.
+    """
+
+    RESET = (None, None)
+
+    def __init__(self, hub, listener, queue_size):
+        self.hub = hub
+        self.listener = listener
+        self.queue_size = queue_size
+        self.pending = []
+        self.synced = False
+        # Queued frames up to this sequence number are already covered by ``pending`` or a resync
+        self.skip_through = 0
+
+    @abstractmethod
+    def offer(self, item):
+        """Queue ``item``; called with the hub lock held, from the listener thread."""
+
+    @abstractmethod
+    def events(self, heartbeat):
+        """Yield SSE text, with a comment line every ``heartbeat`` seconds without events."""
+
+    def _next(self, item):
+        """Turn a queued item into the frames to send, resynchronizing after an overflow."""
+        seq, frame = item
+        if frame is None:
+            with self.hub.lock:
+                self.hub.resets += 1
+                self.synced = self.listener.ready
+                self.skip_through = self.listener.seq
+                return self.listener.snapshot_frames(reset=True)
+        return [] if seq <= self.skip_through else [frame]
+
+    def close(self):
+        """Stop receiving events; safe to call more than once."""
+        self.hub.unsubscribe(self)
+
+
+class ThreadWatchSubscription(WatchSubscription):
+    """Subscription consumed by a blocking generator (Flask)."""
+
+    def __init__(self, hub, listener, queue_size):
+        super().__init__(hub, listener, queue_size)
+        self.queue = queue.Queue(maxsize=queue_size)
+
+    def offer(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put_nowait(self.RESET)
+
+    def events(self, heartbeat):
+        try:
+            yield from self.pending
+            while True:
+                try:
+                    item = self.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield from self._next(item)
+        finally:
+            self.close()
+
+
+class AsyncWatchSubscription(WatchSubscription):
+    """Subscription consumed by an async generator on ``loop`` (Quart)."""
+
+    def __init__(self, hub, listener, queue_size, loop):
+        super().__init__(hub, listener, queue_size)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def offer(self, item):
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self._put, item)
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(self.RESET)
+
+    async def events(self, heartbeat):
+        try:
+            for frame in self.pending:
+                yield frame
+            while True:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                for frame in self._next(item):
+                    yield frame
+        finally:
+            self.close()
+
+
+class WatchHub:
+    """Shares one snapshot listener per distinct watched query across all subscribers.
+
+    ``db_factory`` returns the synchronous Firestore client the listeners run
+    on; it is only called when the first watch starts. A listener outlives its
+    last subscriber by ``linger`` seconds, so clients that reconnect quickly
+    can resume instead of receiving the full state again.
+
+    At most ``max_streams`` subscriptions are open at once (0 for no limit);
+    further subscribes are rejected with a 503 and a Retry-After header.
+    """
+
+    def __init__(self, db_factory, dumps=json.dumps, replay_size=1000, queue_size=1000, linger=60.0,
+                 max_streams=0, retry_after=1):
+        self.db_factory = db_factory
+        self.dumps = dumps
+        self.replay_size = replay_size
+        self.queue_size = queue_size
+        self.linger = linger
+        self.max_streams = max_streams
+        self.retry_after = retry_after
+        self.streams = 0
+        self.rejected = 0
+        self.lock = threading.RLock()
+        self._db = None
+        self._listeners = {}
+        self.events = 0
+        self.resumed = 0
+        self.resets = 0
+
+    def subscribe(self, collection, filters, resume_token=None, loop=None):
+        """Subscribe to a query; returns a subscription whose ``events()`` yields SSE text.
+
+        With ``loop`` the subscription is consumed from that asyncio event loop.
+        """
+        key = flight_key(collection, filters)
+        with self.lock:
+            if self.max_streams and self.streams >= self.max_streams:
+                self.rejected += 1
+                raise AppError("Too many open watch streams", 503, {"Retry-After": str(self.retry_after)})
+            listener = self._listeners.get(key)
+            if listener is None:
+                if self._db is None:
+                    self._db = self.db_factory()
+                query = BaseFirestoreClient._where(self._db.collection(collection), filters)
+                listener = self._listeners[key] = WatchListener(self, key, query)
+                logging.info("Started watch on %s with %d filters", collection, len(filters))
+            if listener.idle_timer is not None:
+                listener.idle_timer.cancel()
+                listener.idle_timer = None
+
+            if loop is None:
+                subscription = ThreadWatchSubscription(self, listener, self.queue_size)
+            else:
+                subscription = AsyncWatchSubscription(self, listener, self.queue_size, loop)
+            frames = listener.resume_frames(resume_token) if resume_token else None
+            if frames is not None:
+                self.resumed += 1
+            else:
+                frames = listener.snapshot_frames(reset=bool(resume_token))
+            subscription.synced = listener.ready
+            subscription.pending = frames
+            subscription.skip_through = listener.seq
+            listener.subscribers.add(subscription)
+            self.streams += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        listener = subscription.listener
+        with self.lock:
+            if subscription not in listener.subscribers:
+                return
+            listener.subscribers.remove(subscription)
+            self.streams -= 1
+            if listener.subscribers:
+                return
+            if self.linger <= 0:
+                self._close(listener)
+                return
+            listener.idle_timer = threading.Timer(self.linger, self._close_if_idle, (listener,))
+            listener.idle_timer.daemon = True
+            listener.idle_timer.start()
+
+    def _close_if_idle(self, listener):
+        with self.lock:
+            listener.idle_timer = None
+            if not listener.subscribers:
+                self._close(listener)
+
+    def _close(self, listener):
+        if self._listeners.get(listener.key) is listener:
+            del self._listeners[listener.key]
+        listener.close()
+        logging.info("Stopped watch on %s", listener.key[0])
+
+    def close(self):
+        with self.lock:
+            for listener in list(self._listeners.values()):
+                if listener.idle_timer is not None:
+                    listener.idle_timer.cancel()
+                self._close(listener)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "listeners": len(self._listeners),
+                "subscribers": sum(len(listener.subscribers) for listener in self._listeners.values()),
+                "events": self.events,
+                "resumed": self.resumed,
+                "resets": self.resets,
+                "rejected": self.rejected,
+            }
+
+
+# --- Collection Export and Import ---
+
+class TypedValue:
+    """Lossless JSON for Firestore values, in the Firestore REST (proto3 JSON) ``Value`` format.
+
+    The API's plain JSON turns timestamps, bytes, references and geo points
+    into strings and objects; exports keep the type so an import writes back
+    exactly the values that were read.
+    """
+
+    _SPECIAL_DOUBLES = {"nan": "NaN", "inf": "Infinity", "-inf": "-Infinity"}
+
+    @classmethod
+    def encode_fields(cls, data):
+        return {key: cls.encode(value) for key, value in data.items()}
+
+    @classmethod
+    def encode(cls, value):
+        if value is None:
+            return {"nullValue": None}
+        if isinstance(value, bool):
+            return {"booleanValue": value}
+        if isinstance(value, int):
+            return {"integerValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value if math.isfinite(value) else cls._SPECIAL_DOUBLES[repr(value)]}
+        if isinstance(value, str):
+            return {"stringValue": value}
+        if isinstance(value, dict):
+            return {"mapValue": {"fields": cls.encode_fields(value)}}
+        if isinstance(value, (list, tuple)):
+            return {"arrayValue": {"values": [cls.encode(v) for v in value]}}
+        if isinstance(value, DatetimeWithNanoseconds):
+            return {"timestampValue": value.rfc3339()}
+        if isinstance(value, datetime):
+            # Naive datetimes are UTC, as in the client library
+            value = value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+            return {"timestampValue": value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")}
+        if isinstance(value, bytes):
+            return {"bytesValue": base64.b64encode(value).decode("ascii")}
+        if isinstance(value, firestore.GeoPoint):
+            return {"geoPointValue": {"latitude": value.latitude, "longitude": value.longitude}}
+        if isinstance(value, BaseDocumentReference):
+            return {"referenceValue": value.path}
+        raise TypeError(f"Cannot export value of type {type(value).__name__}")
+
+    @classmethod
+    def decode_fields(cls, fields, db):
+        return {key: cls.decode(value, db) for key, value in fields.items()}
+
+    @classmethod
+    def decode(cls, value, db):
+        (kind, inner), = value.items()
+        if kind == "mapValue":
+            return cls.decode_fields(inner.get("fields", {}), db)
+        if kind == "arrayValue":
+            return [cls.decode(v, db) for v in inner.get("values", [])]
+        if kind == "nullValue":
+            return None
+        if kind == "booleanValue":
+            return inner
+        if kind == "integerValue":
+            return int(inner)
+        if kind == "doubleValue":
+            return float(inner)
+        if kind == "stringValue":
+            return inner
+        if kind == "timestampValue":
+            return DatetimeWithNanoseconds.from_rfc3339(inner)
+        if kind == "bytesValue":
+            return base64.b64decode(inner)
+        if kind == "geoPointValue":
+            return firestore.GeoPoint(inner.get("latitude", 0.0), inner.get("longitude", 0.0))
+        if kind == "referenceValue":
+            # Resolved in the target database, so an export can be imported into another project;
+            # full resource names ("projects/.../documents/...") are accepted as well as relative paths
+            if inner.startswith("projects/"):
+                inner = inner.split("/documents/", 1)[1]
+            return db.document(inner)
+        raise ValueError(f"Unknown value type {kind!r}")
+
+
+def _ndjson_line(obj):
+    if orjson is not None:
+        return orjson.dumps(obj) + b"\n"
+    return json.dumps(obj, separators=(",", ":")).encode() + b"\n"
+
+
+def _ndjson_loads(line):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+
+class CollectionExporter:
+    """Export a collection as gzip-compressed NDJSON chunks described by a manifest.
+
+    The collection is split with a partition query and the partitions are
+    streamed concurrently on a thread pool. Each partition writes its own
+    chunk files as documents arrive, so memory use does not grow with the
+    collection. Each line is ``{"id": ..., "fields": ...}`` with TypedValue
+    fields. The manifest is written last: a directory without one is an
+    incomplete export.
+    """
+
+    MANIFEST = "manifest.json"
+    FORMAT = "firestore-ndjson/1"
+    # Lines are compressed in blocks rather than one write per document
+    WRITE_BLOCK = 500
+
+    def __init__(self, db, partitions=32, workers=8, chunk_documents=100000, compresslevel=6):
+        self.db = db
+        self.partitions = partitions
+        self.workers = workers
+        self.chunk_documents = chunk_documents
+        self.compresslevel = compresslevel
+
+    def run(self, collection, directory):
+        start = time.perf_counter()
+        os.makedirs(directory, exist_ok=True)
+        # Partition queries only exist for collection groups; documents of other
+        # collections with the same id are skipped while streaming.
+        group = self.db.collection_group(collection.rsplit("/", 1)[-1])
+        partitions = list(group.get_partitions(self.partitions))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            chunks = pool.map(
+                lambda item: self._export_partition(collection, directory, *item), enumerate(partitions)
+            )
+            files = [chunk for partition in chunks for chunk in partition]
+
+        manifest = {
+            "format": self.FORMAT,
+            "collection": collection,
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+            "partitions": len(partitions),
+            "documents": sum(f["documents"] for f in files),
+            "bytes": sum(f["bytes"] for f in files),
+            "files": files,
+        }
+        path = os.path.join(directory, self.MANIFEST)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(path + ".tmp", path)
+        logging.info("Exported %d documents from %s in %d partitions (%.1f s)",
+                     manifest["documents"], collection, len(partitions), time.perf_counter() - start)
+        return manifest
+
+    def _export_partition(self, collection, directory, index, partition):
+        files, block, out, count = [], [], None, 0
+
+        def close():
+            out.write(b"".join(block))
+            block.clear()
+            out.close()
+            files.append({"name": name, "documents": count,
+                          "bytes": os.path.getsize(os.path.join(directory, name))})
+
+        for doc in partition.query().stream():
+            if doc.reference.path.rsplit("/", 1)[0] != collection:
+                continue
+            if out is None or count == self.chunk_documents:
+                if out is not None:
+                    close()
+                name, count = f"{index:05d}-{len(files):04d}.ndjson.gz", 0
+                out = gzip.open(os.path.join(directory, name), "wb", compresslevel=self.compresslevel)
+            block.append(_ndjson_line({"id": doc.id, "fields": TypedValue.encode_fields(doc.to_dict())}))
+            count += 1
+            if len(block) == self.WRITE_BLOCK:
+                out.write(b"".join(block))
+                block.clear()
+        if out is not None:
+            close()
+        return files
+
+
+class CollectionImporter:
+    """Write an export back into Firestore with a BulkWriter.
+
+    The BulkWriter batches writes, sends batches in parallel, ramps up from
+    ``initial_ops_per_second`` by 50% every five minutes (Firestore's 500/50/5
+    rule) up to ``max_ops_per_second``, and retries transient failures.
+    Failures that are not retryable, or still fail after ``max_attempts``, are
+    reported instead of aborting the import.
+    """
+
+    RETRYABLE = frozenset(code.value[0] for code in (
+        grpc.StatusCode.ABORTED, grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.INTERNAL,
+        grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.UNAVAILABLE
+    ))
+    # Failed writes listed in the result; the rest are only counted
+    MAX_REPORTED_ERRORS = 100
+
+    def __init__(self, db, initial_ops_per_second=500, max_ops_per_second=10000, max_attempts=10):
+        self.db = db
+        self.initial_ops_per_second = initial_ops_per_second
+        self.max_ops_per_second = max_ops_per_second
+        self.max_attempts = max_attempts
+
+    def run(self, directory, collection=None):
+        start = time.perf_counter()
+        with open(os.path.join(directory, CollectionExporter.MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != CollectionExporter.FORMAT:
+            raise AppError(f"Unsupported export format: {manifest.get('format')!r}", 400)
+        collection = collection or manifest["collection"]
+        target = self.db.collection(collection)
+
+        # Error callbacks run on the BulkWriter's threads
+        failures, failed, lock = [], [0], threading.Lock()
+
+        def on_error(failure, _):
+            if failure.code in self.RETRYABLE and failure.attempts < self.max_attempts:
+                return True
+            with lock:
+                failed[0] += 1
+                if len(failures) < self.MAX_REPORTED_ERRORS:
+                    failures.append({"id": failure.operation.reference.id, "code": failure.code,
+                                     "message": failure.message})
+            return False
+
+        writer = self.db.bulk_writer(BulkWriterOptions(
+            initial_ops_per_second=self.initial_ops_per_second, max_ops_per_second=self.max_ops_per_second
+        ))
+        writer.on_write_error(on_error)
+        documents = 0
+        try:
+            for entry in manifest["files"]:
+                read = 0
+                with gzip.open(os.path.join(directory, entry["name"]), "rb") as f:
+                    for line in f:
+                        record = _ndjson_loads(line)
+                        writer.set(target.document(record["id"]), TypedValue.decode_fields(record["fields"], self.db))
+                        read += 1
+                if read != entry["documents"]:
+                    raise AppError(f"{entry['name']} has {read} documents, the manifest lists {entry['documents']}")
+                documents += read
+        finally:
+            writer.close()
+
+        logging.info("Imported %d documents into %s (%d failed, %.1f s)",
+                     documents, collection, failed[0], time.perf_counter() - start)
+        return {
+            "collection": collection,
+            "documents": documents,
+            "written": documents - failed[0],
+            "failed": failed[0],
+            "errors": failures,
+        }
@@ -0,0 +1,673 @@
+# In-memory stand-in for the Firestore RPC API, used by the offline benchmarks
+"""An in-memory Firestore backend for ``firestore.Client`` and ``firestore.AsyncClient``.
+
+The fake replaces the client's generated API object (``_firestore_api``), so
+all library code above the RPC layer still runs: query building, protobuf
+encoding and decoding, and snapshot parsing. It implements the RPCs the
+adapter issues. These are batch_get_documents, run_query (filters, ordering,
+cursors, offset, limit, projections and collection groups),
+run_aggregation_query, partition_query, commit and batch_write (preconditions,
+update masks and field transforms). Every RPC can be delayed by a simulated latency.
+
+Listeners (``on_snapshot``) receive the query's results as one initial
+snapshot; later writes are not pushed to them.
+"""
+import asyncio
+import math
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.exceptions import AlreadyExists, Cancelled, FailedPrecondition, InvalidArgument, NotFound
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore
+from google.cloud.firestore_v1 import _helpers
+from google.cloud.firestore_v1.field_path import parse_field_path
+from google.cloud.firestore_v1.types import (
+    AggregationResult, BatchGetDocumentsResponse, BatchWriteResponse, CommitResponse, Cursor, Document,
+    DocumentChange, ListenResponse, RunAggregationQueryResponse, RunQueryResponse, StructuredQuery, TargetChange,
+    Value, WriteResult
+)
+from google.cloud.firestore_v1.types import write as write_types
+from google.protobuf import timestamp_pb2
+from google.rpc import code_pb2, status_pb2
+
+# Cross-type ordering used by Firestore when comparing values
+_TYPE_ORDER = {
+    "null_value": 0, "boolean_value": 1, "integer_value": 2, "double_value": 2, "timestamp_value": 3,
+    "string_value": 4, "bytes_value": 5, "reference_value": 6, "geo_point_value": 7,
+    "array_value": 8, "map_value": 9
+}
+_FieldOp = StructuredQuery.FieldFilter.Operator
+_UnaryOp = StructuredQuery.UnaryFilter.Operator
+_ServerValue = write_types.DocumentTransform.FieldTransform.ServerValue
+_RawValue = Value.pb()
+_NAN_KEY = (2, -math.inf, 0)
+
+
+def _raw(message):
+    """Return the raw protobuf behind a proto-plus message."""
+    return getattr(message, "_pb", message)
+
+
+def _value_key(value):
+    """Map a Value protobuf to a key that sorts in Firestore's value order."""
+    kind = value.WhichOneof("value_type")
+    if kind in (None, "null_value"):
+        return (0,)
+    if kind == "double_value" and math.isnan(value.double_value):
+        return _NAN_KEY
+    if kind in ("integer_value", "double_value"):
+        return (2, getattr(value, kind))
+    if kind == "timestamp_value":
+        return (3, value.timestamp_value.seconds, value.timestamp_value.nanos)
+    if kind == "reference_value":
+        return (6, tuple(value.reference_value.split("/")))
+    if kind == "geo_point_value":
+        return (7, value.geo_point_value.latitude, value.geo_point_value.longitude)
+    if kind == "array_value":
+        return (8, tuple(_value_key(v) for v in value.array_value.values))
+    if kind == "map_value":
+        return (9, tuple(sorted((k, _value_key(v)) for k, v in value.map_value.fields.items())))
+    return (_TYPE_ORDER[kind], getattr(value, kind))
+
+
+def _number(value):
+    kind = value.WhichOneof("value_type")
+    if kind in ("integer_value", "double_value"):
+        return getattr(value, kind)
+    return None
+
+
+class _Stored:
+    """A stored document. Writes replace it rather than mutate it, so its sort keys can be memoized."""
+    __slots__ = ("fields", "create_time", "update_time", "keys")
+
+    def __init__(self, fields, create_time, update_time):
+        self.fields = fields
+        self.create_time = create_time
+        self.update_time = update_time
+        self.keys = {}
+
+
+class FakeFirestoreBackend:
+    """Thread-safe in-memory document store implementing the Firestore RPCs."""
+
+    def __init__(self, database="projects/bench/databases/(default)", latency=0.0):
+        self.database = database
+        self.root = f"{database}/documents"
+        self.latency = latency
+        self.calls = {}
+        self._docs = {}
+        # Documents indexed by the path of the collection that contains them
+        self._collections = {}
+        self._lock = threading.Lock()
+        self._last_time = datetime.now(timezone.utc)
+
+    # --- Helpers ---
+
+    def _count(self, rpc):
+        with self._lock:
+            self.calls[rpc] = self.calls.get(rpc, 0) + 1
+
+    def _now(self):
+        """Strictly increasing commit timestamps, so every write gets a distinct update_time."""
+        now = datetime.now(timezone.utc)
+        if now <= self._last_time:
+            now = self._last_time + timedelta(microseconds=1)
+        self._last_time = now
+        ts = timestamp_pb2.Timestamp()
+        ts.FromDatetime(now)
+        return ts
+
+    def _read_time(self):
+        ts = timestamp_pb2.Timestamp()
+        ts.FromDatetime(self._last_time)
+        return ts
+
+    def _document(self, name, stored, mask=None):
+        doc = Document()._pb
+        doc.name = name
+        fields = stored.fields
+        if mask is not None:
+            fields = {}
+            for path in mask:
+                value = self._get_field(stored.fields, parse_field_path(path))
+                if value is not None:
+                    self._set_field(fields, parse_field_path(path), value)
+        for key, value in fields.items():
+            doc.fields[key].CopyFrom(value)
+        doc.create_time.CopyFrom(stored.create_time)
+        doc.update_time.CopyFrom(stored.update_time)
+        return doc
+
+    @staticmethod
+    def _get_field(fields, parts):
+        value = fields.get(parts[0])
+        for part in parts[1:]:
+            if value is None or value.WhichOneof("value_type") != "map_value":
+                return None
+            value = value.map_value.fields.get(part)
+        return value
+
+    @staticmethod
+    def _set_field(fields, parts, value):
+        """Set a (nested) field; ``fields`` is a dict at the top level and a protobuf map below it."""
+        for part in parts[:-1]:
+            if isinstance(fields, dict):
+                parent = fields.get(part)
+                if parent is None:
+                    parent = fields[part] = _RawValue()
+            else:
+                parent = fields[part]
+            if parent.WhichOneof("value_type") != "map_value":
+                parent.Clear()
+                parent.map_value.SetInParent()
+            fields = parent.map_value.fields
+        if isinstance(fields, dict):
+            fields[parts[-1]] = value
+        else:
+            fields[parts[-1]].CopyFrom(value)
+
+    @staticmethod
+    def _delete_field(fields, parts):
+        for part in parts[:-1]:
+            parent = fields.get(part)
+            if parent is None or parent.WhichOneof("value_type") != "map_value":
+                return
+            fields = parent.map_value.fields
+        if parts[-1] in fields:
+            del fields[parts[-1]]
+
+    def _put(self, name, stored):
+        self._docs[name] = stored
+        self._collections.setdefault(name.rsplit("/", 1)[0], {})[name] = stored
+
+    def _remove(self, name):
+        if self._docs.pop(name, None) is not None:
+            self._collections[name.rsplit("/", 1)[0]].pop(name)
+
+    # --- Seeding ---
+
+    def seed(self, path, data):
+        """Store ``data`` at ``collection/doc_id`` directly, without an RPC."""
+        encoded = {key: _raw(value) for key, value in _helpers.encode_dict(data).items()}
+        with self._lock:
+            now = self._now()
+            self._put(f"{self.root}/{path}", _Stored(encoded, now, now))
+
+    def __len__(self):
+        return len(self._docs)
+
+    # --- Reads ---
+
+    def batch_get_documents(self, request):
+        self._count("batch_get_documents")
+        mask = request.get("mask")
+        mask = list(_raw(mask).field_paths) if mask is not None else None
+        with self._lock:
+            found = [(name, self._docs.get(name)) for name in request["documents"]]
+            read_time = self._read_time()
+        responses = []
+        for name, stored in found:
+            if stored is None:
+                responses.append(BatchGetDocumentsResponse(missing=name, read_time=read_time))
+            else:
+                found_doc = Document.wrap(self._document(name, stored, mask))
+                responses.append(BatchGetDocumentsResponse(found=found_doc, read_time=read_time))
+        return responses
+
+    # --- Queries ---
+
+    @staticmethod
+    def _key_getter(field_path):
+        """Return ``f(name, stored)`` giving the sort key of a field, or None when it is missing."""
+        if field_path == "__name__":
+            return lambda name, stored: (6, tuple(name.split("/")))
+        parts = parse_field_path(field_path)
+
+        def get(name, stored):
+            try:
+                return stored.keys[field_path]
+            except KeyError:
+                value = FakeFirestoreBackend._get_field(stored.fields, parts)
+                key = stored.keys[field_path] = _value_key(value) if value is not None else None
+                return key
+        return get
+
+    def _predicate(self, flt):
+        """Compile a filter protobuf into ``f(name, stored) -> bool``."""
+        kind = flt.WhichOneof("filter_type")
+        if kind == "composite_filter":
+            predicates = [self._predicate(f) for f in flt.composite_filter.filters]
+            if flt.composite_filter.op == StructuredQuery.CompositeFilter.Operator.OR:
+                return lambda name, stored: any(p(name, stored) for p in predicates)
+            return lambda name, stored: all(p(name, stored) for p in predicates)
+
+        if kind == "unary_filter":
+            get = self._key_getter(flt.unary_filter.field.field_path)
+            test = {
+                _UnaryOp.IS_NULL: lambda key: key == (0,),
+                _UnaryOp.IS_NOT_NULL: lambda key: key != (0,),
+                _UnaryOp.IS_NAN: lambda key: key == _NAN_KEY,
+                _UnaryOp.IS_NOT_NAN: lambda key: key[0] == 2 and key != _NAN_KEY,
+            }[flt.unary_filter.op]
+        else:
+            field = flt.field_filter
+            get = self._key_getter(field.field.field_path)
+            op = field.op
+            if op in (_FieldOp.ARRAY_CONTAINS_ANY, _FieldOp.IN, _FieldOp.NOT_IN):
+                targets = {_value_key(v) for v in field.value.array_value.values}
+            else:
+                target = _value_key(field.value)
+            if op == _FieldOp.ARRAY_CONTAINS:
+                def test(key):
+                    return key[0] == 8 and target in key[1]
+            elif op == _FieldOp.ARRAY_CONTAINS_ANY:
+                def test(key):
+                    return key[0] == 8 and not targets.isdisjoint(key[1])
+            elif op == _FieldOp.IN:
+                def test(key):
+                    return key in targets
+            elif op == _FieldOp.NOT_IN:
+                def test(key):
+                    return key not in targets and key != (0,)
+            elif op == _FieldOp.EQUAL:
+                def test(key):
+                    return key == target
+            elif op == _FieldOp.NOT_EQUAL:
+                def test(key):
+                    return key != target and key != (0,)
+            else:
+                # Range filters only match values of the same type
+                compare = {
+                    _FieldOp.LESS_THAN: lambda key: key < target,
+                    _FieldOp.LESS_THAN_OR_EQUAL: lambda key: key <= target,
+                    _FieldOp.GREATER_THAN: lambda key: key > target,
+                    _FieldOp.GREATER_THAN_OR_EQUAL: lambda key: key >= target,
+                }[op]
+
+                def test(key):
+                    return key[0] == target[0] and compare(key)
+
+        def predicate(name, stored):
+            key = get(name, stored)
+            return key is not None and test(key)
+        return predicate
+
+    @staticmethod
+    def _inequality_fields(flt, fields):
+        kind = flt.WhichOneof("filter_type")
+        if kind == "composite_filter":
+            for f in flt.composite_filter.filters:
+                FakeFirestoreBackend._inequality_fields(f, fields)
+        elif kind == "field_filter" and flt.field_filter.op in (
+            _FieldOp.LESS_THAN, _FieldOp.LESS_THAN_OR_EQUAL, _FieldOp.GREATER_THAN,
+            _FieldOp.GREATER_THAN_OR_EQUAL, _FieldOp.NOT_EQUAL, _FieldOp.NOT_IN
+        ):
+            path = flt.field_filter.field.field_path
+            if path not in fields:
+                fields.append(path)
+        return fields
+
+    def _orders(self, query):
+        orders = [(o.field.field_path, o.direction == StructuredQuery.Direction.DESCENDING) for o in query.order_by]
+        ordered = {path for path, _ in orders}
+        if query.HasField("where"):
+            for path in self._inequality_fields(query.where, []):
+                if path not in ordered:
+                    orders.append((path, False))
+                    ordered.add(path)
+        if "__name__" not in ordered:
+            orders.append(("__name__", orders[-1][1] if orders else False))
+        return orders
+
+    @staticmethod
+    def _compare(keys, cursor_keys, orders):
+        """Compare a document's order keys with a cursor; returns -1, 0 or 1 in query order."""
+        for key, cursor_key, (_, descending) in zip(keys, cursor_keys, orders):
+            if key != cursor_key:
+                result = -1 if key < cursor_key else 1
+                return -result if descending else result
+        return 0
+
+    def _candidates(self, parent, selector):
+        """Documents of the collection (or, for collection groups, collections) a query reads from."""
+        with self._lock:
+            if not selector.all_descendants:
+                return list(self._collections.get(f"{parent}/{selector.collection_id}", {}).items())
+            prefix = f"{parent}/"
+            return [
+                item
+                for path, docs in self._collections.items()
+                if path.startswith(prefix) and path.rsplit("/", 1)[-1] == selector.collection_id
+                for item in docs.items()
+            ]
+
+    def _execute(self, parent, query):
+        """Evaluate a StructuredQuery; returns ``[(name, stored, order_keys)]`` in result order."""
+        if len(query.from_) != 1:
+            raise InvalidArgument("Exactly one collection selector is supported")
+        orders = self._orders(query)
+        getters = [self._key_getter(path) for path, _ in orders]
+        matches = self._predicate(query.where) if query.HasField("where") else None
+
+        results = []
+        for name, stored in self._candidates(parent, query.from_[0]):
+            if matches is not None and not matches(name, stored):
+                continue
+            keys = [get(name, stored) for get in getters]
+            if None not in keys:
+                results.append((name, stored, keys))
+
+        for index in reversed(range(len(orders))):
+            results.sort(key=lambda item: item[2][index], reverse=orders[index][1])
+
+        if query.HasField("start_at"):
+            cursor_keys = [_value_key(v) for v in query.start_at.values]
+            lowest = 0 if query.start_at.before else 1
+            results = [r for r in results if self._compare(r[2], cursor_keys, orders) >= lowest]
+        if query.HasField("end_at"):
+            cursor_keys = [_value_key(v) for v in query.end_at.values]
+            highest = -1 if query.end_at.before else 0
+            results = [r for r in results if self._compare(r[2], cursor_keys, orders) <= highest]
+        results = results[query.offset:]
+        if query.HasField("limit"):
+            results = results[:query.limit.value]
+        return results
+
+    def run_query(self, request):
+        self._count("run_query")
+        query = _raw(request["structured_query"])
+        results = self._execute(request["parent"], query)
+        mask = [f.field_path for f in query.select.fields] if query.HasField("select") else None
+        read_time = self._read_time()
+        if not results:
+            return [RunQueryResponse(read_time=read_time)]
+        # Built lazily, so a caller that stops streaming early does not pay for the rest
+        return (
+            RunQueryResponse(document=Document.wrap(self._document(name, stored, mask)), read_time=read_time)
+            for name, stored, _ in results
+        )
+
+    def partition_query(self, request):
+        """Split points that cut the query results into ``partition_count`` roughly equal partitions."""
+        self._count("partition_query")
+        results = self._execute(request["parent"], _raw(request["structured_query"]))
+        count = request["partition_count"]
+        points = sorted({len(results) * i // count for i in range(1, count)} - {0})
+        return [Cursor(values=[Value(reference_value=results[i][0])]) for i in points]
+
+    def listen(self, request):
+        """Responses that deliver a query target's current results as one consistent snapshot."""
+        self._count("listen")
+        target = request.add_target
+        results = self._execute(target.query.parent, target.query.structured_query)
+        target_ids = [target.target_id]
+        change = TargetChange.TargetChangeType
+        responses = [ListenResponse(target_change=TargetChange(target_change_type=change.ADD, target_ids=target_ids))]
+        for name, stored, _ in results:
+            document = Document.wrap(self._document(name, stored))
+            responses.append(ListenResponse(document_change=DocumentChange(document=document, target_ids=target_ids)))
+        responses.append(ListenResponse(target_change=TargetChange(target_change_type=change.CURRENT,
+                                                                   target_ids=target_ids)))
+        # A global NO_CHANGE with a read time marks the snapshot as consistent
+        responses.append(ListenResponse(target_change=TargetChange(target_change_type=change.NO_CHANGE,
+                                                                   read_time=self._read_time())))
+        return responses
+
+    def run_aggregation_query(self, request):
+        self._count("run_aggregation_query")
+        aggregation_query = _raw(request["structured_aggregation_query"])
+        results = self._execute(request["parent"], aggregation_query.structured_query)
+        fields = {}
+        for aggregation in aggregation_query.aggregations:
+            kind = aggregation.WhichOneof("operator")
+            if kind == "count":
+                count = len(results)
+                if aggregation.count.HasField("up_to"):
+                    count = min(count, aggregation.count.up_to.value)
+                fields[aggregation.alias] = _helpers.encode_value(count)
+                continue
+            get = self._key_getter(getattr(aggregation, kind).field.field_path)
+            keys = (get(name, stored) for name, stored, _ in results)
+            numbers = [key[1] for key in keys if key is not None and key[0] == 2 and key != _NAN_KEY]
+            if kind == "sum":
+                total = sum(numbers)
+                fields[aggregation.alias] = _helpers.encode_value(total)
+            else:
+                fields[aggregation.alias] = _helpers.encode_value(sum(numbers) / len(numbers) if numbers else None)
+        result = AggregationResult(aggregate_fields=fields)
+        return [RunAggregationQueryResponse(result=result, read_time=self._read_time())]
+
+    # --- Writes ---
+
+    def _check(self, write, stored):
+        """Raise the error Firestore returns when ``write``'s precondition fails."""
+        if write.HasField("current_document"):
+            precondition = write.current_document
+            if precondition.HasField("exists"):
+                if precondition.exists and stored is None:
+                    raise NotFound(f"No document to update: {self._name(write)}")
+                if not precondition.exists and stored is not None:
+                    raise AlreadyExists(f"Document already exists: {self._name(write)}")
+            elif precondition.HasField("update_time"):
+                if stored is None:
+                    raise NotFound(f"No document to update: {self._name(write)}")
+                if stored.update_time != precondition.update_time:
+                    raise FailedPrecondition("the stored version does not match the required base version")
+
+    @staticmethod
+    def _name(write):
+        return write.delete if write.WhichOneof("operation") == "delete" else write.update.name
+
+    def _transform(self, fields, transform, now):
+        parts = parse_field_path(transform.field_path)
+        current = self._get_field(fields, parts)
+        kind = transform.WhichOneof("transform_type")
+        if kind == "set_to_server_value":
+            if transform.set_to_server_value != _ServerValue.REQUEST_TIME:
+                raise InvalidArgument("Unsupported server value")
+            result = _RawValue(timestamp_value=now)
+        elif kind in ("increment", "maximum", "minimum"):
+            operand = getattr(transform, kind)
+            base = _number(current) if current is not None else None
+            if kind == "increment":
+                base = base or 0
+                total = base + _number(operand)
+            elif base is None:
+                total = _number(operand)
+            else:
+                total = (max if kind == "maximum" else min)(base, _number(operand))
+            is_int = operand.WhichOneof("value_type") == "integer_value" and isinstance(base or 0, int)
+            result = _raw(_helpers.encode_value(int(total) if is_int else float(total)))
+        else:
+            elements = list(current.array_value.values) if current is not None \
+                and current.WhichOneof("value_type") == "array_value" else []
+            operand = getattr(transform, kind).values
+            if kind == "append_missing_elements":
+                keys = {_value_key(v) for v in elements}
+                for value in operand:
+                    if _value_key(value) not in keys:
+                        elements.append(value)
+                        keys.add(_value_key(value))
+            else:
+                removed = {_value_key(v) for v in operand}
+                elements = [v for v in elements if _value_key(v) not in removed]
+            result = _raw(_helpers.encode_value([]))
+            result.array_value.values.extend(elements)
+        self._set_field(fields, parts, result)
+        return result
+
+    def _apply(self, write, now):
+        """Apply one write to the store (the caller holds the lock); returns its WriteResult."""
+        operation = write.WhichOneof("operation")
+        name = self._name(write)
+        stored = self._docs.get(name)
+        self._check(write, stored)
+        if operation == "delete":
+            self._remove(name)
+            return WriteResult(update_time=now)
+
+        # Copy so that merging nested fields never mutates the stored or request messages
+        if write.HasField("update_mask"):
+            fields = {key: _copy(value) for key, value in stored.fields.items()} if stored is not None else {}
+            for path in write.update_mask.field_paths:
+                parts = parse_field_path(path)
+                value = self._get_field(write.update.fields, parts)
+                if value is None:
+                    self._delete_field(fields, parts)
+                else:
+                    self._set_field(fields, parts, _copy(value))
+        else:
+            fields = {key: _copy(value) for key, value in write.update.fields.items()}
+        transform_results = [self._transform(fields, t, now) for t in write.update_transforms]
+        self._put(name, _Stored(fields, stored.create_time if stored is not None else now, now))
+        return WriteResult(update_time=now, transform_results=transform_results)
+
+    def commit(self, request):
+        self._count("commit")
+        writes = [_raw(w) for w in request["writes"]]
+        with self._lock:
+            now = self._now()
+            previous = [(name, self._docs.get(name)) for name in (self._name(write) for write in writes)]
+            try:
+                results = [self._apply(write, now) for write in writes]
+            except Exception:
+                # Commits are atomic: restore every document the commit touched
+                for name, stored in reversed(previous):
+                    self._remove(name)
+                    if stored is not None:
+                        self._put(name, stored)
+                raise
+        return CommitResponse(write_results=results, commit_time=now)
+
+    def batch_write(self, request):
+        self._count("batch_write")
+        results, statuses = [], []
+        with self._lock:
+            for write in (_raw(w) for w in request["writes"]):
+                now = self._now()
+                try:
+                    results.append(self._apply(write, now))
+                    statuses.append(status_pb2.Status(code=code_pb2.OK))
+                except (NotFound, AlreadyExists, FailedPrecondition, InvalidArgument) as e:
+                    results.append(WriteResult())
+                    statuses.append(status_pb2.Status(code=e.grpc_status_code.value[0], message=e.message))
+        return BatchWriteResponse(write_results=results, status=statuses)
+
+
+def _copy(value):
+    copied = value.__class__()
+    copied.CopyFrom(value)
+    return copied
+
+
+class _ListenCall:
+    """A Listen stream: the snapshot responses, then idle until the listener cancels it."""
+
+    def __init__(self, responses):
+        self._responses = queue.Queue()
+        for response in responses:
+            self._responses.put(response)
+        self._active = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        response = self._responses.get()
+        if response is None:
+            raise Cancelled("Listen stream cancelled")
+        return response
+
+    def is_active(self):
+        return self._active
+
+    def cancel(self):
+        self._active = False
+        self._responses.put(None)
+
+    def add_done_callback(self, callback):
+        # The stream never fails or ends on its own, so there is nothing to report
+        pass
+
+
+class FakeFirestoreApi:
+    """Drop-in for the generated ``FirestoreClient`` API, backed by a FakeFirestoreBackend."""
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def _call(self, rpc, request):
+        if self._backend.latency:
+            time.sleep(self._backend.latency)
+        return getattr(self._backend, rpc)(request)
+
+    def batch_get_documents(self, request, metadata=None, **kwargs):
+        return iter(self._call("batch_get_documents", request))
+
+    def run_query(self, request, metadata=None, **kwargs):
+        return iter(self._call("run_query", request))
+
+    def run_aggregation_query(self, request, metadata=None, **kwargs):
+        return iter(self._call("run_aggregation_query", request))
+
+    def partition_query(self, request, metadata=None, **kwargs):
+        return iter(self._call("partition_query", request))
+
+    def commit(self, request, metadata=None, **kwargs):
+        return self._call("commit", request)
+
+    def batch_write(self, request, metadata=None, **kwargs):
+        return self._call("batch_write", request)
+
+    @property
+    def _transport(self):
+        # Listeners open their stream through the transport instead of the API object
+        return self
+
+    def listen(self, requests, metadata=None, **kwargs):
+        return _ListenCall(self._call("listen", _raw(next(requests))))
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+class FakeAsyncFirestoreApi(FakeFirestoreApi):
+    """Drop-in for the generated ``FirestoreAsyncClient`` API; latency is an ``asyncio.sleep``."""
+
+    async def _call(self, rpc, request):
+        if self._backend.latency:
+            await asyncio.sleep(self._backend.latency)
+        return getattr(self._backend, rpc)(request)
+
+    async def batch_get_documents(self, request, metadata=None, **kwargs):
+        return _aiter(await self._call("batch_get_documents", request))
+
+    async def run_query(self, request, metadata=None, **kwargs):
+        return _aiter(await self._call("run_query", request))
+
+    async def run_aggregation_query(self, request, metadata=None, **kwargs):
+        return _aiter(await self._call("run_aggregation_query", request))
+
+    async def partition_query(self, request, metadata=None, **kwargs):
+        return _aiter(await self._call("partition_query", request))
+
+    async def commit(self, request, metadata=None, **kwargs):
+        return await self._call("commit", request)
+
+    async def batch_write(self, request, metadata=None, **kwargs):
+        return await self._call("batch_write", request)
+
+
+def fake_client(backend, project="bench", asynchronous=False):
+    """Return a ``firestore.Client`` (or ``AsyncClient``) whose RPCs are served by ``backend``."""
+    client_class = firestore.AsyncClient if asynchronous else firestore.Client
+    client = client_class(project=project, credentials=AnonymousCredentials())
+    api_class = FakeAsyncFirestoreApi if asynchronous else FakeFirestoreApi
+    client._firestore_api_internal = api_class(backend)
+    return client
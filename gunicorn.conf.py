@@ -0,0 +1,12 @@
+# gunicorn settings for the Flask app; every value can be overridden with environment variables
+from config import Config
+
+bind = f"0.0.0.0:{Config.PORT}"
+workers = Config.WEB_CONCURRENCY
+threads = Config.GUNICORN_THREADS
+worker_class = "gthread"
+# Requests (and :watch streams) are bounded by the platform, not by the worker timeout
+timeout = 0
+# Import the app in each worker, after fork: gRPC channels must not be shared across a fork,
+# and the Firestore client (plus its pre-warm with FIRESTORE_PREWARM) is created per worker.
+preload_app = False
@@ -1,7 +1,10 @@
+import json
 import pytest
 from unittest.mock import patch, MagicMock
 from app import create_app
 from core import FirestoreClient # Import the class to mock it
+from core import AppError
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
 from google.api_core.exceptions import NotFound
 
 # The API key to be used in tests, matching what the test client is configured with
@@ -13,6 +16,7 @@ def mock_firestore_client():
     with patch('core.FirestoreClient', autospec=True) as MockFirestore:
         # Create an instance of the mock
         mock_instance = MockFirestore.return_value
+        mock_instance.flights = None
         yield mock_instance
 
 @pytest.fixture
@@ -21,7 +25,7 @@ def client(mock_firestore_client):
     app = create_app()
     app.config.update({
         "TESTING": True,
-        "API_KEYS": [TEST_API_KEY],
+        "ALL_API_KEYS": [TEST_API_KEY],
         "FIRESTORE_CREDENTIALS": "" # Ensure it doesn't try to load real credentials
     })
     
@@ -58,16 +62,16 @@ def test_wrong_api_key(client):
 
 def test_get_document_authorized(client, mock_firestore_client):
     """Test getting a document with a valid API key."""
-    mock_firestore_client.read_document.return_value = {"id": "test-doc", "data": "some data"}
+    mock_firestore_client.read_document.return_value = ({"id": "test-doc", "data": "some data"}, None)
     headers = {"X-API-KEY": TEST_API_KEY}
     response = client.get("/documents/users/test-doc", headers=headers)
     assert response.status_code == 200
     assert response.json["data"]["id"] == "test-doc"
-    mock_firestore_client.read_document.assert_called_once_with("users", "test-doc")
+    mock_firestore_client.read_document.assert_called_once_with("users", "test-doc", fields=None)
 
 def test_get_document_not_found(client, mock_firestore_client):
     """Test getting a document that does not exist."""
-    mock_firestore_client.read_document.return_value = None
+    mock_firestore_client.read_document.return_value = (None, None)
     headers = {"X-API-KEY": TEST_API_KEY}
     response = client.get("/documents/users/non-existent-doc", headers=headers)
     assert response.status_code == 404
@@ -85,13 +89,23 @@ def test_create_document(client, mock_firestore_client):
 
 def test_update_document(client, mock_firestore_client):
     """Test updating a document."""
-    mock_firestore_client.update_document.return_value = {"id": "test-doc", "name": "updated"}
+    mock_firestore_client.update_document.return_value = ({"id": "test-doc", "name": "updated"}, None)
     headers = {"X-API-KEY": TEST_API_KEY}
     data = {"name": "updated"}
     response = client.put("/documents/users/test-doc", headers=headers, json=data)
     assert response.status_code == 200
     assert response.json["data"]["name"] == "updated"
-    mock_firestore_client.update_document.assert_called_once_with("users", "test-doc", data)
+    mock_firestore_client.update_document.assert_called_once_with(
+        "users", "test-doc", data, return_document=False, if_match=None, merge=False
+    )
+
+def test_update_document_with_merge(client, mock_firestore_client):
+    """Test that ?merge=true asks the client for set(merge=True) semantics."""
+    mock_firestore_client.update_document.return_value = ({"id": "test-doc"}, None)
+    data = {"profile": {"city": "Oslo"}, "visits": {"$increment": 1}}
+    response = client.put("/documents/users/test-doc?merge=true", headers={"X-API-KEY": TEST_API_KEY}, json=data)
+    assert response.status_code == 200
+    assert mock_firestore_client.update_document.call_args.kwargs["merge"] is True
 
 def test_update_document_not_found(client, mock_firestore_client):
     """Test updating a non-existent document."""
@@ -109,4 +123,380 @@ def test_delete_document(client, mock_firestore_client):
     response = client.delete("/documents/users/test-doc", headers=headers)
     assert response.status_code == 200
     assert response.json["data"]["id"] == "test-doc"
-    mock_firestore_client.delete_document.assert_called_once_with("users", "test-doc") 
\ No newline at end of file
+    mock_firestore_client.delete_document.assert_called_once_with("users", "test-doc", if_match=None)
+
+def test_query_documents_parses_query_parameters(client, mock_firestore_client):
+    """Test that paging, ordering, cursors and projection are parsed and passed to the client."""
+    mock_firestore_client.query_documents.return_value = ([{"id": "a", "name": "x"}], "next-token", None, "v1")
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.get("/documents/users?limit=2&offset=5&order_by=-age&page_token=tok&fields=name&status=active",
+                          headers=headers)
+    assert response.status_code == 200
+    assert response.json["next_page_token"] == "next-token"
+    assert response.json["count"] == 1
+    mock_firestore_client.query_documents.assert_called_once_with(
+        "users",
+        filters=[("status", "==", "active")],
+        orders=[("age", "DESCENDING"), ("__name__", "DESCENDING")],
+        limit=2, offset=5, page_token="tok", fields=["name"], with_total=False
+    )
+
+    response = client.get("/documents/users?limit=0", headers=headers)
+    assert response.status_code == 400
+
+def test_query_documents_streams_ndjson(client, mock_firestore_client):
+    """Test that streaming mode writes one JSON document per line and allows larger limits."""
+    mock_firestore_client.stream_documents.return_value = iter([{"age": 1, "id": "a"}, {"age": 2, "id": "b"}])
+    headers = {"X-API-KEY": TEST_API_KEY, "Accept": "application/x-ndjson"}
+    response = client.get("/documents/users?limit=5000", headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines == [{"age": 1, "id": "a"}, {"age": 2, "id": "b"}]
+    assert mock_firestore_client.stream_documents.call_args.kwargs["limit"] == 5000
+
+    response = client.get("/documents/users?limit=5000", headers={"X-API-KEY": TEST_API_KEY})
+    assert response.status_code == 400
+
+def test_query_documents_stream_errors(client, mock_firestore_client):
+    """Test that a rejected stream gets an error status and a failure mid-stream ends with an error record."""
+    headers = {"X-API-KEY": TEST_API_KEY}
+    mock_firestore_client.stream_documents.side_effect = AppError("Invalid page_token", 400)
+    response = client.get("/documents/users?stream=true&page_token=bad", headers=headers)
+    assert response.status_code == 400
+
+    def docs():
+        yield {"id": "a"}
+        raise AppError("Firestore is temporarily unavailable", 503)
+    mock_firestore_client.stream_documents.side_effect = None
+    mock_firestore_client.stream_documents.return_value = docs()
+    response = client.get("/documents/users?stream=true", headers=headers)
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines == [{"id": "a"}, {"status": "error", "message": "Firestore is temporarily unavailable"}]
+
+def test_get_document_with_fields(client, mock_firestore_client):
+    """Test that the fields parameter is passed through as a server-side projection."""
+    mock_firestore_client.read_document.return_value = ({"id": "test-doc", "name": "test"}, None)
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.get("/documents/users/test-doc?fields=name, email", headers=headers)
+    assert response.status_code == 200
+    mock_firestore_client.read_document.assert_called_once_with("users", "test-doc", fields=["name", "email"])
+
+def test_batch_write(client, mock_firestore_client):
+    """Test that the batch endpoint forwards operations and summarizes per-operation results."""
+    mock_firestore_client.batch_write.return_value = [
+        {"op": "create", "id": "a", "status": "success", "update_time": None},
+        {"op": "delete", "id": "b", "status": "error", "code": 404, "message": "not found"},
+    ]
+    headers = {"X-API-KEY": TEST_API_KEY}
+    operations = [{"op": "create", "id": "a", "data": {"x": 1}}, {"op": "delete", "id": "b"}]
+    response = client.post("/documents/users:batch", headers=headers, json={"operations": operations})
+    assert response.status_code == 200
+    assert response.json["succeeded"] == 1
+    assert response.json["failed"] == 1
+    mock_firestore_client.batch_write.assert_called_once_with("users", operations, atomic=False)
+
+    response = client.post("/documents/users:batch", headers=headers, json={"operations": []})
+    assert response.status_code == 400
+
+def test_batch_get(client, mock_firestore_client):
+    """Test that batchGet reads all ids in one call and reports missing ids in order."""
+    mock_firestore_client.read_documents.return_value = [{"id": "a"}, None]
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.post("/documents/users:batchGet", headers=headers, json={"ids": ["a", "b"], "fields": ["name"]})
+    assert response.status_code == 200
+    assert response.json["data"] == [{"id": "a"}, None]
+    assert response.json["missing"] == ["b"]
+    mock_firestore_client.read_documents.assert_called_once_with(["users/a", "users/b"], fields=["name"])
+
+    response = client.post("/documents:batchGet", headers=headers, json={"paths": ["users/a", "mail/x"]})
+    assert response.status_code == 200
+    mock_firestore_client.read_documents.assert_called_with(["users/a", "mail/x"], fields=None)
+
+def test_update_document_with_if_match(client, mock_firestore_client):
+    """Test that If-Match becomes an update_time precondition and the new version is returned as an ETag."""
+    update_time = DatetimeWithNanoseconds.from_rfc3339("2024-06-18T10:00:01.000000002Z")
+    mock_firestore_client.update_document.return_value = ({"id": "test-doc", "name": "updated"}, update_time)
+    headers = {"X-API-KEY": TEST_API_KEY, "If-Match": '"2024-06-18T10:00:00.123456789Z"'}
+    response = client.put("/documents/users/test-doc?return=representation", headers=headers, json={"name": "updated"})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"2024-06-18T10:00:01.000000002Z"'
+    kwargs = mock_firestore_client.update_document.call_args.kwargs
+    assert kwargs["return_document"] is True
+    assert kwargs["if_match"].rfc3339() == "2024-06-18T10:00:00.123456789Z"
+
+def test_delete_document_version_conflict(client, mock_firestore_client):
+    """Test that a stale If-Match on delete surfaces as 412."""
+    mock_firestore_client.delete_document.side_effect = AppError("Document has been modified", 412)
+    headers = {"X-API-KEY": TEST_API_KEY, "If-Match": '"2024-06-18T10:00:00.123456789Z"'}
+    response = client.delete("/documents/users/test-doc", headers=headers)
+    assert response.status_code == 412
+
+def test_stats_reports_cache_counters(client, mock_firestore_client):
+    """Test that the stats endpoint exposes the document cache counters."""
+    mock_firestore_client.cache = MagicMock()
+    mock_firestore_client.cache.stats.return_value = {"hits": 3, "misses": 1, "evictions": 0}
+    response = client.get("/stats", headers={"X-API-KEY": TEST_API_KEY})
+    assert response.status_code == 200
+    assert response.json["data"]["cache"]["hits"] == 3
+
+def test_query_subcollections(client, mock_firestore_client):
+    """Test that subcollection_ filters are unprefixed and passed to a single group query."""
+    mock_firestore_client.query_subcollection_group.return_value = (
+        [{"id": "mail_1", "subject": "hi", "files": [{"id": "f1", "extraction_status": "Scheduled"}]}], 3
+    )
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.get(
+        "/collections/mail-register/subcollections/files"
+        "?subcollection_extraction_status=Scheduled&subcollection_file_size_gte=1000&include_parent=true&limit=5",
+        headers=headers
+    )
+    assert response.status_code == 200
+    assert response.json["count"] == 1
+    assert response.json["total_found"] == 3
+    assert response.json["data"][0]["files"][0]["id"] == "f1"
+    mock_firestore_client.query_subcollection_group.assert_called_once_with(
+        "mail-register", "files",
+        [("extraction_status", "==", "Scheduled"), ("file_size", ">=", 1000)],
+        5, offset=0, include_parent=True
+    )
+
+def test_aggregate_documents(client, mock_firestore_client):
+    """Test that aggregation params are separated from filters and passed to the client."""
+    mock_firestore_client.aggregate.return_value = {"count": 4, "sum": {"file_size": 4096}}
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.get("/documents/files:aggregate?count&sum=file_size&avg=score,pages&status=done",
+                          headers=headers)
+    assert response.status_code == 200
+    assert response.json["data"]["count"] == 4
+    mock_firestore_client.aggregate.assert_called_once_with(
+        "files", [("status", "==", "done")], count=True, sums=["file_size"], avgs=["score", "pages"]
+    )
+
+def test_query_documents_with_total(client, mock_firestore_client):
+    """Test that with_total adds an exact count from a count aggregation."""
+    mock_firestore_client.query_documents.return_value = ([{"id": "a"}], None, 42, "v1")
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.get("/documents/users?with_total=true", headers=headers)
+    assert response.status_code == 200
+    assert response.json["total"] == 42
+    assert mock_firestore_client.query_documents.call_args.kwargs["with_total"] is True
+
+    mock_firestore_client.query_documents.return_value = ([{"id": "a"}], None, None, "v1")
+    response = client.get("/documents/users", headers=headers)
+    assert "total" not in response.json
+
+def test_server_timing_and_metrics(client, mock_firestore_client):
+    """Test that responses carry a Server-Timing breakdown and /metrics exposes per-route histograms."""
+    mock_firestore_client.query_documents.return_value = ([{"id": "a"}], None, None, "v1")
+    response = client.get("/documents/users?status=active", headers={"X-API-KEY": TEST_API_KEY})
+    phases = dict(item.split(";dur=") for item in response.headers["Server-Timing"].split(", "))
+    assert {"auth", "filter", "serialize", "adapter", "total"} <= set(phases)
+    assert float(phases["total"]) >= float(phases["serialize"])
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    body = response.get_data(as_text=True)
+    labels = 'collection="users",method="GET",route="/documents/<collection>"'
+    assert f"fs_adapter_request_duration_seconds_count{{{labels}}}" in body
+    assert 'phase="filter"' in body
+
+    client.get("/documents/probe-123", headers={"X-API-KEY": "wrong"})
+    body = client.get("/metrics").get_data(as_text=True)
+    assert "probe-123" not in body
+    assert 'collection="unknown",method="GET",route="/documents/<collection>",status="401"' in body
+
+def test_query_documents_rejects_invalid_filters_before_reading(client, mock_firestore_client):
+    """Test that an invalid filter combination is a 400 and Firestore is never called."""
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.get("/documents/users?status=active&order_by=status", headers=headers)
+    assert response.status_code == 400
+    mock_firestore_client.query_documents.assert_not_called()
+
+    mock_firestore_client.cache = None
+    response = client.get("/stats", headers=headers)
+    assert {"hits", "misses", "size"} <= set(response.json["data"]["query_plans"])
+
+def test_get_document_conditional(client, mock_firestore_client):
+    """Test that reads carry ETag/Last-Modified and matching validators get a 304 without a body."""
+    update_time = DatetimeWithNanoseconds.from_rfc3339("2024-06-18T10:00:00.123456789Z")
+    mock_firestore_client.read_document.return_value = ({"id": "test-doc"}, update_time)
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.get("/documents/users/test-doc", headers=headers)
+    assert response.headers["ETag"] == '"2024-06-18T10:00:00.123456789Z"'
+    assert response.headers["Last-Modified"] == "Tue, 18 Jun 2024 10:00:00 GMT"
+
+    response = client.get("/documents/users/test-doc", headers={**headers, "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert response.data == b""
+    response = client.get("/documents/users/test-doc",
+                          headers={**headers, "If-Modified-Since": "Tue, 18 Jun 2024 10:00:00 GMT"})
+    assert response.status_code == 304
+    response = client.get("/documents/users/test-doc",
+                          headers={**headers, "If-Modified-Since": "Tue, 18 Jun 2024 09:59:59 GMT"})
+    assert response.status_code == 200
+    # If-None-Match wins over If-Modified-Since
+    response = client.get("/documents/users/test-doc", headers={
+        **headers, "If-None-Match": '"stale"', "If-Modified-Since": "Tue, 18 Jun 2024 10:00:00 GMT"
+    })
+    assert response.status_code == 200
+
+def test_query_documents_conditional(client, mock_firestore_client):
+    """Test that query pages are tagged with the page version and revalidated with If-None-Match."""
+    mock_firestore_client.query_documents.return_value = ([{"id": "a"}], None, None, "v1")
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.get("/documents/users", headers=headers)
+    assert response.headers["ETag"] == '"v1"'
+    response = client.get("/documents/users", headers={**headers, "If-None-Match": '"v1"'})
+    assert response.status_code == 304
+    mock_firestore_client.query_documents.return_value = ([{"id": "b"}], None, None, "v2")
+    response = client.get("/documents/users", headers={**headers, "If-None-Match": '"v1"'})
+    assert response.status_code == 200
+
+@pytest.mark.parametrize("encoding", ["gzip", "br"])
+def test_large_responses_are_compressed(client, mock_firestore_client, encoding):
+    """Test Accept-Encoding negotiation, the encoding-specific ETag and 304s against it."""
+    import gzip
+    brotli = pytest.importorskip("brotli") if encoding == "br" else None
+    docs = [{"id": f"d{i}", "name": "x" * 20} for i in range(100)]
+    mock_firestore_client.query_documents.return_value = (docs, None, None, "v1")
+    headers = {"X-API-KEY": TEST_API_KEY, "Accept-Encoding": encoding}
+    response = client.get("/documents/users", headers=headers)
+    assert response.headers["Content-Encoding"] == encoding
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert response.headers["ETag"] == f'"v1-{encoding}"'
+    body = gzip.decompress(response.data) if encoding == "gzip" else brotli.decompress(response.data)
+    assert json.loads(body)["data"] == docs
+
+    response = client.get("/documents/users", headers={**headers, "If-None-Match": f'"v1-{encoding}"'})
+    assert response.status_code == 304
+
+    mock_firestore_client.query_documents.return_value = (docs[:1], None, None, "v1")
+    response = client.get("/documents/users", headers=headers)
+    assert "Content-Encoding" not in response.headers
+
+def test_watch_documents_streams_server_sent_events(client, mock_firestore_client):
+    """Test that :watch subscribes with the parsed filters and streams changes as SSE."""
+    from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+    app = client.application
+    app.config["WATCH_HEARTBEAT_SECONDS"] = 0.01
+    callbacks = []
+    mock_firestore_client.db = MagicMock()
+    query = mock_firestore_client.db.collection.return_value.where.return_value
+    query.on_snapshot.side_effect = lambda callback: callbacks.append(callback) or MagicMock()
+
+    response = client.get("/documents/mail:watch?extraction_status=new", headers={"X-API-KEY": TEST_API_KEY})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache"
+    where = mock_firestore_client.db.collection.return_value.where.call_args.kwargs["filter"]
+    assert (where.field_path, where.op_string, where.value) == ("extraction_status", "==", "new")
+
+    doc = MagicMock(id="m1", update_time=DatetimeWithNanoseconds.from_rfc3339("2024-06-18T10:00:00Z"))
+    doc.to_dict.return_value = {"extraction_status": "new"}
+    callbacks[0]([doc], [DocumentChange(ChangeType.ADDED, doc, -1, 0)], None)
+    chunks = response.iter_encoded()
+    frames = [f for f in (next(chunks).decode() for _ in range(4)) if not f.startswith(":")]
+    assert frames[0].split("\n")[1:3] == [
+        "event: added", 'data: {"data":{"extraction_status":"new","id":"m1"},"id":"m1",'
+        '"update_time":"2024-06-18T10:00:00.000000Z"}'
+    ]
+    assert "event: sync" in frames[1]
+    assert app.extensions["watch_hub"].stats()["subscribers"] == 1
+    response.close()
+    assert app.extensions["watch_hub"].stats()["subscribers"] == 0
+
+def test_warmup_waits_for_firestore(client, mock_firestore_client):
+    """Test that the readiness endpoint warms the client with the configured timeout."""
+    response = client.get("/warmup")
+    assert response.status_code == 200
+    mock_firestore_client.warm.assert_called_once_with(10.0)
+
+def test_warmup_not_ready(client, mock_firestore_client):
+    """Test that a channel that does not connect in time makes the service report 503."""
+    import grpc
+    mock_firestore_client.warm.side_effect = grpc.FutureTimeoutError()
+    response = client.get("/warmup")
+    assert response.status_code == 503
+    assert response.json["message"] == "Firestore is not ready"
+
+def test_increment_counter(client, mock_firestore_client):
+    """Test that increments default to 1 and reject non-numeric amounts."""
+    mock_firestore_client.increment_counter.return_value = {
+        "id": "m1", "counter": "unread", "shard": "3", "increment": 1
+    }
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.post("/documents/mailboxes/m1/counters/unread:increment", headers=headers)
+    assert response.status_code == 200
+    mock_firestore_client.increment_counter.assert_called_once_with("mailboxes", "m1", "unread", 1)
+    client.post("/documents/mailboxes/m1/counters/unread:increment", headers=headers, json={"by": -2})
+    mock_firestore_client.increment_counter.assert_called_with("mailboxes", "m1", "unread", -2)
+    response = client.post("/documents/mailboxes/m1/counters/unread:increment", headers=headers, json={"by": "2"})
+    assert response.status_code == 400
+
+def test_read_counter(client, mock_firestore_client):
+    """Test that counter reads use the total cache unless the request says no-cache."""
+    mock_firestore_client.read_counter.return_value = {"id": "m1", "counter": "unread", "value": 7, "shards": 10}
+    headers = {"X-API-KEY": TEST_API_KEY}
+    response = client.get("/documents/mailboxes/m1/counters/unread", headers=headers)
+    assert response.json["data"]["value"] == 7
+    mock_firestore_client.read_counter.assert_called_once_with("mailboxes", "m1", "unread", use_cache=True)
+    client.get("/documents/mailboxes/m1/counters/unread", headers={**headers, "Cache-Control": "no-cache"})
+    assert mock_firestore_client.read_counter.call_args.kwargs["use_cache"] is False
+
+def test_multiplexed_batch(client, mock_firestore_client):
+    """Test that POST /batch authenticates once and returns each sub-response in order."""
+    mock_firestore_client.read_document.side_effect = [({"id": "a"}, None), (None, None)]
+    mock_firestore_client.create_document.return_value = {"id": "new", "n": 1}
+    body = {"requests": [
+        {"path": "/documents/users/a"},
+        {"method": "POST", "path": "/documents/users", "body": {"n": 1}},
+        {"path": "/documents/users/missing"},
+        {"path": "/documents/users?bad_filter[op]=1"}
+    ]}
+    response = client.post("/batch", headers={"X-API-KEY": TEST_API_KEY}, json=body)
+    assert response.status_code == 200
+    results = response.json["data"]
+    assert [r["status"] for r in results] == [200, 201, 404, 400]
+    assert results[0]["body"]["data"] == {"id": "a"}
+    assert results[1]["body"]["data"]["id"] == "new"
+    assert response.json["failed"] == 2
+    mock_firestore_client.create_document.assert_called_once_with("users", {"n": 1})
+
+def test_multiplexed_batch_validation(client):
+    """Test that POST /batch needs an API key and rejects nested batches and change feeds."""
+    body = {"requests": [{"path": "/documents/users/a"}]}
+    assert client.post("/batch", json=body).status_code == 401
+    headers = {"X-API-KEY": TEST_API_KEY}
+    for sub in ({"path": "/batch"}, {"path": "/documents/users:watch"}, {"method": "PATCH", "path": "/"}):
+        response = client.post("/batch", headers=headers, json={"requests": [sub]})
+        assert response.status_code == 400
+    assert client.post("/batch", headers=headers, json={"requests": []}).status_code == 400
+
+def test_request_deadline_bounds_firestore_calls(client, mock_firestore_client):
+    """Test that X-Request-Deadline is validated and applies while the handler runs."""
+    from core import RequestDeadline
+    remaining = []
+
+    def read_document(*args, **kwargs):
+        remaining.append(RequestDeadline.remaining())
+        return {"id": "a"}, None
+    mock_firestore_client.read_document.side_effect = read_document
+    headers = {"X-API-KEY": TEST_API_KEY, "X-Request-Deadline": "0.25"}
+    assert client.get("/documents/users/a", headers=headers).status_code == 200
+    assert 0 < remaining[0] <= 0.25
+    assert RequestDeadline.remaining() is None
+    response = client.get("/documents/users/a", headers={**headers, "X-Request-Deadline": "-1"})
+    assert response.status_code == 400
+
+def test_concurrency_limits_shed_with_retry_after(client, mock_firestore_client):
+    """Test that a request over the API key's concurrency limit gets 429 and Retry-After."""
+    mock_firestore_client.read_document.return_value = ({"id": "a"}, None)
+    admission = client.application.extensions["admission"]
+    admission.api_keys.limit = 1
+    with admission.api_keys.slot(TEST_API_KEY):
+        response = client.get("/documents/users/a", headers={"X-API-KEY": TEST_API_KEY})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert client.get("/documents/users/a", headers={"X-API-KEY": TEST_API_KEY}).status_code == 200
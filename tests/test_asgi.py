@@ -0,0 +1,188 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import patch
+from asgi import create_asgi_app
+from core import AppError
+from google.api_core.exceptions import NotFound
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+
+TEST_API_KEY = "test-key"
+HEADERS = {"X-API-KEY": TEST_API_KEY}
+
+@pytest.fixture
+def mock_firestore_client():
+    """Provides a mock of the AsyncFirestoreClient; its coroutine methods become AsyncMocks."""
+    with patch('core.AsyncFirestoreClient', autospec=True) as MockFirestore:
+        mock_instance = MockFirestore.return_value
+        mock_instance.cache = None
+        mock_instance.flights = None
+        yield mock_instance
+
+@pytest.fixture
+def app(mock_firestore_client):
+    app = create_asgi_app()
+    app.config.update({"TESTING": True, "ALL_API_KEYS": [TEST_API_KEY]})
+    app.extensions["firestore_client"] = mock_firestore_client
+    return app
+
+def request(app, method, path, **kwargs):
+    """Issue one request through the Quart test client; returns ``(status, body)``."""
+    async def send():
+        response = await getattr(app.test_client(), method)(path, **kwargs)
+        return response.status_code, await response.get_data(as_text=True), response
+    return asyncio.run(send())
+
+def test_health_check(app):
+    status, body, response = request(app, "get", "/health")
+    assert status == 200
+    assert json.loads(body)["status"] == "success"
+    assert "total;dur=" in response.headers["Server-Timing"]
+
+def test_requires_api_key(app):
+    status, body, _ = request(app, "get", "/documents/users")
+    assert status == 401
+    assert json.loads(body)["message"] == "Unauthorized"
+
+def test_query_documents(app, mock_firestore_client):
+    mock_firestore_client.query_documents.return_value = ([{"id": "a"}], "tok", 3, "v1")
+    status, body, _ = request(app, "get", "/documents/users?limit=1&with_total=true&status=active", headers=HEADERS)
+    assert status == 200
+    body = json.loads(body)
+    assert body["data"] == [{"id": "a"}]
+    assert body["next_page_token"] == "tok"
+    assert body["total"] == 3
+    assert mock_firestore_client.query_documents.call_args.kwargs["filters"] == [("status", "==", "active")]
+
+def test_query_documents_streams_ndjson(app, mock_firestore_client):
+    async def docs(*args, **kwargs):
+        for doc in ({"id": "a"}, {"id": "b"}):
+            yield doc
+    mock_firestore_client.stream_documents.side_effect = docs
+    status, body, response = request(app, "get", "/documents/users?stream=true", headers=HEADERS)
+    assert status == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert [json.loads(line) for line in body.splitlines()] == [{"id": "a"}, {"id": "b"}]
+
+def test_read_document_not_found(app, mock_firestore_client):
+    mock_firestore_client.read_document.return_value = (None, None)
+    status, _, _ = request(app, "get", "/documents/users/missing", headers=HEADERS)
+    assert status == 404
+
+def test_update_document_sets_etag(app, mock_firestore_client):
+    mock_firestore_client.update_document.return_value = ({"id": "a", "n": 1}, None)
+    status, body, _ = request(app, "put", "/documents/users/a", json={"n": 1}, headers=HEADERS)
+    assert status == 200
+    assert json.loads(body)["data"] == {"id": "a", "n": 1}
+
+    mock_firestore_client.update_document.side_effect = NotFound("gone")
+    status, _, _ = request(app, "put", "/documents/users/a", json={"n": 1}, headers=HEADERS)
+    assert status == 404
+
+def test_batch_get_and_errors(app, mock_firestore_client):
+    mock_firestore_client.read_documents.return_value = [{"id": "a"}, None]
+    status, body, _ = request(app, "post", "/documents/users:batchGet", json={"ids": ["a", "b"]}, headers=HEADERS)
+    assert status == 200
+    assert json.loads(body)["missing"] == ["b"]
+    mock_firestore_client.read_documents.assert_called_once_with(["users/a", "users/b"], fields=None)
+
+    mock_firestore_client.batch_write.side_effect = AppError("bad op", 400)
+    status, body, _ = request(app, "post", "/documents/users:batch", json={"operations": [{}]}, headers=HEADERS)
+    assert status == 400
+    assert json.loads(body)["message"] == "bad op"
+
+def test_read_document_conditional_and_compressed(app, mock_firestore_client):
+    import gzip
+    update_time = DatetimeWithNanoseconds.from_rfc3339("2024-06-18T10:00:00.123456789Z")
+    mock_firestore_client.read_document.return_value = ({"id": "a", "text": "x" * 2000}, update_time)
+    headers = {**HEADERS, "Accept-Encoding": "gzip"}
+
+    async def send():
+        response = await app.test_client().get("/documents/users/a", headers=headers)
+        return response, await response.get_data()
+    response, body = asyncio.run(send())
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(body))["data"]["id"] == "a"
+    assert response.headers["ETag"] == '"2024-06-18T10:00:00.123456789Z-gzip"'
+
+    status, body, _ = request(app, "get", "/documents/users/a",
+                              headers={**headers, "If-None-Match": response.headers["ETag"]})
+    assert status == 304
+    assert body == ""
+
+def test_watch_documents_streams_server_sent_events(app, mock_firestore_client):
+    from unittest.mock import MagicMock
+    from core import WatchHub
+    from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+    db = MagicMock()
+    callbacks = []
+    db.collection.return_value.on_snapshot.side_effect = lambda callback: callbacks.append(callback) or MagicMock()
+    app.extensions["watch_hub"] = WatchHub(lambda: db, dumps=app.json.dumps, linger=0)
+    app.config["WATCH_HEARTBEAT_SECONDS"] = 0.01
+
+    async def watch():
+        async with app.test_client().request("/documents/mail:watch", headers=HEADERS) as connection:
+            await connection.send_complete()
+            assert await connection.receive() == b": heartbeat\n\n"
+            doc = MagicMock(id="m1", update_time=None)
+            doc.to_dict.return_value = {"n": 1}
+            # Listener callbacks arrive on another thread
+            await asyncio.to_thread(callbacks[0], [doc], [DocumentChange(ChangeType.ADDED, doc, -1, 0)], None)
+            frames = b""
+            while b"event: sync" not in frames:
+                frames += await connection.receive()
+            await connection.disconnect()
+        return frames.decode()
+
+    frames = asyncio.run(watch())
+    assert "event: added" in frames
+    assert '"data":{"id":"m1","n":1}' in frames
+
+def test_warmup(app, mock_firestore_client):
+    status, _, _ = request(app, "get", "/warmup")
+    assert status == 200
+    mock_firestore_client.warm.assert_awaited_once_with(10.0)
+
+    mock_firestore_client.warm.side_effect = asyncio.TimeoutError()
+    status, body, _ = request(app, "get", "/warmup")
+    assert status == 503
+    assert json.loads(body)["message"] == "Firestore is not ready"
+
+def test_counters(app, mock_firestore_client):
+    mock_firestore_client.increment_counter.return_value = {
+        "id": "m1", "counter": "unread", "shard": "0", "increment": 5
+    }
+    mock_firestore_client.read_counter.return_value = {"id": "m1", "counter": "unread", "value": 5, "shards": 10}
+    status, _, _ = request(app, "post", "/documents/mailboxes/m1/counters/unread:increment", headers=HEADERS,
+                           json={"by": 5})
+    assert status == 200
+    mock_firestore_client.increment_counter.assert_awaited_once_with("mailboxes", "m1", "unread", 5)
+    status, body, _ = request(app, "get", "/documents/mailboxes/m1/counters/unread", headers=HEADERS)
+    assert json.loads(body)["data"]["value"] == 5
+
+def test_multiplexed_batch(app, mock_firestore_client):
+    mock_firestore_client.read_document.return_value = ({"id": "a"}, None)
+    mock_firestore_client.update_document.side_effect = NotFound("gone")
+    body = {"requests": [
+        {"path": "/documents/users/a"},
+        {"method": "PUT", "path": "/documents/users/b", "body": {"n": 1}}
+    ]}
+    status, body, _ = request(app, "post", "/batch", headers=HEADERS, json=body)
+    assert status == 200
+    results = json.loads(body)["data"]
+    assert [r["status"] for r in results] == [200, 404]
+    assert results[0]["body"]["data"] == {"id": "a"}
+
+    status, _, _ = request(app, "post", "/batch", json={"requests": [{"path": "/documents/users/a"}]})
+    assert status == 401
+
+def test_collection_concurrency_limit(app, mock_firestore_client):
+    mock_firestore_client.read_document.return_value = ({"id": "a"}, None)
+    admission = app.extensions["admission"]
+    admission.collections.limit = 1
+    with admission.collections.slot("users"):
+        status, body, response = request(app, "get", "/documents/users/a", headers=HEADERS)
+    assert status == 503
+    assert response.headers["Retry-After"] == "1"
+    status, _, _ = request(app, "get", "/documents/users/a", headers=HEADERS)
+    assert status == 200
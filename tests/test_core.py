@@ -0,0 +1,895 @@
+from unittest.mock import patch, MagicMock
+import core
+from core import FirestoreClient, AsyncFirestoreClient, DocumentCache, FilterBuilder, PageCursor, AppError
+from datetime import datetime, timezone
+from google.api_core.exceptions import NotFound as GoogleNotFound
+import asyncio
+import json
+import pytest
+import time
+
+
+def _client():
+    """Build a FirestoreClient around a mock db without touching real credentials."""
+    client = FirestoreClient.__new__(FirestoreClient)
+    client.db = MagicMock()
+    client.cache = None
+
+    def document(doc_id=None):
+        ref = MagicMock()
+        ref.id = doc_id or "auto-id"
+        ref.path = f"users/{ref.id}"
+        return ref
+
+    client.db.collection.return_value.document.side_effect = document
+    return client
+
+def _status(code=0, message=""):
+    status = MagicMock()
+    status.code = code
+    status.message = message
+    return status
+
+def test_batch_write_chunks_and_reports_per_operation():
+    """Test that repeated documents start a new chunk and statuses map back to operations."""
+    client = _client()
+    responses = [
+        MagicMock(status=[_status(), _status(5, "no doc")], write_results=[MagicMock(update_time=None)] * 2),
+        MagicMock(status=[_status()], write_results=[MagicMock(update_time=None)]),
+    ]
+    with patch("core.BulkWriteBatch") as MockBatch:
+        MockBatch.return_value.commit.side_effect = responses
+        results = client.batch_write("users", [
+            {"op": "set", "id": "a", "data": {"x": 1}},
+            {"op": "update", "id": "b", "data": {"x": 2}},
+            {"op": "delete", "id": "a"},
+        ])
+
+    assert MockBatch.return_value.commit.call_count == 2
+    assert [r["status"] for r in results] == ["success", "error", "success"]
+    assert results[1]["code"] == 404
+    assert [r["id"] for r in results] == ["a", "b", "a"]
+
+def test_batch_write_reports_chunks_past_the_deadline():
+    """Test that chunks left after the deadline are reported per operation instead of failing the batch."""
+    client = _client()
+    client._rpc = MagicMock(side_effect=[{"retry": None, "timeout": 1.0}, AppError("Request deadline exceeded", 504)])
+    with patch("core.BulkWriteBatch") as MockBatch:
+        MockBatch.return_value.commit.return_value = MagicMock(status=[_status()], write_results=[MagicMock()])
+        results = client.batch_write("users", [{"op": "delete", "id": "a"}, {"op": "delete", "id": "a"}])
+
+    assert MockBatch.return_value.commit.call_count == 1
+    assert [(r["status"], r.get("code")) for r in results] == [("success", None), ("error", 504)]
+    assert results[1]["message"] == "Not attempted: Request deadline exceeded"
+
+def test_batch_write_rejects_invalid_operations():
+    """Test that malformed operations are rejected before anything is written."""
+    client = _client()
+    with pytest.raises(AppError) as exc:
+        client.batch_write("users", [{"op": "set", "id": "a", "data": {}}, {"op": "update", "data": {}}])
+    assert exc.value.status_code == 400
+    client.db.batch.assert_not_called()
+
+def test_batch_write_atomic_limit():
+    """Test that atomic batches are capped at a single commit."""
+    client = _client()
+    operations = [{"op": "delete", "id": str(i)} for i in range(FirestoreClient.BATCH_LIMIT + 1)]
+    with pytest.raises(AppError):
+        client.batch_write("users", operations, atomic=True)
+
+def test_read_documents_preserves_request_order():
+    """Test that get_all results are mapped back to request order, with None for missing ids."""
+    client = _client()
+
+    def document(path):
+        ref = MagicMock()
+        ref.path = path
+        return ref
+
+    def snapshot(path, exists):
+        doc = MagicMock(exists=exists)
+        doc.id = path.split("/")[-1]
+        doc.reference.path = path
+        doc.to_dict.return_value = {"n": doc.id}
+        return doc
+
+    client.db.document.side_effect = document
+    client.db.get_all.return_value = [snapshot("users/b", True), snapshot("users/c", False), snapshot("users/a", True)]
+    docs = client.read_documents(["users/a", "users/c", "users/b", "users/a"], fields=["n"])
+
+    assert docs == [{"id": "a", "n": "a"}, None, {"id": "b", "n": "b"}, {"id": "a", "n": "a"}]
+    refs, = client.db.get_all.call_args.args
+    assert [r.path for r in refs] == ["users/a", "users/c", "users/b"]
+    assert client.db.get_all.call_args.kwargs["field_paths"] == ["n"]
+    assert client.db.get_all.call_args.kwargs["timeout"] == 10.0
+
+def test_update_document_is_a_single_write():
+    """Test that update does not read the document back unless a representation is requested."""
+    client = _client()
+    ref = MagicMock()
+    client.db.collection.return_value.document.side_effect = None
+    client.db.collection.return_value.document.return_value = ref
+    ref.update.return_value.update_time = "t1"
+
+    assert client.update_document("users", "a", {"x": 1}) == ({"id": "a", "x": 1}, "t1")
+    ref.get.assert_not_called()
+
+def test_delete_document_uses_exists_precondition():
+    """Test that delete relies on a precondition instead of a prior existence read."""
+    client = _client()
+    ref = MagicMock()
+    client.db.collection.return_value.document.side_effect = None
+    client.db.collection.return_value.document.return_value = ref
+    ref.delete.side_effect = GoogleNotFound("No document to delete")
+
+    with pytest.raises(GoogleNotFound):
+        client.delete_document("users", "missing")
+    client.db.write_option.assert_called_once_with(exists=True)
+    ref.get.assert_not_called()
+
+def test_document_cache_lru_and_ttl():
+    """Test LRU eviction, per-collection TTLs and the hit/miss counters."""
+    cache = DocumentCache(max_entries=2, default_ttl=60, collection_ttls={"volatile": 0.01})
+    cache.put("users", "a", {"id": "a"})
+    cache.put("users", "b", {"id": "b"})
+    assert cache.get("users", "a") == (True, {"id": "a"})
+    cache.put("users", "c", {"id": "c"})  # evicts b, the least recently used
+    assert cache.get("users", "b") == (False, None)
+
+    cache.put("volatile", "x", None)
+    assert cache.get("volatile", "x") == (True, None)
+    time.sleep(0.02)
+    assert cache.get("volatile", "x") == (False, None)
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["expirations"]) == (2, 2, 2, 1)
+
+def test_document_cache_starts_watches_on_first_use():
+    """Test that configured watches create the client on the first lookup, not at startup."""
+    cache = DocumentCache()
+    db = MagicMock()
+    db_factory = MagicMock(side_effect=[RuntimeError("no credentials"), db])
+    cache.watch_on_first_use(db_factory, ["config", "flags"])
+    assert not db_factory.called
+
+    assert cache.get("config", "a") == (False, None)
+    assert cache.stats()["watched_collections"] == []
+    cache.get("config", "a")
+    cache.get("flags", "b")
+    assert db_factory.call_count == 2
+    assert cache.stats()["watched_collections"] == ["config", "flags"]
+    assert db.collection.return_value.on_snapshot.call_count == 2
+
+def test_read_document_is_read_through_and_invalidated_by_writes():
+    """Test that reads are served from the cache until a write through the client invalidates them."""
+    client = _client()
+    client.cache = DocumentCache()
+    ref = MagicMock()
+    client.db.collection.return_value.document.side_effect = None
+    client.db.collection.return_value.document.return_value = ref
+    ref.get.return_value = MagicMock(exists=True, id="a", to_dict=lambda: {"x": 1})
+
+    ref.get.return_value.update_time = "t1"
+    assert client.read_document("users", "a") == ({"id": "a", "x": 1}, "t1")
+    assert client.read_document("users", "a") == ({"id": "a", "x": 1}, "t1")
+    assert ref.get.call_count == 1
+
+    client.update_document("users", "a", {"x": 2})
+    client.read_document("users", "a")
+    assert ref.get.call_count == 2
+    client.read_document("users", "a", fields=["x"])
+    assert ref.get.call_count == 3
+
+def test_failed_writes_still_invalidate_the_cache():
+    """Test that a write that fails (and so may or may not have been applied) drops the cached copy."""
+    from google.api_core.exceptions import DeadlineExceeded
+    client = _client()
+    client.cache = DocumentCache()
+    ref = client.db.collection.return_value.document.return_value
+    client.db.collection.return_value.document.side_effect = None
+    ref.update.side_effect = ref.delete.side_effect = DeadlineExceeded("slow")
+    for write in (lambda: client.update_document("users", "a", {"x": 2}),
+                  lambda: client.delete_document("users", "a")):
+        client.cache.put("users", "a", {"id": "a", "x": 1})
+        with pytest.raises(AppError) as exc:
+            write()
+        assert exc.value.status_code == 504
+        assert client.cache.get("users", "a") == (False, None)
+
+def test_read_document_does_not_cache_a_read_that_raced_a_write():
+    """Test that a read invalidated while its RPC was in flight does not fill the cache."""
+    client = _client()
+    client.cache = DocumentCache()
+    ref = MagicMock()
+    client.db.collection.return_value.document.side_effect = None
+    client.db.collection.return_value.document.return_value = ref
+
+    def stale_get(**kwargs):
+        client.cache.invalidate("users", "a")  # a write lands while the read is in flight
+        return MagicMock(exists=True, id="a", to_dict=lambda: {"x": 1}, update_time="t1")
+
+    ref.get.side_effect = stale_get
+    assert client.read_document("users", "a") == ({"id": "a", "x": 1}, "t1")
+    assert client.cache.get("users", "a") == (False, None)
+    assert client.cache.stats()["stale_puts"] == 1
+
+def _group_snapshot(path, data):
+    doc = MagicMock()
+    parts = path.split("/")
+    doc.id = parts[-1]
+    doc.to_dict.return_value = data
+    doc.reference.parent.parent.path = "/".join(parts[:2])
+    return doc
+
+def test_query_subcollection_group_groups_by_parent_and_stops_early():
+    """Test that matches are grouped per parent in one pass and parents are read in one batch."""
+    client = _client()
+    query = MagicMock()
+    for method in ("where", "order_by", "start_at", "end_at"):
+        getattr(query, method).return_value = query
+    query.stream.return_value = iter([
+        _group_snapshot("mail/m1/files/a", {"s": 1}),
+        _group_snapshot("mail/m1/files/b", {"s": 1}),
+        _group_snapshot("other/x/files/c", {"s": 1}),
+        _group_snapshot("mail/m2/files/d", {"s": 1}),
+        _group_snapshot("mail/m3/files/e", {"s": 1}),
+    ])
+    query.count.return_value.get.return_value = [[MagicMock(value=7)]]
+    client.db.collection_group.return_value = query
+    client.read_documents = MagicMock(return_value=[{"id": "m2", "subject": "hi"}])
+
+    data, total = client.query_subcollection_group("mail", "files", [("s", "==", 1)], 1, offset=1,
+                                                   include_parent=True)
+
+    assert total == 7
+    assert data == [{"id": "m2", "subject": "hi", "files": [{"id": "d", "s": 1}]}]
+    client.read_documents.assert_called_once_with(["mail/m2"])
+    query.order_by.assert_called_once_with("__name__")
+
+def test_aggregate_maps_aliases_back_to_fields():
+    """Test that count/sum/avg run as one aggregation query and results are keyed by field."""
+    client = _client()
+    aggregation = MagicMock()
+    aggregation.sum.return_value = aggregation
+    aggregation.avg.return_value = aggregation
+    client.db.collection.return_value.count.return_value = aggregation
+    aggregation.get.return_value = [[
+        MagicMock(alias="a0", value=3), MagicMock(alias="a1", value=30), MagicMock(alias="a2", value=1.5)
+    ]]
+
+    data = client.aggregate("files", [], count=True, sums=["size"], avgs=["score"])
+    assert data == {"count": 3, "sum": {"size": 30}, "avg": {"score": 1.5}}
+    aggregation.sum.assert_called_once_with("size", alias="a1")
+
+    with pytest.raises(AppError):
+        client.aggregate("files", [])
+
+def _mock_query(client, docs):
+    """Wire a chainable query mock onto the client's db that streams ``docs``."""
+    query = MagicMock()
+    for method in ("where", "order_by", "start_after", "offset", "limit", "select"):
+        getattr(query, method).return_value = query
+    query.stream.return_value = iter(docs)
+    client.db.collection.return_value = query
+    return query
+
+def _mock_snapshot(doc_id, data):
+    snapshot = MagicMock()
+    snapshot.id = doc_id
+    snapshot.to_dict.side_effect = lambda: dict(data)
+    snapshot.get.side_effect = lambda field: data[field]
+    return snapshot
+
+def test_query_documents_pushes_offset_and_cursor_to_firestore():
+    """Test that offset is applied server-side and a full page yields a resumable next_page_token."""
+    client = _client()
+    orders = PageCursor.orders([], "age")
+    query = _mock_query(client, [_mock_snapshot("a", {"age": 1}), _mock_snapshot("b", {"age": 2})])
+    data, token, total, _ = client.query_documents("users", [], orders, 2, offset=5)
+    assert [d["id"] for d in data] == ["a", "b"]
+    query.offset.assert_called_once_with(5)
+    query.limit.assert_called_once_with(2)
+    assert token and total is None
+
+    query.stream.return_value = iter([_mock_snapshot("c", {"age": 3})])
+    _, next_token, _, _ = client.query_documents("users", [], orders, 2, page_token=token)
+    query.start_after.assert_called_once_with({"age": 2, "__name__": "b"})
+    assert next_token is None
+
+    with pytest.raises(AppError) as exc:
+        client.query_documents("users", [], PageCursor.orders([], "-name"), 2, page_token=token)
+    assert exc.value.status_code == 400
+    with pytest.raises(AppError):
+        client.query_documents("users", [], orders, 2, page_token="not-a-token")
+
+def test_query_documents_projects_fields_with_select():
+    """Test that fields become a select() projection that still carries the ordering fields."""
+    client = _client()
+    query = _mock_query(client, [_mock_snapshot("a", {"name": "x", "age": 1})])
+    data, token, _, _ = client.query_documents("users", [], PageCursor.orders([], "age"), 1, fields=["name"])
+    query.select.assert_called_once_with(["name", "age"])
+    assert data == [{"name": "x", "id": "a"}]
+    assert token
+
+def _async_client():
+    client = AsyncFirestoreClient.__new__(AsyncFirestoreClient)
+    client.db = MagicMock()
+    client.cache = None
+    return client
+
+def test_async_read_documents_fetches_chunks_concurrently():
+    """Test that get_all chunks are in flight together and results keep request order."""
+    client = _async_client()
+    client.GET_ALL_CHUNK = 2
+    client.db.document.side_effect = lambda path: MagicMock(path=path)
+    in_flight = []
+
+    async def get_all(refs, field_paths=None, **kwargs):
+        in_flight.append(len(refs))
+        await asyncio.sleep(0)
+        # Every chunk has started before any of them yields a document
+        assert len(in_flight) == 2
+        for ref in refs:
+            if ref.path != "users/c":
+                doc = MagicMock(exists=True)
+                doc.id = ref.path.split("/")[-1]
+                doc.reference.path = ref.path
+                doc.to_dict.return_value = {}
+                yield doc
+
+    client.db.get_all.side_effect = get_all
+    docs = asyncio.run(client.read_documents(["users/c", "users/b", "users/a"]))
+    assert docs == [None, {"id": "b"}, {"id": "a"}]
+    assert in_flight == [2, 1]
+
+def test_async_query_documents_counts_concurrently():
+    """Test that the page and the total count are awaited together."""
+    client = _async_client()
+    query = _mock_query(client, [])
+    started = []
+
+    async def get(**kwargs):
+        started.append("page")
+        await asyncio.sleep(0)
+        assert "count" in started
+        return [_mock_snapshot("a", {"age": 1})]
+
+    async def count(**kwargs):
+        started.append("count")
+        return [[MagicMock(value=7)]]
+
+    query.get.side_effect = get
+    query.count.return_value.get.side_effect = count
+    data, token, total, _ = asyncio.run(
+        client.query_documents("users", [], PageCursor.orders([], None), 10, with_total=True)
+    )
+    assert data == [{"age": 1, "id": "a"}]
+    assert token is None
+    assert total == 7
+
+def test_request_timer_records_firestore_phases():
+    """Test that RPC and count time are recorded separately and excluded from adapter time."""
+    client = _client()
+    query = _mock_query(client, [_mock_snapshot("a", {"age": 1})])
+    query.count.return_value.get.return_value = [[MagicMock(value=1)]]
+    token = core._request_timer.set(core.RequestTimer())
+    try:
+        client.query_documents("users", [], PageCursor.orders([], None), 10, with_total=True)
+        phases = core._request_timer.get().phases()
+    finally:
+        core._request_timer.reset(token)
+    assert {"rpc", "count", "adapter", "total"} <= set(phases)
+    assert phases["adapter"] <= phases["total"] - phases["rpc"] - phases["count"] + 1e-6
+
+    # Outside a timed request the timers are no-ops
+    with core.timing("rpc"):
+        pass
+    assert core._request_timer.get() is None
+
+def test_filter_builder_operators_and_coercion():
+    """Test operator suffixes and typed values, including quoted strings, null and timestamps."""
+    filters = FilterBuilder().build({
+        "status!": "archived", "tags_array_contains_any": "a,b", "kind_in": "1,x",
+        "done": "true", "code": '"007"', "deleted_at": "null", "since_gte": "2024-01-02T03:04:05",
+    })
+    assert filters == [
+        ("code", "==", "007"), ("deleted_at", "==", None), ("done", "==", True), ("kind", "in", [1, "x"]),
+        ("since", ">=", datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)),
+        ("status", "!=", "archived"), ("tags", "array_contains_any", ["a", "b"]),
+    ]
+    assert FilterBuilder().build({"name_not_in": "a,b"}) == [("name", "not-in", ["a", "b"])]
+    assert FilterBuilder().build({"x_ne": "1.5"}) == [("x", "!=", 1.5)]
+
+def test_filter_builder_caches_plans_by_shape():
+    """Test that queries with the same shape reuse one compiled plan and only rebind values."""
+    builder = FilterBuilder()
+    first = builder.plan({"age_gte": "18", "order_by": "age"}, ordered=True)
+    second = builder.plan({"age_gte": "30", "order_by": "age"}, ordered=True)
+    assert second is first
+    assert builder.plan_cache_stats() == {"hits": 1, "misses": 1, "size": 1}
+    assert second.bind({"age_gte": "30"}) == [("age", ">=", 30)]
+    assert builder.plan({"age_gte": "18", "order_by": "-age"}, ordered=True) is not first
+
+    plan = builder.plan({"a": "1", "b_gt": "2"})
+    assert builder.plan({"b_gt": "3", "a": "4"}) is plan
+    assert plan.bind({"b_gt": "3", "a": "4"}) == [("a", "==", 4), ("b", ">", 3)]
+    assert FilterBuilder().plan_cache_stats() == {"hits": 0, "misses": 0, "size": 0}
+
+@pytest.mark.parametrize("args", [
+    {"tags_array_contains": "a", "labels_array_contains_any": "b"},
+    {"a_ne": "1", "b_not_in": "2"},
+    {"a_not_in": "1", "b_in": "2"},
+    {"status": "x", "order_by": "status"},
+    {"age_gt": "1", "order_by": "name"},
+    {"order_by": "name,-name"},
+    {"_gte": "1"},
+    {"a..b": "1"},
+    {"age_gt": "null"},
+    {"status_not_in": ",".join(str(i) for i in range(11))},
+    {"since_gte": "2024-13-01T00:00"},
+    {"since_in": "2024-01-01T00:00,2024-02-30T00:00"},
+])
+def test_filter_builder_rejects_invalid_queries(args):
+    """Test that queries Firestore would reject fail with a 400 at compile or bind time."""
+    with pytest.raises(AppError) as exc:
+        FilterBuilder().query(args)
+    assert exc.value.status_code == 400
+
+def test_filters_are_applied_as_one_composite_filter():
+    """Test that several filters become a single And filter instead of chained positional where() calls."""
+    client = _client()
+    query = _mock_query(client, [])
+    client.query_documents("users", [("a", "==", 1), ("b", ">", 2)], PageCursor.orders([], None), 10)
+    query.where.assert_called_once()
+    composite = query.where.call_args.kwargs["filter"]
+    assert isinstance(composite, core.And)
+    assert [(f.field_path, f.op_string, f.value) for f in composite.filters] == [("a", "==", 1), ("b", ">", 2)]
+
+@pytest.mark.parametrize("encoder", ["json", "orjson"])
+def test_json_provider_encodes_firestore_values(encoder):
+    """Test that both encoders write Firestore value types the same way."""
+    from flask import Flask
+    from google.cloud import firestore
+    from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+    app = Flask(__name__)
+    provider = core.TimedJSONProvider(app, encoder=encoder)
+    assert provider.encoder == encoder
+    ref = MagicMock(spec=core.BaseDocumentReference)
+    ref.path = "users/a"
+    doc = {
+        "ts": DatetimeWithNanoseconds(2024, 6, 18, 10, tzinfo=timezone.utc, nanosecond=123456789),
+        "at": datetime(2024, 6, 18, tzinfo=timezone.utc),
+        "geo": firestore.GeoPoint(1.5, -2.0),
+        "ref": ref,
+        "raw": b"\x00\xff",
+        "id": "a",
+    }
+    expected = {
+        "at": "2024-06-18T00:00:00+00:00", "geo": {"latitude": 1.5, "longitude": -2.0}, "id": "a",
+        "raw": "AP8=", "ref": "users/a", "ts": "2024-06-18T10:00:00.123456789Z",
+    }
+    assert json.loads(provider.dumps(doc)) == expected
+    with app.app_context():
+        response = provider.response({"data": doc})
+    assert response.get_data().endswith(b"\n")
+    assert json.loads(response.get_data()) == {"data": expected}
+
+def test_json_provider_rejects_unknown_encoder():
+    from flask import Flask
+    with pytest.raises(ValueError):
+        core.TimedJSONProvider(Flask(__name__), encoder="simplejson")
+
+def test_page_version_tracks_documents_and_total():
+    """Test that the page ETag changes when a document is rewritten or the total changes."""
+    def snapshot(doc_id, update_time):
+        return MagicMock(id=doc_id, update_time=MagicMock(rfc3339=lambda: update_time))
+    page = [snapshot("a", "t1"), snapshot("b", "t1")]
+    version = core.DocumentVersion.page(page)
+    assert version == core.DocumentVersion.page([snapshot("a", "t1"), snapshot("b", "t1")])
+    assert version != core.DocumentVersion.page([snapshot("a", "t1"), snapshot("b", "t2")])
+    assert version != core.DocumentVersion.page([snapshot("b", "t1"), snapshot("a", "t1")])
+    assert version != core.DocumentVersion.page(page, total=2)
+
+def test_if_match_accepts_compressed_etags():
+    from werkzeug.http import parse_etags
+    update_time = core.DocumentVersion.from_if_match(parse_etags('"2024-06-18T10:00:00.123456789Z-gzip"'))
+    assert update_time.rfc3339() == "2024-06-18T10:00:00.123456789Z"
+
+def test_single_flight_shares_one_call_between_concurrent_callers():
+    """Test that identical concurrent calls share one execution, its result and its error."""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    flights = core.SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def read(value):
+        calls.append(value)
+        release.wait(5)
+        if value == "boom":
+            raise AppError("Failed", 500)
+        return {"value": value}
+
+    with ThreadPoolExecutor(8) as pool:
+        futures = [pool.submit(flights.do, ("document", "users", "a"), read, "a") for _ in range(8)]
+        while flights.stats()["coalesced"] < 7:
+            time.sleep(0.001)
+        release.set()
+        results = [f.result() for f in futures]
+    assert calls == ["a"]
+    assert all(r is results[0] for r in results)
+    assert flights.stats() == {"in_flight": 0, "executions": 1, "coalesced": 7}
+
+    release.clear()
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(flights.do, ("k",), read, "boom") for _ in range(2)]
+        while flights.stats()["coalesced"] < 8:
+            time.sleep(0.001)
+        release.set()
+        for f in futures:
+            with pytest.raises(AppError):
+                f.result()
+
+def test_single_flight_forget_starts_a_new_call():
+    """Test that a call made after forget() does not join the flight that was in progress."""
+    import threading
+    flights = core.SingleFlight()
+    release, started = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "old"
+
+    leader = threading.Thread(target=flights.do, args=(("document", "users", "a", None), slow))
+    leader.start()
+    started.wait(5)
+    flights.forget(("document", "users", "a"))
+    assert flights.do(("document", "users", "a", None), lambda: "new") == "new"
+    release.set()
+    leader.join()
+    assert flights.stats()["in_flight"] == 0
+
+def test_async_single_flight_coalesces_and_survives_cancellation():
+    """Test that concurrent coroutines share one call, even if the first caller is cancelled."""
+    flights = core.AsyncSingleFlight()
+    calls = []
+
+    async def read():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "doc"
+
+    async def main():
+        first = asyncio.ensure_future(flights.do(("k",), read))
+        await asyncio.sleep(0)
+        rest = [flights.do(("k",), read) for _ in range(3)]
+        first.cancel()
+        return await asyncio.gather(*rest)
+
+    assert asyncio.run(main()) == ["doc", "doc", "doc"]
+    assert calls == [1]
+    assert flights.stats() == {"in_flight": 0, "executions": 1, "coalesced": 3}
+
+def test_single_flight_followers_stop_waiting_at_their_deadline():
+    """Test that a caller sharing a slow call gives up with a 504 when its request deadline passes."""
+    import threading
+    flights = core.SingleFlight()
+    release, started = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "doc"
+
+    leader = threading.Thread(target=flights.do, args=(("k",), slow))
+    leader.start()
+    started.wait(5)
+    core.RequestDeadline.start({"X-Request-Deadline": "0.05"}, {"RPC_DEADLINE": 10.0, "RPC_MAX_DEADLINE": 60.0})
+    try:
+        with pytest.raises(AppError) as exc:
+            flights.do(("k",), slow)
+        assert exc.value.status_code == 504
+    finally:
+        core.RequestDeadline.clear()
+        release.set()
+        leader.join()
+
+    async_flights = core.AsyncSingleFlight()
+
+    async def main():
+        leader = asyncio.ensure_future(async_flights.do(("k",), asyncio.sleep, 0.2, "doc"))
+        await asyncio.sleep(0)
+        core.RequestDeadline.start({"X-Request-Deadline": "0.01"}, {"RPC_DEADLINE": 10.0, "RPC_MAX_DEADLINE": 60.0})
+        with pytest.raises(AppError) as exc:
+            await async_flights.do(("k",), asyncio.sleep, 0.2, "doc")
+        assert exc.value.status_code == 504
+        return await leader
+
+    assert asyncio.run(main()) == "doc"
+
+def test_read_document_coalesces_concurrent_reads():
+    """Test that a client with coalescing shares one get() between concurrent identical reads."""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    client = _client()
+    client.flights = core.SingleFlight()
+    release = threading.Event()
+    ref = client.db.collection.return_value.document.return_value = MagicMock()
+    client.db.collection.return_value.document.side_effect = None
+
+    def get(field_paths=None, **kwargs):
+        release.wait(5)
+        return MagicMock(exists=True, id="a", to_dict=lambda: {"x": 1}, update_time="t1")
+    ref.get.side_effect = get
+
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(client.read_document, "users", "a") for _ in range(4)]
+        while client.flights.stats()["coalesced"] < 3:
+            time.sleep(0.001)
+        release.set()
+        assert [f.result() for f in futures] == [({"id": "a", "x": 1}, "t1")] * 4
+    assert ref.get.call_count == 1
+
+def _watch_hub(**kwargs):
+    """A WatchHub on a mock db; returns ``(hub, db, callbacks)`` where callbacks[i] drives listener i."""
+    db = MagicMock()
+    callbacks = []
+    query = db.collection.return_value.where.return_value
+
+    def on_snapshot(callback):
+        callbacks.append(callback)
+        return MagicMock()
+    query.on_snapshot.side_effect = on_snapshot
+    db.collection.return_value.on_snapshot.side_effect = on_snapshot
+    return core.WatchHub(lambda: db, **kwargs), db, callbacks
+
+def _change(kind, doc_id, data=None, update_time="t"):
+    from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+    doc = _mock_snapshot(doc_id, data or {})
+    doc.update_time = MagicMock(rfc3339=lambda: update_time)
+    return DocumentChange(ChangeType[kind], doc, -1, -1)
+
+def _sse(frames):
+    """Parse SSE frames into ``(event, id, data)`` tuples, skipping heartbeats."""
+    events = []
+    for frame in frames:
+        if frame.startswith(":"):
+            continue
+        fields = dict(line.split(": ", 1) for line in frame.strip().split("\n"))
+        events.append((fields["event"], fields.get("id"), json.loads(fields["data"])))
+    return events
+
+def _drain(subscription, count):
+    events = subscription.events(heartbeat=0.01)
+    return [next(events) for _ in range(count)], events
+
+def test_watch_hub_shares_listeners_and_fans_out_changes():
+    """Test that identical watches share one listener and every subscriber gets each change once."""
+    hub, db, callbacks = _watch_hub(linger=0)
+    first = hub.subscribe("mail", [("status", "==", "new")])
+    second = hub.subscribe("mail", [("status", "==", "new")])
+    other = hub.subscribe("mail", [])
+    assert len(callbacks) == 2
+    assert hub.stats()["subscribers"] == 3
+
+    callbacks[0]([], [_change("ADDED", "m1", {"status": "new"}), _change("ADDED", "m2")], None)
+    callbacks[0]([], [_change("MODIFIED", "m1", {"status": "new", "n": 1}, "t2"), _change("REMOVED", "m2")], None)
+    # A late subscriber starts from the current state
+    late = hub.subscribe("mail", [("status", "==", "new")])
+    assert [(e, d.get("id")) for e, _, d in _sse(late.pending)] == [("added", "m1"), ("sync", None)]
+
+    for subscription in (first, second):
+        frames, events = _drain(subscription, 5)
+        assert [(e, d.get("id")) for e, _, d in _sse(frames)] == [
+            ("added", "m1"), ("added", "m2"), ("sync", None), ("modified", "m1"), ("removed", "m2")
+        ]
+        assert _sse(frames)[3][2] == {"id": "m1", "data": {"status": "new", "n": 1, "id": "m1"}, "update_time": "t2"}
+        assert next(events) == ": heartbeat\n\n"
+        events.close()
+
+    assert hub.stats()["listeners"] == 2
+    late.close()
+    other.close()
+    assert hub.stats() == {"listeners": 0, "subscribers": 0, "events": 4, "resumed": 0, "resets": 0, "rejected": 0}
+
+def test_watch_hub_resumes_from_last_event_id():
+    """Test that a reconnect replays only the missed events, and an unknown token resets."""
+    hub, db, callbacks = _watch_hub(linger=60, replay_size=2)
+    subscription = hub.subscribe("mail", [])
+    callbacks[0]([], [_change("ADDED", "m1")], None)
+    frames, events = _drain(subscription, 2)
+    token = _sse(frames)[0][1]
+    events.close()
+    assert hub.stats()["listeners"] == 1  # kept alive for resumes
+
+    callbacks[0]([], [_change("ADDED", "m2")], None)
+    callbacks[0]([], [_change("MODIFIED", "m1", {}, "t2")], None)
+    resumed = hub.subscribe("mail", [], resume_token=token)
+    assert [(e, d["id"]) for e, _, d in _sse(resumed.pending)] == [("added", "m2"), ("modified", "m1")]
+
+    # m2 and m1's update pushed the first event out of the replay buffer
+    callbacks[0]([], [_change("REMOVED", "m2")], None)
+    reset = hub.subscribe("mail", [], resume_token=token)
+    assert [e for e, _, _ in _sse(reset.pending)] == ["reset", "added", "sync"]
+    assert hub.subscribe("mail", [], resume_token="other-epoch.1").pending[0].startswith("event: reset")
+    assert hub.stats()["resumed"] == 1
+    hub.close()
+
+def test_watch_subscription_overflow_resynchronizes():
+    """Test that a subscriber that falls behind gets a reset and the current state instead of a backlog."""
+    hub, db, callbacks = _watch_hub(linger=0, queue_size=2)
+    subscription = hub.subscribe("mail", [])
+    callbacks[0]([], [_change("ADDED", f"m{i}") for i in range(5)], None)
+    frames, events = _drain(subscription, 7)
+    assert [(e, d.get("id")) for e, _, d in _sse(frames)] == [
+        ("reset", None), *[("added", f"m{i}") for i in range(5)], ("sync", None)
+    ]
+    assert next(events).startswith(":")
+    events.close()
+    assert hub.stats()["resets"] == 1
+
+def test_watch_hub_caps_open_streams():
+    """Test that subscribes past max_streams are a 503 until an open stream closes."""
+    hub, db, callbacks = _watch_hub(linger=0, max_streams=2, retry_after=3)
+    first = hub.subscribe("mail", [])
+    hub.subscribe("other", [])
+    with pytest.raises(AppError) as exc:
+        hub.subscribe("mail", [])
+    assert (exc.value.status_code, exc.value.headers) == (503, {"Retry-After": "3"})
+    first.close()
+    first.close()
+    hub.subscribe("mail", [])
+    assert hub.stats()["rejected"] == 1
+    hub.close()
+
+def test_firestore_client_is_created_lazily_once():
+    """Test that the Firestore client is created on first use, once, even under concurrent access."""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    with patch("core.firestore") as mock_firestore:
+        client = FirestoreClient()
+        mock_firestore.Client.assert_not_called()
+
+        barrier = threading.Barrier(8)
+
+        def use():
+            barrier.wait()
+            return client.db
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            dbs = list(pool.map(lambda _: use(), range(8)))
+    mock_firestore.Client.assert_called_once_with()
+    assert all(db is mock_firestore.Client.return_value for db in dbs)
+
+def test_warm_waits_for_the_grpc_channel():
+    """Test that warm blocks on the channel of the (lazily created) client."""
+    client = _client()
+    channel = client.db._firestore_api._transport.grpc_channel
+    with patch("core.grpc.channel_ready_future") as ready:
+        client.warm(timeout=2)
+    ready.assert_called_once_with(channel)
+    ready.return_value.result.assert_called_once_with(timeout=2)
+
+def test_typed_value_matches_the_firestore_json_format():
+    """Test that exported values parse as Firestore ``Value`` protobuf JSON and decode back unchanged."""
+    from google.cloud.firestore_v1 import _helpers
+    from google.cloud.firestore_v1.types import Document
+    from google.protobuf import json_format
+    data = {"n": 3, "x": float("nan"), "at": datetime(2024, 6, 18, 10, 0, tzinfo=timezone.utc),
+            "bytes": b"\x01", "tags": ["a", None], "map": {"ok": False}}
+    fields = core.TypedValue.encode_fields(data)
+    document = json_format.ParseDict({"fields": fields}, Document.pb()())
+    decoded = _helpers.decode_dict(Document.wrap(document).fields, None)
+    assert decoded["x"] != decoded["x"]
+    assert {k: v for k, v in decoded.items() if k != "x"} == {k: v for k, v in data.items() if k != "x"}
+    assert core.TypedValue.decode_fields(json.loads(json.dumps(fields)), None)["at"] == data["at"]
+
+def test_field_transforms_resolve_to_sentinels():
+    """Test that transform objects become Firestore sentinels and everything else is left alone."""
+    from google.cloud import firestore
+    data = {"n": 1, "plain": {"$other": 1}, "views": {"$increment": 2},
+            "stats": {"best": {"$maximum": 9.5}, "tags": {"$arrayUnion": ["a"]}}, "at": {"$serverTimestamp": True}}
+    resolved = core.FieldTransforms.resolve(data)
+    assert resolved["n"] == 1 and resolved["plain"] is data["plain"]
+    assert isinstance(resolved["views"], firestore.Increment) and resolved["views"].value == 2
+    assert isinstance(resolved["stats"]["best"], firestore.Maximum)
+    assert resolved["stats"]["tags"].values == ["a"]
+    assert resolved["at"] is firestore.SERVER_TIMESTAMP
+    assert data["views"] == {"$increment": 2}
+    plain = {"a": [1, {"b": 2}]}
+    assert core.FieldTransforms.resolve(plain) is plain
+    assert core.FieldTransforms.resolve({"old": {"$delete": True}}, delete=True)["old"] is firestore.DELETE_FIELD
+
+    for bad in ({"old": {"$delete": True}}, {"n": {"$increment": "1"}}, {"n": {"$increment": True}},
+                {"a": {"$arrayRemove": 1}}, {"a": [{"$increment": 1}]}, {"t": {"$serverTimestamp": 1}}, [1]):
+        with pytest.raises(AppError) as exc:
+            core.FieldTransforms.resolve(bad)
+        assert exc.value.status_code == 400
+
+def test_rpc_policy_retries_reads_and_guarded_writes_only():
+    """Test that idempotent calls get a jittered retry within the deadline and other writes none."""
+    from google.api_core.exceptions import InvalidArgument, ServiceUnavailable
+    policy = core.RpcPolicy(deadline=5.0, initial_backoff=0.001, max_backoff=0.002)
+    write = policy.kwargs(core.Retry, idempotent=False)
+    assert write == {"retry": None, "timeout": 5.0}
+
+    read = policy.kwargs(core.Retry)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ServiceUnavailable("overloaded")
+        return "ok"
+    assert read["retry"](flaky)() == "ok"
+    assert len(attempts) == 3
+    assert not read["retry"]._predicate(InvalidArgument("bad"))
+
+def test_rpc_policy_uses_the_request_deadline():
+    """Test that RPC timeouts shrink with the request's remaining time and fail once it is spent."""
+    policy = core.RpcPolicy(deadline=5.0)
+    core.RequestDeadline.start({"X-Request-Deadline": "0.5"}, {"RPC_DEADLINE": 10.0, "RPC_MAX_DEADLINE": 60.0})
+    try:
+        assert 0 < policy.kwargs(core.Retry)["timeout"] <= 0.5
+        core.RequestDeadline.start({}, {"RPC_DEADLINE": 10.0, "RPC_MAX_DEADLINE": 0.0})
+        with pytest.raises(AppError) as exc:
+            policy.kwargs(core.Retry)
+        assert exc.value.status_code == 504
+        with pytest.raises(AppError) as exc:
+            core.RequestDeadline.start({"X-Request-Deadline": "soon"}, {"RPC_DEADLINE": 10.0, "RPC_MAX_DEADLINE": 60.0})
+        assert exc.value.status_code == 400
+    finally:
+        core.RequestDeadline.clear()
+    assert policy.kwargs(core.Retry)["timeout"] == 5.0
+
+def test_rpc_errors_map_to_overload_statuses():
+    """Test that an overloaded backend surfaces as 503 with Retry-After and a timeout as 504."""
+    from google.api_core.exceptions import DeadlineExceeded, ServiceUnavailable
+    client = _client()
+    get = client.db.collection.return_value.document.return_value.get
+    client.db.collection.return_value.document.side_effect = None
+    for error, status in ((ServiceUnavailable("down"), 503), (DeadlineExceeded("slow"), 504), (KeyError(), 500)):
+        get.side_effect = error
+        with pytest.raises(AppError) as exc:
+            client.read_document("users", "a")
+        assert exc.value.status_code == status
+    assert get.call_args.kwargs["retry"] is not None
+    client.db.collection.return_value.document.return_value.set.side_effect = ServiceUnavailable("down")
+    with pytest.raises(AppError) as exc:
+        client.create_document_with_id("users", "a", {"n": 1})
+    assert exc.value.headers == {"Retry-After": "1"}
+    assert client.db.collection.return_value.document.return_value.set.call_args.kwargs["retry"] is None
+
+def test_stream_documents_uses_the_rpc_policy():
+    """Test that streamed queries get the retry and remaining-deadline timeout of other queries."""
+    client = _client()
+    client.policy = core.RpcPolicy(deadline=5.0)
+    query = client.db.collection.return_value.limit.return_value
+    query.stream.return_value = iter([])
+    assert list(client.stream_documents("users", [], [], 10)) == []
+    assert query.stream.call_args.kwargs["timeout"] == 5.0
+    core.RequestDeadline.start({}, {"RPC_DEADLINE": 10.0, "RPC_MAX_DEADLINE": 0.0})
+    try:
+        with pytest.raises(AppError) as exc:
+            client.stream_documents("users", [], [], 10)
+        assert exc.value.status_code == 504
+    finally:
+        core.RequestDeadline.clear()
+
+def test_concurrency_limiter_sheds_excess_requests():
+    """Test that requests over the per-key limit are rejected at once and slots are released."""
+    admission = core.AdmissionControl(per_api_key=1, per_collection=2, retry_after=3)
+    with admission.admit("k1", "users"):
+        with pytest.raises(AppError) as exc:
+            with admission.admit("k1", "orders"):
+                pass
+        assert (exc.value.status_code, exc.value.headers) == (429, {"Retry-After": "3"})
+        with admission.admit("k2", "users"):
+            with pytest.raises(AppError) as exc:
+                with admission.admit("k3", "users"):
+                    pass
+            assert exc.value.status_code == 503
+    assert admission.stats()["api_keys"] == {"limit": 1, "in_flight": 0, "shed": 1}
+    with admission.admit("k1", "users"):
+        pass
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import pytest
+from google.api_core.exceptions import NotFound
+from google.cloud import firestore
+import benchmark
+import transfer
+from core import FirestoreClient, AsyncFirestoreClient, PageCursor, AppError
+from fake_firestore import FakeFirestoreBackend, fake_client
+
+
+@pytest.fixture
+def backend():
+    backend = FakeFirestoreBackend()
+    for n in range(6):
+        backend.seed(f"users/u{n}", {"age": n, "team": "a" if n % 2 else "b", "tags": ["x"] if n < 3 else []})
+        backend.seed(f"users/u{n}/files/f0", {"size": n})
+    backend.seed("teams/t0/files/f0", {"size": 0})
+    return backend
+
+def _client(backend, client_class=FirestoreClient):
+    client = client_class.__new__(client_class)
+    client.db = fake_client(backend, asynchronous=client_class is AsyncFirestoreClient)
+    if client_class is AsyncFirestoreClient:
+        client.sync_db = fake_client(backend)
+    client.cache = None
+    return client
+
+def test_query_filters_orders_and_pages(backend):
+    """Test filters, ordering, projections and page tokens end to end through the real client library."""
+    client = _client(backend)
+    orders = PageCursor.orders([("age", ">", 1)], "-age")
+    data, token, total, version = client.query_documents("users", [("age", ">", 1)], orders, 2, fields=["team"],
+                                                         with_total=True)
+    assert data == [{"team": "a", "id": "u5"}, {"team": "b", "id": "u4"}]
+    assert total == 4
+    data, token, _, next_version = client.query_documents("users", [("age", ">", 1)], orders, 2, page_token=token)
+    assert [d["id"] for d in data] == ["u3", "u2"]
+    assert next_version != version
+
+    data, _, _, _ = client.query_documents("users", [("tags", "array_contains", "x"), ("team", "==", "b")],
+                                           PageCursor.orders([], None), 10)
+    assert [d["id"] for d in data] == ["u0", "u2"]
+
+def test_page_tokens_keep_firestore_value_types(backend):
+    """Test that pages ordered by references, geo points and bytes resume where they stopped."""
+    client = _client(backend)
+    for n in range(4):
+        backend.seed(f"pets/p{n}", {"owner": client.db.document(f"users/u{n // 2}"),
+                                    "spot": firestore.GeoPoint(n, 0), "tag": bytes([n])})
+    for field in ("owner", "spot", "tag"):
+        orders = PageCursor.orders([], field)
+        data, token, _, _ = client.query_documents("pets", [], orders, 2)
+        assert token is not None
+        data, _, _, _ = client.query_documents("pets", [], orders, 2, page_token=token)
+        assert [d["id"] for d in data] == ["p2", "p3"]
+
+def test_stream_documents_validates_before_streaming(backend):
+    client = _client(backend)
+    orders = PageCursor.orders([], "age")
+    with pytest.raises(AppError) as exc:
+        client.stream_documents("users", [], orders, 10, page_token="not-a-token")
+    assert exc.value.status_code == 400
+    assert [d["id"] for d in client.stream_documents("users", [("age", ">=", 4)], orders, 10)] == ["u4", "u5"]
+    assert list(client.stream_documents("users", [("age", ">", 9)], orders, 10)) == []
+
+def test_aggregate_and_subcollection_group(backend):
+    client = _client(backend)
+    assert client.aggregate("users", [("team", "==", "a")], count=True, sums=["age"], avgs=["age"]) == {
+        "count": 3, "sum": {"age": 9}, "avg": {"age": 3.0}
+    }
+    data, total_found = client.query_subcollection_group("users", "files", [], 2, offset=1, include_parent=True)
+    assert [(d["id"], d["age"], [f["size"] for f in d["files"]]) for d in data] == [("u1", 1, [1]), ("u2", 2, [2])]
+    assert total_found == 6
+    # Range filters keep the scope too: teams/t0/files/f0 is neither returned nor counted
+    data, total_found = client.query_subcollection_group("users", "files", [("size", "<", 3)], 2, offset=1)
+    assert [(d["id"], [f["size"] for f in d["files"]]) for d in data] == [("u1", [1]), ("u2", [2])]
+    assert total_found == 3
+
+def test_subcollection_group_skips_deeper_parents(backend):
+    """Test that documents under a nested parent of the same collection group are left out of the groups."""
+    backend.seed("users/u0/archive/a0/files/f1", {"size": 9})
+    client = _client(backend)
+    data, _ = client.query_subcollection_group("users", "files", [], 1, include_parent=True)
+    assert [(d["id"], d["files"]) for d in data] == [("u0", [{"id": "f0", "size": 0}])]
+
+def test_write_preconditions(backend):
+    client = _client(backend)
+    _, update_time = client.update_document("users", "u1", {"age": 10})
+    with pytest.raises(AppError) as exc:
+        client.update_document("users", "u1", {"age": 11}, if_match=update_time.replace(microsecond=0))
+    assert exc.value.status_code == 412
+    with pytest.raises(NotFound):
+        client.delete_document("users", "missing")
+    doc, read_time = client.read_document("users", "u1")
+    assert doc["age"] == 10
+    assert read_time == update_time
+
+def test_atomic_batch_rolls_back(backend):
+    """Test that a failed commit leaves no partial writes, while BatchWrite reports per-write statuses."""
+    client = _client(backend)
+    operations = [{"op": "set", "id": "new", "data": {"a": 1}}, {"op": "create", "id": "u0", "data": {}}]
+    results = client.batch_write("users", operations, atomic=True)
+    assert [r["status"] for r in results] == ["error", "error"]
+    assert client.read_document("users", "new") == (None, None)
+
+    results = client.batch_write("users", operations)
+    assert [r["status"] for r in results] == ["success", "error"]
+    doc, update_time = client.read_document("users", "new")
+    assert doc == {"id": "new", "a": 1}
+    assert results[0]["update_time"] == update_time.rfc3339()
+    assert results[0]["update_time"].endswith("Z")
+
+    results = client.batch_write("users", [{"op": "delete", "id": "new"}, {"op": "delete", "id": "missing"}])
+    assert [(r["status"], r.get("code")) for r in results] == [("success", None), ("error", 404)]
+    assert client.read_document("users", "new") == (None, None)
+
+def test_transforms_and_merge_through_the_client(backend):
+    """Test inline transforms on update, set(merge=True) with nested maps, and If-Match on a merge."""
+    client = _client(backend)
+    client.update_document("users", "u1", {"age": {"$increment": 5}, "tags": {"$arrayUnion": ["y"]},
+                                           "team": {"$delete": True}, "seen": {"$serverTimestamp": True}})
+    doc, update_time = client.read_document("users", "u1")
+    assert doc["age"] == 6 and doc["tags"] == ["x", "y"] and "team" not in doc
+    assert doc["seen"] == update_time
+
+    client.update_document("users", "u1", {"profile": {"city": "Oslo", "zip": "0150"}}, merge=True)
+    doc, update_time = client.update_document("users", "u1", {"profile": {"city": "Bergen"}, "age": {"$increment": 1}},
+                                              merge=True, return_document=True)
+    assert doc["profile"] == {"city": "Bergen", "zip": "0150"} and doc["age"] == 7
+    with pytest.raises(AppError) as exc:
+        client.update_document("users", "u1", {"age": 1}, merge=True, if_match=update_time.replace(microsecond=0))
+    assert exc.value.status_code == 412
+    echoed, update_time = client.update_document(
+        "users", "u1", {"profile": {"city": "Oslo", "zip": {"$delete": True}, "a.b": 1}, "age": {"$increment": 1}},
+        merge=True, if_match=update_time
+    )
+    assert echoed == {"id": "u1", "profile": {"city": "Oslo", "a.b": 1}}
+    doc = client.read_document("users", "u1")[0]
+    assert doc["profile"] == {"city": "Oslo", "a.b": 1} and doc["age"] == 8 and doc["tags"] == ["x", "y"]
+    assert client.create_document_with_id("users", "c1", {"n": 1, "at": {"$serverTimestamp": True}}) == {
+        "id": "c1", "n": 1
+    }
+
+    client.update_document("users", "new", {"profile": {"city": "Oslo"}, "n": {"$increment": 1}}, merge=True)
+    assert client.read_document("users", "new")[0] == {"id": "new", "profile": {"city": "Oslo"}, "n": 1}
+    with pytest.raises(NotFound):
+        client.update_document("users", "missing", {"n": {"$increment": 1}})
+    with pytest.raises(AppError) as exc:
+        client.update_document("users", "u1", {"profile": {"zip": {"$delete": True}}})
+    assert exc.value.status_code == 400
+
+    results = client.batch_write("users", [{"op": "set", "id": "u2", "merge": True, "data": {"age": {"$minimum": 0}}},
+                                           {"op": "create", "id": "c", "data": {"at": {"$serverTimestamp": True}}}])
+    assert [r["status"] for r in results] == ["success", "success"]
+    assert client.read_document("users", "u2")[0]["age"] == 0
+
+def test_sharded_counter(backend):
+    """Test that increments spread over shards and reads sum them, with a short-lived cached total."""
+    from concurrent.futures import ThreadPoolExecutor
+    from core import ShardedCounters
+    client = _client(backend)
+    client.counters = ShardedCounters(default_shards=4, shard_counts={"mailboxes/unread": 8}, cache_ttl=60)
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: client.increment_counter("mailboxes", "m1", "unread", 1 if i % 2 else 2), range(40)))
+    shards = fake_client(backend).collection("mailboxes/m1/counters/unread/shards").stream()
+    assert {int(doc.id) for doc in shards} <= set(range(8))
+
+    assert client.read_counter("mailboxes", "m1", "unread") == {
+        "id": "m1", "counter": "unread", "value": 60, "shards": 8
+    }
+    client.increment_counter("mailboxes", "m1", "unread", 0.5)
+    aggregations = backend.calls["run_aggregation_query"]
+    assert client.read_counter("mailboxes", "m1", "unread")["value"] == 60
+    assert backend.calls["run_aggregation_query"] == aggregations
+    assert client.read_counter("mailboxes", "m1", "unread", use_cache=False)["value"] == 60.5
+    assert client.read_counter("mailboxes", "m2", "unread")["value"] == 0
+    assert client.counters.shards("mailboxes", "other") == 4
+
+    async_client = _client(backend, AsyncFirestoreClient)
+    async_client.counters = ShardedCounters()
+    asyncio.run(async_client.increment_counter("mailboxes", "m1", "unread", 1))
+    assert asyncio.run(async_client.read_counter("mailboxes", "m1", "unread"))["value"] == 61.5
+
+def test_field_transforms(backend):
+    db = fake_client(backend)
+    db.document("users/u0").update({"age": firestore.Increment(5), "tags": firestore.ArrayUnion(["y", "x"])})
+    assert db.document("users/u0").get().to_dict()["age"] == 5
+    assert db.document("users/u0").get().to_dict()["tags"] == ["x", "y"]
+
+def test_export_and_import_round_trip(backend, tmp_path):
+    """Test that a partitioned export keeps value types and skips same-named subcollections on import."""
+    from datetime import datetime, timezone
+    db = fake_client(backend)
+    backend.seed("teams/t0/users/x", {"age": 99})
+    values = {
+        "at": datetime(2024, 6, 18, 10, 0, 0, 123456, tzinfo=timezone.utc), "blob": b"\x00\xff",
+        "where": firestore.GeoPoint(1.5, -2.0), "owner": db.document("teams/t0"), "ratio": float("inf"),
+        "nested": {"list": [1, 2.5, None, True, "s"]}
+    }
+    db.document("users/u0").set(values)
+
+    export = ["export", "users", str(tmp_path), "--partitions", "3", "--workers", "2", "--chunk-documents", "2"]
+    assert transfer.main(export, db=db) == 0
+    manifest = json.loads((tmp_path / "manifest.json").read_text())
+    assert manifest["documents"] == 6
+    assert sum(f["documents"] for f in manifest["files"]) == 6
+    assert max(f["documents"] for f in manifest["files"]) <= 2
+    assert backend.calls["partition_query"] == 1
+
+    assert transfer.main(["import", str(tmp_path), "--collection", "copy"], db=db) == 0
+    copied = {doc.id: doc.to_dict() for doc in db.collection("copy").stream()}
+    assert sorted(copied) == ["u0", "u1", "u2", "u3", "u4", "u5"]
+    assert copied["u0"] == values
+    assert copied["u3"] == {"age": 3, "team": "a", "tags": []}
+
+def test_import_counts_failures_but_lists_only_the_first(backend, tmp_path, monkeypatch):
+    """Test that an import that fails everywhere keeps a bounded error list and counts the rest."""
+    from google.api_core.exceptions import InvalidArgument
+    from core import CollectionImporter
+    db = fake_client(backend)
+    transfer.main(["export", "users", str(tmp_path)], db=db)
+
+    def reject(write, stored):
+        raise InvalidArgument("rejected")
+    monkeypatch.setattr(backend, "_check", reject)
+    monkeypatch.setattr(CollectionImporter, "MAX_REPORTED_ERRORS", 2)
+    result = CollectionImporter(db).run(str(tmp_path), collection="copy")
+    assert (result["documents"], result["written"], result["failed"]) == (6, 0, 6)
+    assert len(result["errors"]) == 2
+
+def test_import_requires_a_complete_export(backend, tmp_path):
+    db = fake_client(backend)
+    transfer.main(["export", "users", str(tmp_path)], db=db)
+    manifest = json.loads((tmp_path / "manifest.json").read_text())
+    manifest["files"][0]["documents"] += 1
+    (tmp_path / "manifest.json").write_text(json.dumps(manifest))
+    with pytest.raises(AppError):
+        transfer.main(["import", str(tmp_path), "--collection", "copy"], db=db)
+
+def test_async_client(backend):
+    client = _client(backend, AsyncFirestoreClient)
+    docs = asyncio.run(client.read_documents(["users/u1", "users/missing"]))
+    assert docs == [{"id": "u1", "age": 1, "team": "a", "tags": ["x"]}, None]
+
+    operations = [{"op": "set", "id": "new", "data": {"a": 1}}, {"op": "create", "id": "u0", "data": {}},
+                  {"op": "delete", "id": "u5"}]
+    results = asyncio.run(client.batch_write("users", operations))
+    assert [r["status"] for r in results] == ["success", "error", "success"]
+    assert asyncio.run(client.read_document("users", "new"))[0] == {"id": "new", "a": 1}
+    assert asyncio.run(client.read_document("users", "u5")) == (None, None)
+
+    async def stream():
+        docs = await client.stream_documents("users", [("age", ">=", 4)], PageCursor.orders([], "age"), 10)
+        return [doc["id"] async for doc in docs]
+    assert asyncio.run(stream()) == ["u4"]
+
+def test_benchmark_runs_every_scenario(monkeypatch):
+    """Smoke-test the benchmark harness with a handful of requests per scenario."""
+    monkeypatch.setattr(benchmark, "SEED_USERS", 60)
+    args = benchmark.parse_args(["--latency-ms", "0", "--requests", "3", "--warmup", "1", "--alloc-requests", "1"])
+    results = benchmark.run(args)
+    assert [r.scenario for r in results] == [s.name for s in benchmark.SCENARIOS]
+    assert all(r.errors == 0 and r.requests == 3 for r in results)
+
+def test_benchmark_measures_startup():
+    """Smoke-test the cold-start benchmark: one fresh process importing, building and querying the app."""
+    args = benchmark.parse_args(["--startup", "1", "--latency-ms", "0"])
+    [result] = benchmark.run_startup(args)
+    assert result.import_ms > 0 and result.first_response_ms > 0
+    assert result.process_ms > result.import_ms + result.create_app_ms + result.first_response_ms
+
+def test_warm_without_a_channel(backend):
+    """The in-memory client has no gRPC channel, so warming only creates the client."""
+    _client(backend).warm(timeout=1)
+    asyncio.run(_client(backend, AsyncFirestoreClient).warm(timeout=1))
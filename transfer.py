@@ -0,0 +1,61 @@
+# Command-line export and import of whole collections
+"""Export a Firestore collection to compressed NDJSON chunks, or import such an export.
+
+An export is a directory of gzip-compressed NDJSON files plus ``manifest.json``.
+The collection is read in parallel partitions; the import goes through a
+throttled BulkWriter. Credentials come from the same settings as the service.
+
+    python transfer.py export users ./exports/users --partitions 64 --workers 16
+    python transfer.py import ./exports/users --collection users_restored
+"""
+import argparse
+import json
+import sys
+
+from config import Config
+from core import configure_logging, FirestoreClient, CollectionExporter, CollectionImporter
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="export a collection to a directory")
+    export.add_argument("collection", help="collection path, e.g. users or users/u1/files")
+    export.add_argument("directory")
+    export.add_argument("--partitions", type=int, default=32, help="partitions requested from Firestore")
+    export.add_argument("--workers", type=int, default=8, help="partitions read concurrently")
+    export.add_argument("--chunk-documents", type=int, default=100000, help="documents per output file")
+    export.add_argument("--compresslevel", type=int, default=6, choices=range(1, 10), metavar="1-9")
+
+    load = commands.add_parser("import", help="import an export directory")
+    load.add_argument("directory")
+    load.add_argument("--collection", help="target collection (default: the exported one)")
+    load.add_argument("--initial-ops-per-second", type=int, default=500)
+    load.add_argument("--max-ops-per-second", type=int, default=10000)
+    load.add_argument("--max-attempts", type=int, default=10, help="attempts per write for retryable errors")
+    return parser.parse_args(argv)
+
+
+def main(argv=None, db=None):
+    args = parse_args(argv)
+    configure_logging()
+    db = db or FirestoreClient(Config.FIRESTORE_CREDENTIALS).db
+    if args.command == "export":
+        manifest = CollectionExporter(
+            db, partitions=args.partitions, workers=args.workers,
+            chunk_documents=args.chunk_documents, compresslevel=args.compresslevel
+        ).run(args.collection, args.directory)
+        print(json.dumps({key: value for key, value in manifest.items() if key != "files"}))
+        return 0
+
+    result = CollectionImporter(
+        db, initial_ops_per_second=args.initial_ops_per_second,
+        max_ops_per_second=args.max_ops_per_second, max_attempts=args.max_attempts
+    ).run(args.directory, args.collection)
+    print(json.dumps(result))
+    return 1 if result["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())